@@ -0,0 +1,183 @@
+import logging
+from collections import Counter
+
+from database import GachaHistory
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_anaLogger = logging.getLogger("AnalyticsLogger")
+
+BASE_RATE = {5: 0.02, 4: 0.08, 3: 0.50, 2: 0.40}
+SOFT_PITY_START = 50
+SOFT_PITY_STEP = 0.02
+MAX_PITY = 99
+PULL_COST = 600  # 合成玉
+
+
+def official_curve(max_pity: int = MAX_PITY):
+    """
+    官方6星概率曲线:连续50抽未出6星后每抽提升2%
+    返回 tuple[list[第k抽出6星的概率], list[恰好第k抽出6星的概率]],下标0对应第1抽
+    :param max_pity:
+    :return:
+    """
+    hazard = [min(1.0, BASE_RATE[5] + SOFT_PITY_STEP * max(0, k - SOFT_PITY_START)) for k in range(1, max_pity + 1)]
+    pmf = []
+    survive = 1.0
+    for p in hazard:
+        pmf.append(survive * p)
+        survive *= 1 - p
+    return hazard, pmf
+
+
+HAZARD, PMF = official_curve()
+EXPECTED_PULLS = sum((k + 1) * p for k, p in enumerate(PMF))
+
+
+def _bincount(values, minlength: int):
+    if np is not None:
+        return np.bincount(np.asarray(values, dtype=np.int64), minlength=minlength).tolist()
+    counts = Counter(values)
+    return [counts[i] for i in range(max(minlength, max(counts, default=-1) + 1))]
+
+
+def _as_histories(histories):
+    if isinstance(histories, GachaHistory):
+        return (histories,)
+    return tuple(histories)
+
+
+def pity_gaps(history: GachaHistory, rarity: int = 5):
+    """
+    同GachaHistory.pity_gaps,安装numpy时按卡池批量计算
+    :param history:
+    :param rarity:
+    :return:
+    """
+    if np is None:
+        return history.pity_gaps(rarity)
+    pool = np.frombuffer(history.column("pool"), dtype=np.int16)
+    hit = np.frombuffer(history.column("rarity"), dtype=np.int8) >= rarity
+    gaps = {}
+    remains = {}
+    for i, name in enumerate(history.pools):
+        positions = np.flatnonzero(hit[pool == i])
+        counts = int(np.count_nonzero(pool == i))
+        gaps[name] = np.diff(positions, prepend=-1).astype(np.int32)
+        remains[name] = counts - 1 - int(positions[-1]) if len(positions) else counts
+    return gaps, remains
+
+
+def pity_histogram(histories, rarity: int = 5):
+    """
+    返回 dict,包括:
+    gaps: list[抽数为k的次数],下标0对应第1抽;
+    reached: list[垫到第k抽的次数](含当前未出货的卡池);
+    hazard: list[第k抽的实际出货率];
+    official: list[第k抽的官方出货率]
+    :param histories: GachaHistory 或其可迭代对象
+    :param rarity:
+    :return:
+    """
+    completed = []
+    pending = []
+    for history in _as_histories(histories):
+        gaps, remains = pity_gaps(history, rarity)
+        for g in gaps.values():
+            completed.extend(g.tolist() if np is not None else g)
+        pending.extend(r for r in remains.values() if r)
+    length = max([MAX_PITY] + completed + pending)
+    hits = _bincount(completed, length + 1)[1:]
+    ends = _bincount(completed + pending, length + 1)[1:]
+    # 垫到第k抽的次数 = 在第k抽及以后才结束(出货或仍未出货)的次数
+    reached = []
+    total = len(completed) + len(pending)
+    for cnt in ends:
+        reached.append(total)
+        total -= cnt
+    hazard = [h / n if n else None for h, n in zip(hits, reached)]
+    _anaLogger.info(f"pity histogram of {len(completed)} gaps.")
+    return {"gaps": hits, "reached": reached, "hazard": hazard,
+            "official": (HAZARD + [1.0] * length)[:length] if rarity == 5 else [BASE_RATE.get(rarity)] * length}
+
+
+def empirical_rates(histories):
+    """
+    返回 dict[星级-1:tuple[实际出率, 官方综合出率]],6星综合出率按软保底曲线的期望抽数计算
+    :param histories:
+    :return:
+    """
+    counts = Counter()
+    total = 0
+    for history in _as_histories(histories):
+        if np is not None:
+            counts.update(dict(enumerate(np.bincount(np.frombuffer(history.column("rarity"), dtype=np.int8),
+                                                     minlength=6).tolist())))
+        else:
+            counts.update(history.rarity)
+        total += len(history)
+    official = dict(BASE_RATE)
+    official[5] = 1 / EXPECTED_PULLS
+    official[4] = BASE_RATE[4] * (1 - official[5]) / (1 - BASE_RATE[5])
+    return {rarity: (counts[rarity] / total if total else 0.0, official[rarity]) for rarity in (5, 4, 3, 2)}
+
+
+def luck(histories):
+    """
+    返回 dict,包括 pulls:总抽数; count:6星数; mean:平均出货抽数; expected:官方期望抽数;
+    percentile:欧气百分位(比多少百分比的博士更欧,按官方曲线计算); best/worst:最欧/最非的一次
+    :param histories:
+    :return:
+    """
+    completed = []
+    pulls = 0
+    for history in _as_histories(histories):
+        gaps, _ = pity_gaps(history)
+        for g in gaps.values():
+            completed.extend(g.tolist() if np is not None else g)
+        pulls += len(history)
+    if not completed:
+        return {"pulls": pulls, "count": 0, "mean": None, "expected": EXPECTED_PULLS, "percentile": None,
+                "best": None, "worst": None}
+    # 单次出货的百分位: P(X>g)+P(X=g)/2
+    survive = [1.0]
+    for p in PMF:
+        survive.append(survive[-1] - p)
+    scores = [max(0.0, survive[g]) + PMF[g - 1] / 2 if g <= MAX_PITY else 0.0 for g in completed]
+    return {"pulls": pulls, "count": len(completed), "mean": sum(completed) / len(completed),
+            "expected": EXPECTED_PULLS, "percentile": sum(scores) / len(scores) * 100,
+            "best": min(completed), "worst": max(completed)}
+
+
+def expected_remaining(pity: int):
+    """
+    已垫pity抽时,距离下个6星的期望抽数
+    :param pity:
+    :return:
+    """
+    if pity >= MAX_PITY:
+        return 1.0
+    rest = PMF[pity:]
+    return sum((k + 1) * p for k, p in enumerate(rest)) / sum(rest)
+
+
+def expected_cost(history: GachaHistory):
+    """
+    返回 tuple[tuple[卡池, 抽数, 6星数, 已垫抽数, 期望抽数, 期望合成玉]]
+    :param history:
+    :return:
+    """
+    gaps, remains = pity_gaps(history)
+    counts = history.pool_counts()
+    result = []
+    for pool, cnt in counts.items():
+        remain = expected_remaining(remains[pool])
+        result.append((pool, cnt, len(gaps[pool]), remains[pool], remain, remain * PULL_COST))
+    return tuple(result)
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,485 @@
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from database import GachaModel, UserModel, parse_export_file, parse_gacha_list, read_columnar
+from online_service import OnlineService
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+POOLS = ("常驻标准寻访", "联合行动", "限定寻访·庆典", "中坚寻访")
+RARITY_WEIGHTS = ((5, 2), (4, 8), (3, 50), (2, 40))
+
+
+def _model(database: str):
+    class BenchGachaModel(GachaModel):
+        DATABASE = database
+    return BenchGachaModel()
+
+
+def _peak_memory():
+    """
+    返回进程峰值内存(字节),没有resource模块时返回tracemalloc统计的Python分配峰值
+    """
+    if resource is None:
+        return tracemalloc.get_traced_memory()[1]
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def iter_entries(pulls: int, seed: int = 0, end: int = 1700000000):
+    """
+    逐条生成约pulls抽的模拟寻访记录(官方接口data.list格式),按时间倒序
+    """
+    rnd = random.Random(seed)
+    rarities = [r for r, w in RARITY_WEIGHTS for _ in range(w)]
+    ts = end
+    while pulls > 0:
+        size = 10 if rnd.random() < 0.5 and pulls >= 10 else 1
+        ts -= rnd.randint(1, 600)
+        chars = []
+        for _ in range(size):
+            rarity = rnd.choice(rarities)
+            chars.append({"name": f"干员{rarity}-{rnd.randrange(20)}", "rarity": rarity, "isNew": rnd.random() < 0.01})
+        yield {"ts": ts, "pool": rnd.choice(POOLS), "chars": chars}
+        pulls -= size
+
+
+def generate_file(file: str, pulls: int, seed: int = 0):
+    """
+    逐条写出模拟导出文件,不在内存中保存整个文档
+    """
+    total = 0
+    with open(file, "w", encoding="utf-8") as f:
+        f.write('{"code": 0, "data": {"list": [')
+        for i, entry in enumerate(iter_entries(pulls, seed)):
+            f.write((",\n" if i else "\n") + json.dumps(entry, ensure_ascii=False))
+            total += len(entry["chars"])
+        f.write('\n], "pagination": {"current": 1, "total": %d}}, "msg": "benchmark"}' % total)
+    return total
+
+
+def _run_load(file: str, database: str, batch_size: int or None):
+    if resource is None:
+        tracemalloc.start()  # tracemalloc会明显拖慢速度,只在无法读取RSS时使用
+    model = _model(database)
+    start = time.perf_counter()
+    with open(file, "r", encoding="utf-8") as f:
+        cnt, err = model.load(1, f, batch_size=batch_size)
+    duration = time.perf_counter() - start
+    model.close()
+    return {"rows": cnt, "rejected": err, "seconds": duration, "rows_per_second": cnt / duration,
+            "peak_memory": _peak_memory()}
+
+
+def bench_stream(pulls: int = 1000000, batch_size: int = 10000, compare: bool = False):
+    """
+    比较增量解析与整体解析的峰值内存和吞吐量,每种模式在独立的子进程中运行
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        file = os.path.join(tmp, "gacha.json")
+        total = generate_file(file, pulls)
+        print(f"generated {total} pulls ({os.path.getsize(file) / 2 ** 20:.1f} MiB)")
+        modes = (("stream", batch_size),) + ((("full", None),) if compare else ())
+        for mode, size in modes:
+            with ProcessPoolExecutor(1) as executor:  # 每种模式使用新进程,峰值内存互不影响
+                result = executor.submit(_run_load, file, os.path.join(tmp, f"{mode}.db"), size).result()
+            print("{:>6}: {rows} rows ({rejected} rejected) in {seconds:.2f}s, {rows_per_second:.0f} rows/s, "
+                  "peak {kind} {memory:.1f} MiB".format(mode, kind="python alloc" if resource is None else "rss",
+                                                        memory=result["peak_memory"] / 2 ** 20, **result))
+
+
+def bench_export(pulls: int = 100000, accounts: int = 10):
+    """
+    比较CSV、JSON与列式格式(ritc/parquet)导出全部账号后的文件大小和读取时间
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        file = os.path.join(tmp, "gacha.json")
+        model = _model(os.path.join(tmp, "export.db"))
+        for uid in range(1, accounts + 1):
+            generate_file(file, pulls // accounts, seed=uid)
+            with open(file, "r", encoding="utf-8") as f:
+                model.load(uid, f, batch_size=10000)
+        uids = model.get_uids()
+        print(f"{len(uids)} accounts, {model.get_version()} pulls")
+        for file_type in ("csv", "json", "ritc", "parquet"):
+            try:
+                if file_type in ("csv", "json"):
+                    for uid in uids:
+                        model.dump(uid, os.path.join(tmp, file_type, f"{uid}.{file_type}"))
+                    files = [os.path.join(tmp, file_type, f"{uid}.{file_type}") for uid in uids]
+                else:
+                    model.dump(None, os.path.join(tmp, f"all.{file_type}"))
+                    files = [os.path.join(tmp, f"all.{file_type}")]
+            except ValueError as e:
+                print(f"{file_type:>8}: skipped ({e})")
+                continue
+            size = sum(os.path.getsize(f) for f in files)
+            start = time.perf_counter()
+            if file_type in ("csv", "json"):
+                rows = sum(len(parse_export_file(f)[1]) for f in files)
+            else:
+                rows = sum(len(history) for history in read_columnar(files[0]))
+            duration = time.perf_counter() - start
+            print(f"{file_type:>8}: {size / 2 ** 20:8.2f} MiB, read {rows} rows in {duration:.3f}s")
+        model.close()
+
+
+def make_pages(pulls: int, seed: int = 0):
+    """
+    返回 list[bytes],按寻访记录接口的格式每页10条,与OnlineService.get_gacha(raw=True)返回的内容相同
+    """
+    entries = list(iter_entries(pulls, seed))
+    total = sum(len(entry["chars"]) for entry in entries)
+    return [json.dumps({"code": 0, "data": {"list": entries[i:i + 10],
+                                            "pagination": {"current": i // 10 + 1, "total": total}}, "msg": ""},
+                       ensure_ascii=False).encode("utf-8") for i in range(0, len(entries), 10)]
+
+
+class PageAdapter(HTTPAdapter):
+    """
+    从内存返回寻访记录页的连接池,不联网,用于测量OnlineService.get_gacha到入库的完整路径
+    """
+
+    def __init__(self, pages: list):
+        super().__init__()
+        self.pages = pages
+
+    def send(self, request, **kwargs):
+        page = int(parse_qs(urlsplit(request.url).query)["page"][0])
+        response = requests.Response()
+        response.status_code = 200
+        response.headers["Content-Type"] = "application/json"
+        response._content = self.pages[page - 1]
+        response.url = request.url
+        response.request = request
+        return response
+
+
+# 更新时使用的raw路径的内存上限,以页大小的倍数计(实测约为平均5.5倍、最大9倍)
+INGEST_PEAK_RATIO = 8
+INGEST_MAX_PEAK_RATIO = 16
+INGEST_BLOCK_LIMIT = 40  # 处理完一页后仍存活的新内存块数(实测约23)
+
+
+def bench_ingest(pulls: int = 20000):
+    """
+    用tracemalloc测量更新时每页的分配峰值与新增内存块数:get_gacha返回data.list再写入(json),
+    与返回原始字节直接交给loads(raw);日志级别与交互终端相同(DEBUG),输出丢弃
+    raw超过INGEST_PEAK_RATIO、INGEST_MAX_PEAK_RATIO或INGEST_BLOCK_LIMIT时记为失败
+    返回 退出码,有失败时为1
+    """
+    pages = make_pages(pulls)
+    page_size = sum(map(len, pages)) / len(pages)
+    print(f"{len(pages)} pages ({page_size:.0f} bytes/page)")
+    failures = []
+    logging.basicConfig(stream=open(os.devnull, "w", encoding="utf-8"), level=logging.DEBUG)
+    osv = OnlineService(adapter=PageAdapter(pages))
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ("json", "raw"):
+            model = _model(os.path.join(tmp, f"{mode}.db"))
+            peaks, blocks = [], []
+            tracemalloc.start()
+            start = time.perf_counter()
+            iterator = osv.get_gacha("benchmark", raw=mode == "raw")
+            while True:
+                tracemalloc.reset_peak()
+                current = tracemalloc.get_traced_memory()[0]
+                before = tracemalloc.take_snapshot() if len(blocks) < 20 else None  # 快照很慢,只统计前20页
+                page = next(iterator, None)
+                if page is None:
+                    break
+                model.loads(1, page)
+                del page
+                peaks.append(tracemalloc.get_traced_memory()[1] - current)
+                if before is not None:
+                    blocks.append(sum(stat.count_diff for stat in
+                                      tracemalloc.take_snapshot().compare_to(before, "filename")))
+            duration = time.perf_counter() - start
+            tracemalloc.stop()
+            mean_peak, mean_blocks = sum(peaks) / len(peaks), sum(blocks) / len(blocks)
+            print(f"{mode:>5}: {model.get_version(1)} rows in {duration:.2f}s (traced), peak per page "
+                  f"mean {mean_peak / 1024:.1f} KiB max {max(peaks) / 1024:.1f} KiB, "
+                  f"new blocks per page {mean_blocks:.1f}")
+            model.close()
+            if mode == "raw":
+                if mean_peak > page_size * INGEST_PEAK_RATIO:
+                    failures.append(f"mean peak {mean_peak / 1024:.1f} KiB > {INGEST_PEAK_RATIO}x page size")
+                if max(peaks) > page_size * INGEST_MAX_PEAK_RATIO:
+                    failures.append(f"max peak {max(peaks) / 1024:.1f} KiB > {INGEST_MAX_PEAK_RATIO}x page size")
+                if mean_blocks > INGEST_BLOCK_LIMIT:
+                    failures.append(f"{mean_blocks:.1f} new blocks per page > {INGEST_BLOCK_LIMIT}")
+    for failure in failures:
+        print(f"FAIL raw: {failure}")
+    return 1 if failures else 0
+
+
+# 读取方法: (名称, 调用, 复杂度),复杂度为数据库变大时耗时的增长方式:
+# "log"只按索引查找少数几行,"h"与该账号的记录数成正比,"a"与账号数成正比(汇总表、users表),"n"与总行数成正比
+READ_METHODS = (
+    ("GachaModel.get_global_pools", lambda m, uid: m.get_global_pools(), "a"),
+    ("GachaModel.get_global_rarity", lambda m, uid: m.get_global_rarity(), "a"),
+    ("GachaModel.get_global_rarity(uid)", lambda m, uid: m.get_global_rarity(uid), "log"),
+    ("GachaModel.get_top_operators", lambda m, uid: m.get_top_operators(10), "a"),
+    ("GachaModel.get_top_operators(rarity)", lambda m, uid: m.get_top_operators(10, rarity=5), "a"),
+    ("GachaModel.get_daily", lambda m, uid: m.get_daily(), "n"),
+    ("GachaModel.get_daily(uid)", lambda m, uid: m.get_daily(uid, earliest_day="2000-01-01"), "h"),
+    ("GachaModel.get_rarity", lambda m, uid: m.get_rarity(uid), "h"),
+    ("GachaModel.get_total", lambda m, uid: m.get_total(uid, max_cnt=100), "h"),
+    ("GachaModel.get_total_page", lambda m, uid: m.get_total_page(uid), "h"),
+    ("GachaModel.get_total_page(after)", lambda m, uid: m.get_total_page(uid, after=("2000-01-01 00:00:00", 0)),
+     "h"),
+    ("GachaModel.get_version", lambda m, uid: m.get_version(), "a"),
+    ("GachaModel.get_version(uid)", lambda m, uid: m.get_version(uid), "log"),
+    ("GachaModel.get_duration", lambda m, uid: m.get_duration(uid), "log"),
+    ("GachaModel.get_pools", lambda m, uid: m.get_pools(uid), "h"),
+    ("GachaModel.get_remains", lambda m, uid: m.get_remains(uid), "log"),
+    ("GachaModel.get_operators", lambda m, uid: m.get_operators(uid), "h"),
+    ("GachaModel.get_uids", lambda m, uid: m.get_uids(), "n"),
+    ("GachaModel.load_history", lambda m, uid: m.load_history(uid), "h"),
+    ("GachaModel.get_rows", lambda m, uid: m.get_rows(uid), "h"),
+    ("GachaModel.get_rows(after)", lambda m, uid: m.get_rows(uid, after=("2000-01-01 00:00:00", 0)), "h"),
+    ("GachaModel.dumps(csv)", lambda m, uid: m.dumps(uid, "csv"), "h"),
+    ("GachaModel.dumps(json)", lambda m, uid: m.dumps(uid, "json"), "h"),
+    ("UserModel.get_schedule", lambda m, uid: m.get_schedule(), "a"),
+    ("UserModel.get_identities(uid)", lambda m, uid: m.get_identities(uid=uid), "log"),
+    ("UserModel.get_identities(phone)", lambda m, uid: m.get_identities(phone=13800000000 + uid), "a"),
+    ("UserModel.get_identities(username)", lambda m, uid: m.get_identities(username=f"doctor{uid}"), "a"),
+    ("UserModel.get_identities(page)", lambda m, uid: m.get_identities(limit=10, offset=10), "log"),
+)
+# 写入文件或修改数据的方法只检查查询计划,不计时
+WRITE_METHODS = (
+    ("GachaModel.insert_many", lambda m, uid: m.insert_many(uid, parse_gacha_list(iter_entries(20, seed=-uid)))),
+    ("GachaModel.dumpb", lambda m, uid: m.dumpb((uid,))),
+    ("GachaModel.dump_append", lambda m, uid: m.dump_append(uid, f"{m.database}.{uid}.csv")),
+    ("GachaModel.insert_many(newer)", lambda m, uid: m.insert_many(uid, parse_gacha_list(
+        iter_entries(20, seed=-uid, end=1800000000)))),
+    ("GachaModel.dump_append(appended)", lambda m, uid: m.dump_append(uid, f"{m.database}.{uid}.csv")),
+    ("GachaModel.rebuild_rollups", lambda m, uid: m.rebuild_rollups()),
+    ("UserModel.insert_user", lambda m, uid: m.insert_user(uid, 1, phone=13800000000 + uid, username=f"doctor{uid}")),
+    ("UserModel.update_user", lambda m, uid: m.update_user(uid, 1, cookies="{}", update_time=True)),
+    ("UserModel.set_schedule", lambda m, uid: m.set_schedule(uid, time.time(), last_run=time.time(),
+                                                             last_result="ok")),
+    ("UserModel.delete_user", lambda m, uid: m.delete_user(uid=uid)),
+)
+PLAN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "query_plans.json")
+SCALING_TOLERANCE = 2.0  # 允许实测增长倍数超过预期的倍数,吸收计时误差;复杂度高一级时增长至少为预期的sqrt(总行数之比)倍
+
+
+def _user_model(database: str):
+    class BenchUserModel(UserModel):
+        DATABASE = database
+    return BenchUserModel()
+
+
+def _fill(gacha: GachaModel, users: UserModel, accounts: int, pulls: int, first_uid: int = 1):
+    """
+    写入uid从first_uid开始的accounts个账号,每个账号约pulls抽,并在users中登记账号与同步计划
+    """
+    for uid in range(first_uid, first_uid + accounts):
+        gacha.insert_many(uid, parse_gacha_list(iter_entries(pulls, seed=uid)))
+        users.insert_user(uid, 1, phone=13800000000 + uid, username=f"doctor{uid}")
+        users.set_schedule(uid, time.time() + uid)
+
+
+def _plan(connection, sql: str, args=()):
+    """
+    返回 list[str],EXPLAIN QUERY PLAN的结果,子节点按层级缩进
+    """
+    depth = {0: -1}
+    result = []
+    for node, parent, _, detail in connection.execute("EXPLAIN QUERY PLAN " + sql, args):
+        depth[node] = depth.get(parent, -1) + 1
+        result.append("  " * depth[node] + detail)
+    return result
+
+
+def capture_plans(model, uid: int, methods):
+    """
+    依次调用methods中属于该model的方法,记录经过execute/executemany的每条SQL语句及其查询计划
+    返回 dict[方法名:dict[SQL:list[查询计划]]]
+    """
+    prefix = next(cls.__name__ for cls in type(model).__mro__ if cls.__name__ in ("GachaModel", "UserModel")) + "."
+    result = {}
+    for name, call, *_ in methods:
+        if not name.startswith(prefix):
+            continue
+        statements = []
+
+        def execute(sql, args=tuple(), debug: bool = False):
+            statements.append((sql, tuple(args)))
+            return type(model).execute(model, sql, args, debug)
+
+        def executemany(sql, seq_of_args):
+            seq_of_args = list(seq_of_args)
+            statements.append((sql, tuple(seq_of_args[0]) if seq_of_args else None))
+            return type(model).executemany(model, sql, seq_of_args)
+
+        model.execute, model.executemany = execute, executemany
+        try:
+            call(model, uid)
+        finally:
+            del model.execute, model.executemany
+        plans = result[name] = {}
+        for sql, args in statements:
+            sql = " ".join(sql.split())
+            if sql not in plans and args is not None:
+                plans[sql] = _plan(model.connection, sql, args)
+    return result
+
+
+def bench_plans(accounts: int = 20, pulls: int = 1000, update: bool = False, file: str = PLAN_FILE):
+    """
+    在模拟的多账号数据库上记录GachaModel与UserModel全部语句的查询计划,与file中保存的预期比较
+    返回 退出码,有不一致(如索引查找变为全表扫描)时为1
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        gacha, users = _model(os.path.join(tmp, "gacha.db")), _user_model(os.path.join(tmp, "users.db"))
+        _fill(gacha, users, accounts, pulls)
+        uid = accounts // 2 + 1
+        plans = {}
+        for model in (gacha, users):
+            plans.update(capture_plans(model, uid, READ_METHODS))
+        new_uid = accounts + 1
+        for model in (gacha, users):
+            plans.update(capture_plans(model, new_uid, WRITE_METHODS))
+        gacha.close()
+        users.close()
+    if update or not os.path.exists(file):
+        with open(file, "w", encoding="utf-8") as f:
+            json.dump(plans, f, ensure_ascii=False, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"wrote {sum(map(len, plans.values()))} query plans of {len(plans)} methods to '{file}'")
+        return 0
+    with open(file, "r", encoding="utf-8") as f:
+        expected = json.load(f)
+    failures = 0
+    for name in sorted(set(plans) | set(expected)):
+        got, want = plans.get(name), expected.get(name)
+        if got == want:
+            continue
+        failures += 1
+        print(f"FAIL {name}")
+        for sql in sorted(set(got or {}) | set(want or {})):
+            old, new = (want or {}).get(sql), (got or {}).get(sql)
+            if old == new:
+                continue
+            print(f"  {sql}")
+            scans = [line.strip() for line in new or () if line.strip().startswith("SCAN")
+                     and line not in (old or ())]
+            print("    expected: " + ("(not executed)" if old is None else " | ".join(s.strip() for s in old)))
+            print("    actual:   " + ("(not executed)" if new is None else " | ".join(s.strip() for s in new)))
+            if scans:
+                print("    new full scans: " + ", ".join(scans))
+    print(f"{len(plans)} methods, {failures} with changed query plans"
+          + ("" if not failures else f" (run with --update to accept them into '{file}')"))
+    return 1 if failures else 0
+
+
+def _median_time(call, repeat: int):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call()
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def bench_scaling(sizes=(10000, 100000, 1000000), pulls: int = 1000, repeat: int = 5):
+    """
+    逐步把总行数增加到sizes中的各个规模,账号数与每个账号的抽数都按sqrt(规模之比)增长(最小规模时每个账号约pulls抽),
+    在最后加入的账号上测量每个读取方法的耗时中位数
+    耗时增长超过预期(log:总行数对数之比,h:该账号抽数之比,a:账号数之比,n:总行数之比)SCALING_TOLERANCE倍时记为失败
+    返回 退出码,有失败时为1
+    """
+    sizes = sorted(sizes)
+    timings = {name: [] for name, _, _ in READ_METHODS}
+    steps = []  # list[tuple[总行数, 账号数, 测量账号的抽数]]
+    with tempfile.TemporaryDirectory() as tmp:
+        gacha, users = _model(os.path.join(tmp, "gacha.db")), _user_model(os.path.join(tmp, "users.db"))
+        accounts = 0
+        for size in sizes:
+            start = time.perf_counter()
+            step_pulls = round(pulls * math.sqrt(size / sizes[0]))
+            while gacha.get_version() < size:
+                accounts += 1
+                _fill(gacha, users, 1, step_pulls, first_uid=accounts)
+            uid = accounts
+            steps.append((gacha.get_version(), accounts, gacha.get_version(uid)))
+            print("{} rows, {} accounts, {} pulls in the measured account (filled in {:.1f}s)".format(
+                *steps[-1], time.perf_counter() - start))
+            for name, call, _ in READ_METHODS:
+                model = gacha if name.startswith("GachaModel.") else users
+                call(model, uid)  # 预热页缓存
+                timings[name].append(_median_time(lambda: call(model, uid), repeat))
+        gacha.close()
+        users.close()
+    (rows0, accounts0, history0), (rows1, accounts1, history1) = steps[0], steps[-1]
+    expected = {"log": math.log(rows1) / math.log(rows0), "h": history1 / history0, "a": accounts1 / accounts0,
+                "n": rows1 / rows0}
+    print(f"{'method':<38}{'':>4}" + "".join(f"{step[0]:>11}" for step in steps) + f"{'growth':>9}{'allowed':>9}")
+    failures = 0
+    for name, _, complexity in READ_METHODS:
+        # 太快的调用计时误差较大,以0.05ms为下限
+        ratio = max(timings[name][-1], 5e-5) / max(timings[name][0], 5e-5)
+        limit = expected[complexity] * SCALING_TOLERANCE
+        failed = ratio > limit
+        failures += failed
+        print(f"{name:<38}{complexity:>4}" + "".join(f"{t * 1000:9.3f}ms" for t in timings[name])
+              + f"{ratio:8.1f}x{limit:8.1f}x" + ("  FAIL" if failed else ""))
+    print(f"{len(READ_METHODS)} methods, {failures} scaling worse than expected ({rows1 / rows0:.0f}x rows, "
+          f"{accounts1 / accounts0:.0f}x accounts, {history1 / history0:.0f}x pulls per account)")
+    return 1 if failures else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rhodes Island Terminal benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+    stream = sub.add_parser("stream", help="streaming JSON ingest: peak memory and throughput")
+    stream.add_argument("--pulls", type=int, default=1000000)
+    stream.add_argument("--batch-size", type=int, default=10000)
+    stream.add_argument("--compare", action="store_true", help="also run the json.load path")
+    export = sub.add_parser("export", help="export formats: file size and read time")
+    export.add_argument("--pulls", type=int, default=100000)
+    export.add_argument("--accounts", type=int, default=10)
+    ingest = sub.add_parser("ingest", help="per-page allocations of the update path (tracemalloc)")
+    ingest.add_argument("--pulls", type=int, default=20000)
+    plans = sub.add_parser("plans", help="compare query plans of every model statement with query_plans.json")
+    plans.add_argument("--accounts", type=int, default=20)
+    plans.add_argument("--pulls", type=int, default=1000, help="pulls per account")
+    plans.add_argument("--update", action="store_true", help="accept the current plans as expected")
+    plans.add_argument("--file", default=PLAN_FILE)
+    scaling = sub.add_parser("scaling", help="latency of read methods as the database grows")
+    scaling.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000], help="total rows")
+    scaling.add_argument("--pulls", type=int, default=1000, help="pulls per account at the smallest size")
+    scaling.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+    if args.command == "stream":
+        bench_stream(args.pulls, args.batch_size, args.compare)
+    elif args.command == "export":
+        bench_export(args.pulls, args.accounts)
+    elif args.command == "ingest":
+        return bench_ingest(args.pulls)
+    elif args.command == "plans":
+        return bench_plans(args.accounts, args.pulls, args.update, args.file)
+    elif args.command == "scaling":
+        return bench_scaling(args.sizes, args.pulls, args.repeat)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
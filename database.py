@@ -1,11 +1,31 @@
+import codecs
 import glob
 import hashlib
+import itertools
+from array import array
+from collections import Counter
 import os
 import sqlite3
+import threading
 import atexit
+import bisect
 import logging
 import datetime
 import json
+import re
+import struct
+import sys
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import metrics
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 _dbLogger = logging.getLogger("DataBaseLogger")
 
@@ -21,7 +41,9 @@ atexit.register(_e)
 
 class SqlConnection:
     _instance = None
+    _sql_files = {}  # .sql文件路径 -> (修改时间, 内容)
     ENCODING = "utf-8"
+    SCHEMA_VERSION = 1  # 写入PRAGMA user_version,表结构变化时加1并在upgrade中补全
 
     def __new__(cls, *args, **kwargs):
         if cls._instance is None:
@@ -35,53 +57,79 @@ class SqlConnection:
         database = os.path.abspath(database)
         self.database = database
         self.echo = echo
+        # 连接可在后台线程中使用(如后台更新),语句由lock串行执行,每次执行使用独立的游标
+        kwargs.setdefault("check_same_thread", False)
+        self.lock = threading.RLock()
         self.connection = sqlite3.connect(database, *args, **kwargs)
         self.cursor = self.connection.cursor()
         _dbLogger.info(f"connect to database '{database}'.")
 
-        exist = bool(self.cursor.execute("select * from sqlite_master limit 1").fetchall())
-
-        if not exist:
-            _dbLogger.info(f"initialize database '{database}'.")
-
-            if isinstance(initializations, str):
-                initializations = (initializations,)
-
-            for line in initializations:
-                if isinstance(line, (list, tuple)):
-                    sql = line[0]
-                    sql_val = line[1]
-                elif isinstance(line, str):
-                    if os.path.isfile(line):
-                        sql_val = ()
-                        with open(line, "r", encoding=self.ENCODING) as f:
-                            sql = f.read()
-                    elif os.path.isdir(line):
-                        for file in glob.glob(os.path.join(line, "*.sql")):
-                            with open(file, "r", encoding=self.ENCODING) as f:
-                                try:
-                                    self.cursor.execute(f.read())
-                                except Exception as e:
-                                    _dbLogger.error(
-                                        f"meet {e.__class__.__name__} when initialize {self.__class__.__name__}:{e}")
-                                    raise e
-                                finally:
-                                    _dbLogger.debug(f"{self.__class__.__name__} do sql '{sql}'")
-                        continue
-                    else:
-                        sql = line
-                        sql_val = ()
-                else:
-                    continue
+        # user_version等于SCHEMA_VERSION说明表结构已经建立并检查过,只需读取一次pragma
+        version = self.cursor.execute("PRAGMA user_version").fetchone()[0]
+        if version == self.SCHEMA_VERSION:
+            return
+        if version > self.SCHEMA_VERSION:
+            _dbLogger.warning(f"schema version of '{database}' is {version}, newer than {self.SCHEMA_VERSION}.")
+            return
 
-                try:
+        exist = bool(self.cursor.execute("select * from sqlite_master limit 1").fetchall())
+        try:
+            self.cursor.execute("BEGIN")  # 建表与升级在同一个事务中完成,只写入一次
+            if exist:
+                _dbLogger.info(f"upgrade database '{database}' from schema version {version}.")
+                self.upgrade()
+            else:
+                _dbLogger.info(f"initialize database '{database}'.")
+                for sql, sql_val in self._init_statements(initializations):
                     self.cursor.execute(sql, sql_val)
-                except Exception as e:
-                    _dbLogger.error(f"meet {e.__class__.__name__} when initialize {self.__class__.__name__}: \
-{e}")
-                    raise e
-                finally:
                     _dbLogger.debug(f"{self.__class__.__name__} do sql '{sql}'")
+            self.cursor.execute(f"PRAGMA user_version={int(self.SCHEMA_VERSION)}")
+            self.connection.commit()
+        except Exception as e:
+            _dbLogger.error(f"meet {e.__class__.__name__} when initialize {self.__class__.__name__}: {e}")
+            self.connection.rollback()
+            raise e
+
+    @classmethod
+    def _init_statements(cls, initializations):
+        """
+        展开初始化语句:str为SQL语句、.sql文件或包含.sql文件的目录,tuple/list为(SQL, 参数)
+        返回 list[tuple[SQL, 参数]]
+        """
+        if isinstance(initializations, str):
+            initializations = (initializations,)
+        statements = []
+        for line in initializations:
+            if isinstance(line, (list, tuple)):
+                statements.append((line[0], line[1]))
+            elif isinstance(line, str) and os.path.isdir(line):
+                files = sorted(glob.glob(os.path.join(line, "*.sql")))
+                statements.extend((cls._read_sql(file), ()) for file in files)
+            elif isinstance(line, str) and os.path.isfile(line):
+                statements.append((cls._read_sql(line), ()))
+            elif isinstance(line, str):
+                statements.append((line, ()))
+        return statements
+
+    @classmethod
+    def _read_sql(cls, file: str) -> str:
+        """
+        读取.sql文件,按(路径, 修改时间)缓存,同一进程中多次打开数据库时不重复读取
+        """
+        file = os.path.abspath(file)
+        mtime = os.stat(file).st_mtime_ns
+        cached = cls._sql_files.get(file)
+        if cached is None or cached[0] != mtime:
+            with open(file, "r", encoding=cls.ENCODING) as f:
+                cached = cls._sql_files[file] = (mtime, f.read())
+        return cached[1]
+
+    def upgrade(self):
+        """
+        在已有的旧版本(user_version小于SCHEMA_VERSION)数据库上补全表结构,在初始化事务中调用,子类按需重写
+        :return:
+        """
+        pass
 
     # 别写__del__,会出事(logging无法记录)
 
@@ -93,11 +141,13 @@ class SqlConnection:
 
     def commit(self):
         _dbLogger.debug(f"database '{self.database}' commit.")
-        return self.connection.commit()
+        with self.lock:
+            return self.connection.commit()
 
     def rollback(self):
         _dbLogger.debug(f"database '{self.database}' rollback.")
-        return self.connection.rollback()
+        with self.lock:
+            return self.connection.rollback()
 
     def close(self):
         try:
@@ -110,25 +160,524 @@ class SqlConnection:
 
     def execute(self, sql, args=tuple(), debug: bool = False):
         sql_tr = sql.replace("?", "{}").format(*map(repr, args))
+        start = time.perf_counter() if metrics.enabled else None
         try:
-            self.cursor.execute(sql, args)
+            with self.lock:
+                cursor = self.connection.execute(sql, args)
         except Exception as e:
             msg = f"meet {e.__class__.__name__} when do sql '{sql_tr}'."
             if debug:
                 _dbLogger.debug(msg)
             else:
                 _dbLogger.error(msg)
+            if start is not None:
+                metrics.incr("sql_error", sql)
             raise e
         else:
+            if start is not None:
+                metrics.observe("sql", sql, time.perf_counter() - start)
             _dbLogger.debug(f"{self.__class__.__name__} do sql '{sql_tr}'.")
             if self.echo:
                 print(sql_tr)
-        return self.cursor
+        return cursor
+
+    def executemany(self, sql, seq_of_args):
+        start = time.perf_counter() if metrics.enabled else None
+        try:
+            with self.lock:
+                cursor = self.connection.executemany(sql, seq_of_args)
+        except Exception as e:
+            _dbLogger.error(f"meet {e.__class__.__name__} when do sql '{sql}' many times: {e}")
+            if start is not None:
+                metrics.incr("sql_error", sql)
+            raise e
+        else:
+            if start is not None:
+                metrics.observe("sql", sql, time.perf_counter() - start)
+                metrics.incr("sql_rows", sql, cursor.rowcount)
+            _dbLogger.debug(f"{self.__class__.__name__} do sql '{sql}' {cursor.rowcount} times.")
+            if self.echo:
+                print(sql)
+        return cursor
+
+
+def open_databases(*factories):
+    """
+    在线程池中同时打开多个数据库,各自的连接和初始化事务互不影响,冷启动耗时取决于最慢的一个
+    返回 tuple[各factory()的返回值]
+    :param factories: 如UserModel, GachaModel
+    :return:
+    """
+    if len(factories) <= 1:
+        return tuple(factory() for factory in factories)
+    with ThreadPoolExecutor(len(factories), thread_name_prefix="open-db") as executor:
+        return tuple(executor.map(lambda factory: factory(), factories))
+
+
+def file_digests(file: str, chunk_size: int = 1 << 20):
+    """
+    分块读取文件
+    返回 tuple[md5, sha256]
+    :param file:
+    :param chunk_size:
+    :return:
+    """
+    md5, sha256 = hashlib.md5(), hashlib.sha256()
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+            sha256.update(chunk)
+    return md5.hexdigest(), sha256.hexdigest()
+
+
+def parse_gacha_list(js: list):
+    """
+    将官方接口格式的data.list转换为行
+    返回 list[tuple[时间, 序号, 卡池, 干员, 星级-1, 是否为新]]
+    :param js:
+    :return:
+    """
+    rows = []
+    for line in js:
+        ts = datetime.datetime.fromtimestamp(line["ts"]).strftime("%Y-%m-%d %H:%M:%S")
+        pool = line["pool"]
+        start = (len(line['chars']) - 1) // 9  # 0/1
+        for j, char in enumerate(line['chars']):
+            if char is None:  # dump导出的不完整十连
+                continue
+            rows.append((ts, start + j, pool, char['name'], char['rarity'], char['isNew']))
+    return rows
+
+
+def parse_gacha_csv(lines):
+    """
+    解析GachaModel.dump导出的CSV(时间,卡池,序号,干员,稀有度),同一时间的连续行视为一次寻访
+    CSV中没有是否为新干员的信息,一律视为否
+    返回 list[tuple[时间, 序号, 卡池, 干员, 星级-1, 是否为新]]
+    :param lines: 不含表头的行
+    :return:
+    """
+    rows = []
+    group = []
+
+    def flush():
+        start = (len(group) - 1) // 9
+        rows.extend((ts, start + j, pool, name, rarity, False) for j, (ts, pool, name, rarity) in enumerate(group))
+        group.clear()
+
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if not line:
+            continue
+        items = line.split(",")
+        # 卡池名中可能含有逗号,其余字段均不会
+        ts, pool, name, rarity = items[0], ",".join(items[1:-3]), items[-2], int(items[-1].rstrip("星")) - 1
+        if group and group[0][0] != ts:
+            flush()
+        group.append((ts, pool, name, rarity))
+    if group:
+        flush()
+    return rows
+
+
+def parse_export_file(file: str):
+    """
+    解析一个导出的JSON或CSV文件,可在子进程中调用
+    返回 tuple[文件, list[行] 或 None, 错误信息 或 None]
+    :param file:
+    :return:
+    """
+    try:
+        file_type = os.path.splitext(file)[-1][1:].lower()
+        if file_type == "csv":
+            with open(file, "r", encoding="utf-8-sig") as f:
+                header = f.readline()
+                if not header.startswith("时间,"):
+                    raise ValueError(f"'{file}' is not a csv made by GachaModel.dump.")
+                return file, parse_gacha_csv(f), None
+        elif file_type == "json":
+            with open(file, "r", encoding="utf-8") as f:
+                return file, parse_gacha_list(JsonListStream(f)), None
+        else:
+            raise ValueError(f"file type must be 'csv' or 'json', not '{file_type}'")
+    except Exception as e:
+        return file, None, f"{e.__class__.__name__}: {e}"
+
+
+class JsonListStream:
+    """
+    增量解析JSON文档中的某个列表,逐条返回列表元素,内存占用只与缓冲区和单条记录的大小有关
+    默认读取官方接口格式的data.list,文档本身为列表时直接读取该列表
+    """
+    _decoder = json.JSONDecoder()
+
+    def __init__(self, fp, path: tuple or list = ("data", "list"), chunk_size: int = 1 << 16):
+        """
+        :param fp: 文本或二进制文件对象,也可以是str或bytes等缓冲区(如HTTP响应的原始内容,只解码一次)
+        :param path: 列表所在的键路径
+        :param chunk_size: 每次读取的字符(字节)数
+        """
+        self.path = tuple(path)
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        if isinstance(fp, str):
+            self.fp = None
+            self.buf = fp
+        elif isinstance(fp, (bytes, bytearray, memoryview)):
+            self.fp = None
+            self.buf = str(fp, "utf-8-sig")
+        else:
+            self.fp = fp
+        self._byte_decoder = codecs.getincrementaldecoder("utf-8-sig")()
+
+    def _fill(self) -> bool:
+        if self.fp is None:
+            return False
+        chunk = self.fp.read(self.chunk_size)
+        while isinstance(chunk, bytes):
+            raw = chunk
+            chunk = self._byte_decoder.decode(raw, final=not raw)
+            if chunk or not raw:
+                break
+            chunk = self.fp.read(self.chunk_size)  # 读到多字节字符的一部分
+        if not chunk:
+            self.fp = None
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self) -> str:
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def _expect(self, chars: str) -> str:
+        c = self._peek()
+        if not c or c not in chars:
+            raise ValueError(f"expect one of '{chars}' at char {self.pos}, got '{c}'.")
+        self.pos += 1
+        return c
+
+    def _decode(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # 数字可能被缓冲区截断(如'-1.5'只读到'-1.'),后面必须紧跟分隔符才能确定已读完
+            if (end < len(self.buf) and self.buf[end] in ",:]} \t\r\n") or not self._fill():
+                self.pos = end
+                return value
+
+    def _seek(self, path: tuple) -> bool:
+        if not path:
+            return self._peek() == "["
+        self._expect("{")
+        if self._peek() == "}":
+            return False
+        while True:
+            key = self._decode()
+            self._expect(":")
+            if key == path[0]:
+                return self._seek(path[1:])
+            self._decode()
+            if self._expect(",}") == "}":
+                return False
+
+    def __iter__(self):
+        if self._peek() != "[" and not self._seek(self.path):
+            return
+        self._expect("[")
+        if self._peek() == "]":
+            return
+        while True:
+            yield self._decode()
+            if self._expect(",]") == "]":
+                return
+
+
+class GachaHistory:
+    """
+    列式存储的抽卡记录,每列为一个array,按(时间, 序号)升序排列,每抽约15字节
+    ts:int64 时间戳; sequence:int8 十连内序号; pool:int16 卡池编号; operator:int16 干员编号; rarity:int8 星级-1;
+    isNew:uint8 是否为新干员. 卡池和干员名称分别保存在pools与operators中,编号即为下标.
+    """
+    COLUMNS = (("ts", "q"), ("sequence", "b"), ("pool", "h"), ("operator", "h"), ("rarity", "b"), ("isNew", "B"))
+
+    def __init__(self, uid: int = None, pools: list or tuple = (), operators: list or tuple = ()):
+        self.uid = uid
+        self.pools = list(pools)
+        self.operators = list(operators)
+        self._pool_ids = {name: i for i, name in enumerate(self.pools)}
+        self._operator_ids = {name: i for i, name in enumerate(self.operators)}
+        self.ts = array("q")
+        self.sequence = array("b")
+        self.pool = array("h")
+        self.operator = array("h")
+        self.rarity = array("b")
+        self.isNew = array("B")
+
+    def __len__(self):
+        return len(self.ts)
+
+    def __getitem__(self, item: int):
+        """
+        返回tuple[时间戳, 序号, 卡池, 干员, 星级-1, 是否为新]
+        :param item:
+        :return:
+        """
+        return (self.ts[item], self.sequence[item], self.pools[self.pool[item]], self.operators[self.operator[item]],
+                self.rarity[item], bool(self.isNew[item]))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).itemsize * len(self) for name, _ in self.COLUMNS)
+
+    def column(self, name: str) -> memoryview:
+        """
+        返回某一列的memoryview,切片不复制数据
+        :param name:
+        :return:
+        """
+        if name not in dict(self.COLUMNS):
+            _dbLogger.error(f"no column '{name}' in {self.__class__.__name__}.")
+            raise KeyError(name)
+        return memoryview(getattr(self, name))
+
+    def pool_id(self, pool: str) -> int:
+        i = self._pool_ids.get(pool)
+        if i is None:
+            i = self._pool_ids[pool] = len(self.pools)
+            self.pools.append(pool)
+        return i
+
+    def operator_id(self, operator: str) -> int:
+        i = self._operator_ids.get(operator)
+        if i is None:
+            i = self._operator_ids[operator] = len(self.operators)
+            self.operators.append(operator)
+        return i
+
+    def append(self, ts: int, sequence: int, pool: str, operator: str, rarity: int, isNew: bool or int):
+        self.ts.append(ts)
+        self.sequence.append(sequence)
+        self.pool.append(self.pool_id(pool))
+        self.operator.append(self.operator_id(operator))
+        self.rarity.append(rarity)
+        self.isNew.append(bool(isNew))
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(*row)
+
+    def pool_counts(self):
+        """
+        返回 dict[卡池:抽数],按卡池首次出现顺序排列
+        :return:
+        """
+        counts = Counter(self.pool)
+        return {pool: counts[i] for i, pool in enumerate(self.pools) if counts[i]}
+
+    def rarity_counts(self):
+        """
+        返回 dict[星级-1:数量],与GachaModel.get_rarity格式一致
+        :return:
+        """
+        result = {2: 0, 3: 0, 4: 0, 5: 0}
+        result.update(Counter(self.rarity))
+        return result
+
+    def rarity_rates(self):
+        """
+        返回 dict[星级-1:出率]
+        :return:
+        """
+        total = len(self)
+        return {rarity: cnt / total if total else 0.0 for rarity, cnt in self.rarity_counts().items()}
+
+    def pity_gaps(self, rarity: int = 5):
+        """
+        返回 (dict[卡池:array[抽数]], dict[卡池:距离上个该星级抽数]),
+        前者为每次抽到不低于该星级干员时所用的抽数,后者为每个卡池当前已垫的抽数
+        :param rarity:
+        :return:
+        """
+        gaps = [array("i") for _ in self.pools]
+        counter = [0] * len(self.pools)
+        for pool, rar in zip(self.pool, self.rarity):
+            counter[pool] += 1
+            if rar >= rarity:
+                gaps[pool].append(counter[pool])
+                counter[pool] = 0
+        return ({name: gaps[i] for i, name in enumerate(self.pools)},
+                {name: counter[i] for i, name in enumerate(self.pools)})
+
+    def to_bytes(self) -> bytes:
+        """
+        返回一个列式数据块:uid与行数,卡池和干员的字典,之后每列为长度前缀的小端序原始数组,
+        ts列保存与上一行的差值(十连内为0,便于压缩)
+        :return:
+        """
+        parts = [struct.pack("<qI", -1 if self.uid is None else self.uid, len(self))]
+        for names in (self.pools, self.operators):
+            parts.append(struct.pack("<H", len(names)))
+            for name in names:
+                raw = name.encode("utf-8")
+                parts.append(struct.pack("<H", len(raw)) + raw)
+        for name, _ in self.COLUMNS:
+            column = getattr(self, name)
+            if name == "ts":
+                column = array("q", (b - a for a, b in zip(itertools.chain((0,), column), column)))
+            if sys.byteorder == "big":
+                column = array(column.typecode, column)
+                column.byteswap()
+            raw = column.tobytes()
+            parts.append(struct.pack("<I", len(raw)) + raw)
+        return b"".join(parts)
+
+    @classmethod
+    def from_buffer(cls, buffer: bytes or memoryview, offset: int = 0):
+        """
+        读取to_bytes写出的数据块
+        返回 tuple[GachaHistory, 数据块之后的偏移量]
+        :param buffer:
+        :param offset:
+        :return:
+        """
+        buffer = memoryview(buffer)
+        uid, rows = struct.unpack_from("<qI", buffer, offset)
+        offset += 12
+        dictionaries = []
+        for _ in range(2):
+            cnt, = struct.unpack_from("<H", buffer, offset)
+            offset += 2
+            names = []
+            for _ in range(cnt):
+                size, = struct.unpack_from("<H", buffer, offset)
+                names.append(str(buffer[offset + 2:offset + 2 + size], "utf-8"))
+                offset += 2 + size
+            dictionaries.append(names)
+        history = cls(None if uid == -1 else uid, *dictionaries)
+        for name, typecode in cls.COLUMNS:
+            size, = struct.unpack_from("<I", buffer, offset)
+            column = array(typecode)
+            column.frombytes(buffer[offset + 4:offset + 4 + size])
+            if sys.byteorder == "big":
+                column.byteswap()
+            if name == "ts":
+                column = array("q", itertools.accumulate(column))
+            if len(column) != rows:
+                _dbLogger.error(f"column '{name}' has {len(column)} rows, {rows} expected.")
+                raise ValueError(f"column '{name}' has {len(column)} rows, {rows} expected.")
+            setattr(history, name, column)
+            offset += 4 + size
+        return history, offset
+
+
+COLUMNAR_MAGIC = b"RITC"
+COLUMNAR_VERSION = 1
+COLUMNAR_TYPES = ("ritc", "parquet")
+
+
+def dump_columnar(histories, file_type: str = "ritc") -> bytes:
+    """
+    返回列式导出文件的内容,每个GachaHistory(一个账号)为一个数据块
+    ritc: 'RITC', 版本号(uint8), 3字节保留, 数据块数(uint32), 之后每个数据块为长度(uint32)与zlib压缩的
+          GachaHistory.to_bytes()
+    parquet: 需要安装pyarrow,卡池与干员为字典编码列
+    :param histories:
+    :param file_type:
+    :return:
+    """
+    file_type = file_type.lower()
+    if file_type == "ritc":
+        blocks = [zlib.compress(history.to_bytes(), 6) for history in histories]
+        return COLUMNAR_MAGIC + struct.pack("<B3xI", COLUMNAR_VERSION, len(blocks)) + \
+            b"".join(struct.pack("<I", len(block)) + block for block in blocks)
+    elif file_type == "parquet":
+        if pyarrow is None:
+            _dbLogger.error("parquet export needs pyarrow.")
+            raise ValueError("parquet export needs pyarrow, use 'ritc' instead.")
+        tables = []
+        for history in histories:
+            tables.append(pyarrow.table({
+                "uid": pyarrow.array([history.uid] * len(history), pyarrow.int64()),
+                "ts": pyarrow.array(history.ts, pyarrow.int64()).cast(pyarrow.timestamp("s")),
+                "sequence": pyarrow.array(history.sequence, pyarrow.int8()),
+                "pool": pyarrow.DictionaryArray.from_arrays(pyarrow.array(history.pool, pyarrow.int16()),
+                                                            pyarrow.array(history.pools, pyarrow.string())),
+                "operator": pyarrow.DictionaryArray.from_arrays(pyarrow.array(history.operator, pyarrow.int16()),
+                                                                pyarrow.array(history.operators, pyarrow.string())),
+                "rarity": pyarrow.array(history.rarity, pyarrow.int8()),
+                "isNew": pyarrow.array(history.isNew, pyarrow.uint8()).cast(pyarrow.bool_()),
+            }))
+        sink = pyarrow.BufferOutputStream()
+        if tables:
+            pyarrow.parquet.write_table(pyarrow.concat_tables(tables), sink)
+        return sink.getvalue().to_pybytes()
+    _dbLogger.error(f"columnar file type must be one of {COLUMNAR_TYPES}, not '{file_type}'")
+    raise ValueError(f"columnar file type must be one of {COLUMNAR_TYPES}, not '{file_type}'")
+
+
+def read_columnar(file: str):
+    """
+    读取dump_columnar写出的文件(.ritc或.parquet)
+    返回 list[GachaHistory],每个账号一个
+    :param file:
+    :return:
+    """
+    if os.path.splitext(file)[-1].lower() == ".parquet":
+        if pyarrow is None:
+            _dbLogger.error("parquet import needs pyarrow.")
+            raise ValueError("parquet import needs pyarrow.")
+        table = pyarrow.parquet.read_table(file)
+        columns = table.to_pydict()
+        columns["ts"] = table.column("ts").cast(pyarrow.int64()).to_pylist()
+        histories = {}
+        for uid, ts, seq, pool, operator, rarity, is_new in zip(
+                columns["uid"], columns["ts"], columns["sequence"], columns["pool"], columns["operator"],
+                columns["rarity"], columns["isNew"]):
+            history = histories.get(uid)
+            if history is None:
+                history = histories[uid] = GachaHistory(uid)
+            history.append(ts, seq, pool, operator, rarity, is_new)
+        return list(histories.values())
+    with open(file, "rb") as f:
+        buffer = f.read()
+    if buffer[:4] != COLUMNAR_MAGIC:
+        _dbLogger.error(f"'{file}' is not a ritc file.")
+        raise ValueError(f"'{file}' is not a ritc file.")
+    version, blocks = struct.unpack_from("<B3xI", buffer, 4)
+    if version != COLUMNAR_VERSION:
+        _dbLogger.error(f"unsupported ritc version {version}.")
+        raise ValueError(f"unsupported ritc version {version}.")
+    offset = 12
+    histories = []
+    for _ in range(blocks):
+        size, = struct.unpack_from("<I", buffer, offset)
+        histories.append(GachaHistory.from_buffer(zlib.decompress(buffer[offset + 4:offset + 4 + size]))[0])
+        offset += 4 + size
+    return histories
 
 
 class UserModel(SqlConnection):
     DATABASE = "./data/users.db"
     DB_KEY = "Secret key for users.db"
+    SCHEDULE_INIT = "CREATE TABLE sync_schedule(uid INTEGER NOT NULL PRIMARY KEY, next_run REAL NOT NULL, failures \
+INTEGER NOT NULL DEFAULT 0, last_run REAL, last_result TEXT)"
     DB_INIT = (
         "CREATE TABLE users(\
 uid integer NOT NULL UNIQUE,\
@@ -139,11 +688,43 @@ cookies TEXT,\
 first_time DATETIME DEFAULT (DATETIME('now', 'localtime')),\
 latest_time DATETIME DEFAULT (DATETIME('now', 'localtime'))\
 )",
+
+        SCHEDULE_INIT,
     )
 
     def __init__(self):
         super().__init__(self.DATABASE, self.DB_INIT)
 
+    def upgrade(self):
+        if not self.cursor.execute("SELECT name FROM sqlite_master WHERE name='sync_schedule'").fetchall():
+            _dbLogger.info(f"create sync_schedule in '{self.database}'.")
+            self.cursor.execute(self.SCHEDULE_INIT)
+
+    def get_schedule(self):
+        """
+        返回 dict[uid:tuple[下次同步时间戳, 连续失败次数, 上次同步时间戳, 上次同步结果]]
+        :return:
+        """
+        sql = "SELECT uid, next_run, failures, last_run, last_result FROM sync_schedule"
+        _dbLogger.info("get schedule.")
+        return {line[0]: line[1:] for line in self.execute(sql).fetchall()}
+
+    def set_schedule(self, uid: int, next_run: float, failures: int = 0, last_run: float = None,
+                     last_result: str = None) -> bool:
+        sql = ("INSERT INTO sync_schedule(uid, next_run, failures, last_run, last_result) VALUES (?,?,?,?,?) "
+               "ON CONFLICT(uid) DO UPDATE SET next_run=excluded.next_run, failures=excluded.failures, "
+               "last_run=IFNULL(excluded.last_run, last_run), last_result=IFNULL(excluded.last_result, last_result)")
+        with self.lock:  # 执行与提交之间不允许其他线程写入
+            try:
+                self.execute(sql, (uid, next_run, failures, last_run, last_result))
+            except Exception as e:
+                _dbLogger.error(f"meet {e.__class__.__name__} when set schedule (uid='{uid}'): {str(e)}")
+                return False
+            else:
+                self.commit()
+                _dbLogger.info("set schedule.")
+                return True
+
     @staticmethod
     def prepare_sql(uid: int = None, phone: str = None, username: str = None, channel_id: int = None,
                     cookies: str = None, join: str = "AND", username_mode: str = "LIKE"):
@@ -199,28 +780,30 @@ latest_time DATETIME DEFAULT (DATETIME('now', 'localtime'))\
             sql += ", cookies"
             sql_val += (cookies,)
         sql += ") VALUES (?, ?, DATETIME('now', 'localtime')" + ",?" * (len(sql_val) - 2) + ")"
-        try:
-            self.execute(sql, sql_val)
-        except Exception as e:
-            _dbLogger.error(f"meet {e.__class__.__name__} when insert user(uid='{uid}'): {str(e)}")
-            return False
-        else:
-            self.commit()
-            _dbLogger.info("insert user.")
-            return True
+        with self.lock:
+            try:
+                self.execute(sql, sql_val)
+            except Exception as e:
+                _dbLogger.error(f"meet {e.__class__.__name__} when insert user(uid='{uid}'): {str(e)}")
+                return False
+            else:
+                self.commit()
+                _dbLogger.info("insert user.")
+                return True
 
     def delete_user(self, uid: int = None, phone: str = None, username: str = None, channel_id: int = 1) -> bool:
         sql, sql_val = self.prepare_sql(uid=uid, phone=phone, username=username, channel_id=channel_id)
         sql = "DELETE FROM users" + " WHERE " * bool(sql) + sql
-        try:
-            self.execute(sql, sql_val)
-        except Exception as e:
-            _dbLogger.error(f"meet {e.__class__.__name__} when delete user(uid='{uid}'): {str(e)}")
-            return False
-        else:
-            self.commit()
-            _dbLogger.info("delete user.")
-            return True
+        with self.lock:
+            try:
+                self.execute(sql, sql_val)
+            except Exception as e:
+                _dbLogger.error(f"meet {e.__class__.__name__} when delete user(uid='{uid}'): {str(e)}")
+                return False
+            else:
+                self.commit()
+                _dbLogger.info("delete user.")
+                return True
 
     def update_user(self, uid: int, channel_id: int = None, /, *, phone: str = None, username: str = None,
                     cookies: str = None, update_time: bool = False) -> bool:
@@ -231,20 +814,69 @@ latest_time DATETIME DEFAULT (DATETIME('now', 'localtime'))\
             sql += ", " * bool(sql) + " latest_time=DATETIME('now', 'localtime') "
         sql = "UPDATE users SET " + sql + " WHERE uid=? AND channel_id=?"
         sql_val += (uid, channel_id)
-        try:
-            self.execute(sql, sql_val)
-        except Exception as e:
-            _dbLogger.error(f"meet {e.__class__.__name__} when update user (uid='{uid}'): {str(e)}")
-            return False
-        else:
-            self.commit()
-            _dbLogger.info("update user.")
-            return True
+        with self.lock:
+            try:
+                self.execute(sql, sql_val)
+            except Exception as e:
+                _dbLogger.error(f"meet {e.__class__.__name__} when update user (uid='{uid}'): {str(e)}")
+                return False
+            else:
+                self.commit()
+                _dbLogger.info("update user.")
+                return True
 
 
 class GachaModel(SqlConnection):
     DATABASE = "./data/AkGacha.db"
     DB_KEY = "Secret key for AkGacha.db"
+    CSV_HEADER = "时间,卡池,序号,干员,稀有度\n"
+    EXPORT_STATE_SUFFIX = ".state"
+    ROLLUP_INIT = (
+        "CREATE TABLE gacha_rollup(uid INTEGER NOT NULL, pool TEXT NOT NULL, rarity INTEGER NOT NULL, cnt INTEGER NOT \
+NULL DEFAULT 0, PRIMARY KEY(uid, pool, rarity))",
+
+        "CREATE TABLE gacha_daily(uid INTEGER NOT NULL, day DATE NOT NULL, cnt INTEGER NOT NULL DEFAULT 0, PRIMARY KEY\
+(uid, day))",
+
+        "CREATE TABLE operator_rollup(uid INTEGER NOT NULL, operator TEXT NOT NULL, cnt INTEGER NOT NULL DEFAULT 0, \
+PRIMARY KEY(uid, operator))",
+
+        "CREATE TRIGGER rollup_gacha AFTER INSERT ON gacha FOR EACH ROW\n\
+BEGIN\n\
+INSERT INTO gacha_rollup(uid, pool, rarity, cnt) SELECT new.uid, new.pool, rarity, 1 FROM operators WHERE \
+name=new.operator ON CONFLICT(uid, pool, rarity) DO UPDATE SET cnt=cnt+1;\n\
+INSERT INTO gacha_daily(uid, day, cnt) VALUES (new.uid, DATE(new.ts), 1) ON CONFLICT(uid, day) DO UPDATE SET \
+cnt=cnt+1;\n\
+INSERT INTO operator_rollup(uid, operator, cnt) VALUES (new.uid, new.operator, 1) ON CONFLICT(uid, operator) DO \
+UPDATE SET cnt=cnt+1;\n\
+END;",
+    )
+    # 每个卡池最后一个6星的位置(时间, 十连内序号)及其后的抽数,没有6星时位置为NULL,抽数为该卡池总抽数
+    PITY_INIT = (
+        "CREATE TABLE gacha_pity(uid INTEGER NOT NULL, pool TEXT NOT NULL, last_ts DATETIME, last_sequence INTEGER, \
+cnt INTEGER NOT NULL DEFAULT 0, PRIMARY KEY(uid, pool))",
+
+        "CREATE TRIGGER pity_gacha AFTER INSERT ON gacha FOR EACH ROW\n\
+BEGIN\n\
+INSERT INTO gacha_pity(uid, pool) VALUES (new.uid, new.pool) ON CONFLICT(uid, pool) DO NOTHING;\n\
+UPDATE gacha_pity SET last_ts=new.ts, last_sequence=new.sequence, cnt=(SELECT COUNT(*) FROM gacha WHERE uid=new.uid \
+AND pool=new.pool AND (ts, sequence)>(new.ts, new.sequence)) WHERE uid=new.uid AND pool=new.pool AND (SELECT rarity \
+FROM operators WHERE name=new.operator)=5 AND (last_ts IS NULL OR (new.ts, new.sequence)>(last_ts, last_sequence));\n\
+UPDATE gacha_pity SET cnt=cnt+1 WHERE uid=new.uid AND pool=new.pool AND (SELECT rarity FROM operators WHERE \
+name=new.operator)<>5 AND (last_ts IS NULL OR (new.ts, new.sequence)>(last_ts, last_sequence));\n\
+END;",
+    )
+    ROLLUP_SELECT = {
+        "gacha_rollup": "SELECT uid, pool, rarity, COUNT(*) FROM gacha JOIN operators ON gacha.operator=operators.name \
+GROUP BY uid, pool, rarity",
+        "gacha_daily": "SELECT uid, DATE(ts), COUNT(*) FROM gacha GROUP BY uid, DATE(ts)",
+        "operator_rollup": "SELECT uid, operator, COUNT(*) FROM gacha GROUP BY uid, operator",
+        "gacha_pity": "SELECT p.uid, p.pool, l.ts, l.sequence, (SELECT COUNT(*) FROM gacha g WHERE g.uid=p.uid AND \
+g.pool=p.pool AND (l.ts IS NULL OR (g.ts, g.sequence)>(l.ts, l.sequence))) FROM (SELECT DISTINCT uid, pool FROM gacha) \
+p LEFT JOIN (SELECT uid, pool, ts, sequence, ROW_NUMBER() OVER(PARTITION BY uid, pool ORDER BY ts DESC, sequence DESC) \
+AS rn FROM gacha JOIN operators ON gacha.operator=operators.name WHERE rarity=5) l ON p.uid=l.uid AND p.pool=l.pool \
+AND l.rn=1",
+    }
     DB_INIT = (
         "CREATE TABLE gacha(uid INTEGER NOT NULL, ts DATETIME NOT NULL, sequence INTEGER DEFAULT 0 CHECK\
 (sequence BETWEEN 0 AND 10), pool TEXT DEFAULT '常驻标准寻访', operator TEXT NOT NULL, isNew BOOL DEFAULT\
@@ -264,10 +896,109 @@ BEGIN\nSELECT RAISE(ROLLBACK,'operator not found') WHERE NOT EXISTS (SELECT * FR
 name=new.operator);\n\
 SELECT RAISE(ROLLBACK,'INSERT FORBIDDEN');\n\
 END;"
-    )
+    ) + ROLLUP_INIT + PITY_INIT
 
-    def __init__(self):
-        super().__init__(self.DATABASE, self.DB_INIT)
+    def __init__(self, database: str = None):
+        super().__init__(self.DATABASE if database is None else database, self.DB_INIT)
+
+    def upgrade(self):
+        missing = [init for table, init in (("gacha_rollup", self.ROLLUP_INIT), ("gacha_pity", self.PITY_INIT))
+                   if not self.cursor.execute("SELECT name FROM sqlite_master WHERE name=?", (table,)).fetchall()]
+        if missing:
+            _dbLogger.info(f"create rollup tables in '{self.database}'.")
+            for sql in (sql for init in missing for sql in init):
+                self.cursor.execute(sql)
+            self.rebuild_rollups(commit=False)
+
+    def rebuild_rollups(self, commit: bool = True):
+        """
+        根据gacha表重新计算汇总表,在同一事务内完成
+        返回 dict[汇总表:不一致的分组数],正常情况下均为0
+        :param commit: 为False时由调用者提交(如在初始化事务中)
+        :return:
+        """
+        result = {}
+        with self.lock:  # 重建期间其他线程的写入或提交会带上写了一半的汇总表
+            try:
+                for table, select in self.ROLLUP_SELECT.items():
+                    fresh = set(self.execute(select).fetchall())
+                    stored = set(self.execute(f"SELECT * FROM {table}").fetchall())
+                    result[table] = len(fresh ^ stored)
+                    self.execute(f"DELETE FROM {table}")
+                    self.execute(f"INSERT INTO {table} " + select)
+            except Exception as e:
+                _dbLogger.error(f"meet {e.__class__.__name__} when rebuild rollups: {e}")
+                self.rollback()
+                raise e
+            if commit:
+                self.commit()
+        _dbLogger.info(f"rebuild rollups: {result}.")
+        return result
+
+    def get_global_pools(self):
+        """
+        返回 tuple[tuple[卡池, 抽数, 6星数]],全部账号汇总,按抽数降序
+        :return:
+        """
+        sql = ("SELECT pool, SUM(cnt), SUM(CASE WHEN rarity=5 THEN cnt ELSE 0 END) FROM gacha_rollup GROUP BY pool "
+               "ORDER BY SUM(cnt) DESC")
+        _dbLogger.info("get global pools.")
+        return tuple(self.execute(sql).fetchall())
+
+    def get_global_rarity(self, uid: int = None):
+        """
+        返回 dict[星级-1:数量],uid为None时汇总全部账号
+        :param uid:
+        :return:
+        """
+        sql = "SELECT rarity, SUM(cnt) FROM gacha_rollup "
+        sql_val = ()
+        if uid is not None:
+            sql += "WHERE uid=? "
+            sql_val += (uid,)
+        sql += "GROUP BY rarity"
+        result = {2: 0, 3: 0, 4: 0, 5: 0}
+        result.update(dict(self.execute(sql, sql_val).fetchall()))
+        _dbLogger.info("get global rarity.")
+        return result
+
+    def get_top_operators(self, limit: int = 10, rarity: int = None):
+        """
+        返回 tuple[tuple[干员, 星级-1, 抽到次数, 抽到的账号数]],全部账号汇总
+        :param limit:
+        :param rarity:
+        :return:
+        """
+        sql = ("SELECT operator, rarity, SUM(cnt) AS total, COUNT(uid) FROM operator_rollup LEFT JOIN operators ON "
+               "operator_rollup.operator=operators.name ")
+        sql_val = ()
+        if rarity is not None:
+            sql += "WHERE rarity=? "
+            sql_val += (rarity,)
+        sql += "GROUP BY operator ORDER BY total DESC LIMIT ?"
+        sql_val += (limit,)
+        _dbLogger.info("get top operators.")
+        return tuple(self.execute(sql, sql_val).fetchall())
+
+    def get_daily(self, uid: int = None, earliest_day: str = None):
+        """
+        返回 tuple[tuple[日期, 抽数]],uid为None时汇总全部账号
+        :param uid:
+        :param earliest_day:
+        :return:
+        """
+        sql = "SELECT day, SUM(cnt) FROM gacha_daily "
+        cond = ()
+        sql_val = ()
+        if uid is not None:
+            cond += ("uid=?",)
+            sql_val += (uid,)
+        if earliest_day is not None:
+            cond += ("day>=?",)
+            sql_val += (earliest_day,)
+        sql += ("WHERE " + " AND ".join(cond) + " " if cond else "") + "GROUP BY day ORDER BY day ASC"
+        _dbLogger.info("get daily.")
+        return tuple(self.execute(sql, sql_val).fetchall())
 
     def get_rarity(self, uid: int, earliest_time: str or int or float = None):
         """
@@ -314,14 +1045,43 @@ END;"
         _dbLogger.info("get total.")
         return tuple(self.execute(sql, sql_val).fetchall())
 
+    def get_total_page(self, uid: int, after: tuple or list = None, limit: int = 100):
+        """
+        按(时间, 十连内序号)分页,after为上一页最后一条的(时间, 十连内序号)
+        返回 tuple[tuple[时间, 十连内序号, 卡池, 序号, 名字, 星级]]
+        :param uid:
+        :param after:
+        :param limit:
+        :return:
+        """
+        sql = "SELECT ts, sequence, pool, row, name, PRINTF('%d星', rarity+1) AS rarity FROM gacha_view WHERE uid=? "
+        sql_val = (uid,)
+        if after is not None:
+            sql += "AND (ts, sequence) > (?, ?) "
+            sql_val += tuple(after)
+        sql += "ORDER BY ts ASC, sequence ASC LIMIT ?"
+        sql_val += (limit,)
+        _dbLogger.info("get total page.")
+        return tuple(self.execute(sql, sql_val).fetchall())
+
+    def get_version(self, uid: int = None):
+        """
+        返回数据版本号(记录总数),只会随写入增大,可用于判断数据是否变化
+        :param uid: 为None时返回全部账号的版本号
+        :return:
+        """
+        sql = "SELECT IFNULL(SUM(cnt), 0) FROM gacha_rollup" + ("" if uid is None else " WHERE uid=?")
+        return self.execute(sql, () if uid is None else (uid,)).fetchone()[0]
+
     def get_duration(self, uid: int):
         """
         返回[最大值,最小值]
         :param uid:
         :return:
         """
-        sql = "SELECT MIN(ts), MAX(ts) FROM gacha WHERE uid=?"
-        sql_val = (uid,)
+        # MIN与MAX写在同一个SELECT中时sqlite不使用min/max优化,会扫描该账号的全部记录
+        sql = "SELECT (SELECT MIN(ts) FROM gacha WHERE uid=?), (SELECT MAX(ts) FROM gacha WHERE uid=?)"
+        sql_val = (uid, uid)
         _dbLogger.info("get duration.")
         return self.execute(sql, sql_val).fetchone()
 
@@ -345,16 +1105,13 @@ END;"
 
     def get_remains(self, uid: int):
         """
-        返回tuple[tuple[卡池, 距离上个6星抽数]]
+        返回tuple[tuple[卡池, 距离上个6星抽数]],先是抽到过6星的卡池,再是没抽到过的,各自按卡池名排序
+        读取触发器维护的gacha_pity,只扫描该账号的卡池数行,与历史记录条数无关
         :param uid:
         :return:
         """
-        sql = ("SELECT pool, cnt FROM (SELECT pool, cnt-1 as cnt, ROW_NUMBER() OVER(PARTITION BY pool ORDER BY cnt ASC)"
-               " AS row FROM (SELECT pool, rarity, ROW_NUMBER() OVER(PARTITION BY pool ORDER BY ts DESC, sequence DESC)"
-               " AS cnt FROM gacha_view WHERE uid=?) WHERE rarity=5) WHERE row=1 UNION ALL SELECT pool, COUNT(operator)"
-               " AS cnt FROM gacha WHERE uid=? GROUP BY pool HAVING pool NOT IN (SELECT pool FROM gacha_view WHERE"
-               " uid=? GROUP BY pool HAVING MAX(rarity)=5)")
-        sql_val = (uid,) * 3
+        sql = "SELECT pool, cnt FROM gacha_pity WHERE uid=? ORDER BY last_ts IS NULL, pool"
+        sql_val = (uid,)
         results = self.execute(sql, sql_val).fetchall()
         _dbLogger.info("get remains.")
         return tuple(results)
@@ -387,77 +1144,224 @@ END;"
         _dbLogger.info("get operators.")
         return results
 
-    def loads(self, uid: int, js: str or dict or list):
+    def get_uids(self):
+        """
+        返回 tuple[uid]
+        :return:
+        """
+        _dbLogger.info("get uids.")
+        return tuple(uid for uid, in self.execute("SELECT DISTINCT uid FROM gacha ORDER BY uid").fetchall())
+
+    def load_history(self, uid: int):
         """
-        返回tuple[总条数, 错误条数, 总干员, 错误干员]
+        返回 GachaHistory,一次查询载入该用户全部抽卡记录
         :param uid:
-        :param js:
         :return:
         """
-        tp = str(type(js))
-        if isinstance(js, str):
+        sql = ("SELECT CAST(STRFTIME('%s', ts, 'utc') AS INTEGER), sequence, pool, operator, IFNULL(rarity, 0), isNew "
+               "FROM gacha LEFT JOIN operators ON gacha.operator=operators.name WHERE uid=? "
+               "ORDER BY ts ASC, sequence ASC")
+        history = GachaHistory(uid)
+        history.extend(self.execute(sql, (uid,)))
+        _dbLogger.info(f"load history of {len(history)} lines.")
+        return history
+
+    def get_rows(self, uid: int, after: tuple or list = None):
+        """
+        返回 list[tuple[时间, 序号, 卡池, 干员, 星级-1, 是否为新]],格式同insert_many的rows
+        :param uid:
+        :param after: 只返回(时间, 十连内序号)大于after的记录
+        :return:
+        """
+        sql = ("SELECT ts, sequence, pool, operator, IFNULL(rarity, 0), isNew FROM gacha LEFT JOIN operators ON "
+               "gacha.operator=operators.name WHERE uid=? ")
+        sql_val = (uid,)
+        if after is not None:
+            sql += "AND (ts, sequence)>(?,?) "
+            sql_val += tuple(after)
+        return self.execute(sql + "ORDER BY ts ASC, sequence ASC", sql_val).fetchall()
+
+    def insert_many(self, uid: int, rows, commit: bool = True):
+        """
+        批量写入,rows为tuple[时间, 序号, 卡池, 干员, 星级-1, 是否为新]的可迭代对象
+        已存在的记录以及会被insert_gacha触发器拒绝的记录会被预先过滤并计入错误条数
+        返回tuple[总条数, 错误条数]
+        :param uid:
+        :param rows:
+        :param commit:
+        :return:
+        """
+        rows = sorted(rows, key=lambda r: (r[0], r[1]))
+        if not rows:
+            return 0, 0
+        with self.lock:  # 预过滤与写入之间不允许其他线程写入
+            existing = {}
+            for ts, seq in self.execute("SELECT ts, sequence FROM gacha WHERE uid=? AND ts BETWEEN ? AND ?",
+                                        (uid, rows[0][0], rows[-1][0])):
+                existing.setdefault(ts, set()).add(seq)
+            accepted = []
+            for row in rows:
+                seqs = existing.setdefault(row[0], set())
+                if row[1] in seqs or (seqs and max(seqs) > row[1]) or \
+                        not (isinstance(row[4], int) and 0 <= row[4] <= 5):
+                    continue
+                seqs.add(row[1])
+                accepted.append(row)
+            try:
+                self.executemany("INSERT OR IGNORE INTO operators(name, rarity) VALUES (?,?)",
+                                 {(r[3], r[4]) for r in accepted})
+                self.executemany("INSERT INTO gacha(uid, ts, sequence, pool, operator, isNew) VALUES (?,?,?,?,?,?)",
+                                 [(uid,) + r[:4] + r[5:] for r in accepted])
+            except Exception as e:
+                self.rollback()
+                raise e
+            if commit:
+                self.commit()
+        if metrics.enabled:
+            metrics.incr("ingest", "rows", len(rows))
+            metrics.incr("ingest", "inserted", len(accepted))
+            metrics.incr("ingest", "rejected", len(rows) - len(accepted))
+        return len(rows), len(rows) - len(accepted)
+
+    def loads(self, uid: int, js: str or bytes or dict or list, batch_size: int = None):
+        """
+        返回tuple[总条数, 错误条数]
+        :param uid:
+        :param js: 也可以是bytes(如OnlineService.get_gacha(raw=True)返回的原始响应),直接从字节解码,日志不记录整个内容
+        :param batch_size: 不为None且js为str或bytes时增量解析,每batch_size条写入一次
+        :return:
+        """
+        raw = isinstance(js, (str, bytes, bytearray))
+        if raw and batch_size is not None:
+            return self.load_stream(uid, JsonListStream(js), batch_size)
+        if raw:
             try:
                 js = json.loads(js)
             except Exception:
-                _dbLogger.error(f"'{js}' is not a legal json string.")
-                raise ValueError(f"'{js}' is not a legal json string.")
+                _dbLogger.error(f"{js[:64]!r}... ({len(js)} in total) is not a legal json string.")
+                raise ValueError(f"{js[:64]!r}... is not a legal json string.")
         if isinstance(js, dict):
             js = js.get("data", {}).get("list", [])
 
-        _dbLogger.info(f"load json from '{tp}': {js}")
-        cnt_ga = err_ga = 0
-
-        for line in js:
-            ts = datetime.datetime.fromtimestamp(line["ts"]).strftime("%Y-%m-%d %H:%M:%S")
-            pool = line["pool"]
-            start = (len(line['chars']) - 1) // 9  # 0/1
-            for j, char in enumerate(line['chars']):
-                name = char['name']
-                rarity = char['rarity']
-                isNew = char['isNew']
-                try:
-                    self.execute("insert into operators(name, rarity) values (?,?)", (name, rarity), debug=True)
-                except Exception as e:
-                    _dbLogger.debug(f"meet {e.__class__} when load json[name={name}, rarity={rarity}]: {str(e)} ")
-
-                try:
-                    self.execute("insert into gacha(uid,ts,pool,sequence, operator, isNew) values (?,?,?,?,?,?)",
-                                 (uid, ts, pool, start + j, name, isNew), debug=True)
-                except Exception as e:
-                    _dbLogger.debug(f"meet {e.__class__} when load json[name={name}, rarity={rarity}]: {str(e)} ")
-                    err_ga += 1
-                finally:
-                    cnt_ga += 1
+        _dbLogger.info(f"load {len(js)} gacha records.")
+        start = time.perf_counter() if metrics.enabled else None
+        cnt_ga, err_ga = self.insert_many(uid, parse_gacha_list(js))
+        if start is not None:
+            metrics.observe("ingest", "loads", time.perf_counter() - start)
         _dbLogger.info(f"insert {cnt_ga} gacha line({err_ga} fail).")
-        self.commit()
         return cnt_ga, err_ga
 
-    def load(self, uid: int, fp):
+    def load(self, uid: int, fp, batch_size: int = None):
+        """
+        :param uid:
+        :param fp:
+        :param batch_size: 不为None时增量解析,内存占用只与batch_size有关
+        :return:
+        """
+        if batch_size is not None:
+            return self.load_stream(uid, JsonListStream(fp), batch_size)
         return self.loads(uid=uid, js=json.load(fp))
 
-    def dump(self, uid: int, file: str, *, file_type: str = None, separators: tuple = None, indent: int = 4):
+    def load_stream(self, uid: int, entries, batch_size: int = 10000):
         """
-        CSV使用utf-8-sig编码,JSON使用utf-8编码
+        逐条读取寻访记录(官方接口data.list中的元素),每batch_size条写入并提交一次
+        返回tuple[总条数, 错误条数]
+        :param uid:
+        :param entries:
+        :param batch_size:
+        :return:
+        """
+        cnt_ga = err_ga = 0
+        rows = []
+        for entry in entries:
+            rows.extend(parse_gacha_list((entry,)))
+            if len(rows) >= batch_size:
+                cnt, err = self.insert_many(uid, rows)
+                cnt_ga, err_ga = cnt_ga + cnt, err_ga + err
+                rows = []
+        cnt, err = self.insert_many(uid, rows)
+        cnt_ga, err_ga = cnt_ga + cnt, err_ga + err
+        _dbLogger.info(f"insert {cnt_ga} gacha line({err_ga} fail) from stream.")
+        return cnt_ga, err_ga
+
+    @staticmethod
+    def expand_files(paths: str or list or tuple):
+        """
+        将目录、通配符或文件路径展开为导出文件列表(.json/.csv)
+        :param paths:
+        :return:
+        """
+        if isinstance(paths, str):
+            paths = (paths,)
+        files = []
+        for path in paths:
+            if os.path.isdir(path):
+                candidates = sorted(glob.glob(os.path.join(path, "*.json")) + glob.glob(os.path.join(path, "*.csv")))
+            elif os.path.isfile(path):
+                candidates = [path]
+            else:
+                candidates = sorted(glob.glob(path, recursive=True))
+            files.extend(f for f in candidates if os.path.splitext(f)[-1].lower() in (".json", ".csv"))
+        return files
+
+    def import_files(self, paths: str or list or tuple, uid: int = None, processes: int = None):
+        """
+        批量导入dump导出的JSON/CSV文件,解析在进程池中进行,写入由当前连接统一完成
+        uid为None时从文件名开头的数字中获取uid(如'123456.csv'、'123456_2023.json')
+        返回 tuple[list[tuple[文件, uid, 总条数, 错误条数, 错误信息]], 耗时(秒)]
+        :param paths: 文件、目录或通配符
+        :param uid:
+        :param processes: 进程数,为1时不使用进程池
+        :return:
+        """
+        files = self.expand_files(paths)
+        _dbLogger.info(f"import {len(files)} files.")
+        start = time.perf_counter()
+        results = []
+
+        def write(file, rows, error):
+            file_uid = uid
+            if file_uid is None and error is None:
+                match = re.match(r"\d+", os.path.basename(file))
+                if match is None:
+                    error = f"cannot get uid from file name '{os.path.basename(file)}'."
+                else:
+                    file_uid = int(match.group())
+            if error is not None:
+                _dbLogger.error(f"import file '{file}' failed: {error}")
+                results.append((file, file_uid, 0, 0, error))
+                return
+            try:
+                cnt, err = self.insert_many(file_uid, rows)
+            except sqlite3.Error as e:  # 如CSV中一次寻访超过11条违反sequence约束,只跳过该文件
+                error = f"{e.__class__.__name__}: {e}"
+                _dbLogger.error(f"import file '{file}' failed: {error}")
+                results.append((file, file_uid, 0, 0, error))
+                return
+            _dbLogger.info(f"import file '{file}': {cnt} lines({err} fail).")
+            results.append((file, file_uid, cnt, err, None))
+
+        if processes == 1 or len(files) <= 1:
+            for file in files:
+                write(*parse_export_file(file))
+        else:
+            with ProcessPoolExecutor(processes) as executor:
+                for result in executor.map(parse_export_file, files, chunksize=4):
+                    write(*result)
+        return results, time.perf_counter() - start
+
+    def dumps(self, uid: int, file_type: str = "csv", *, separators: tuple = None, indent: int = 4) -> str:
+        """
+        返回导出文件的文本内容,格式同dump
         :param uid:
-        :param file:
         :param file_type:
         :param separators:
         :param indent:
         :return:
         """
-        file = os.path.abspath(file)
-        file_path = os.path.split(file)[0]
-        if file_path and not os.path.exists(file_path):
-            os.makedirs(file_path)
-        if file_type is None:
-            file_type = os.path.splitext(file)[-1][1:]
         file_type = file_type.lower()
-
         if file_type == "csv":
-            with open(file, "w", encoding="utf-8-sig") as f:
-                f.write("时间,卡池,序号,干员,稀有度\n")
-                for line in self.get_total(uid):
-                    f.write(",".join(list(map(str, line))) + "\n")
+            return self.CSV_HEADER + "".join(",".join(map(str, line)) + "\n" for line in self.get_total(uid))
         elif file_type == "json":
             data = self.execute("SELECT ts, sequence, pool, name, rarity, isNew FROM gacha_view WHERE uid=? \
 ORDER BY ts ASC, sequence ASC", (uid,)).fetchall()
@@ -478,18 +1382,268 @@ ORDER BY ts ASC, sequence ASC", (uid,)).fetchall()
 
             js = {"code": 0, "data": {"list": new_data, "pagination": {"current": 1, "total": total}},
                   "msg": "This file is made by Rhodes Island Terminal, for reference only."}
-            with open(file, "w", encoding="utf-8") as f:
-                json.dump(js, f, separators=separators, indent=indent)
+            return json.dumps(js, separators=separators, indent=indent)
         else:
             _dbLogger.error(f"file type must be 'csv' or 'json', not '{file_type}'")
             raise ValueError(f"file type must be 'csv' or 'json', not '{file_type}'")
-        with open(file, "rb") as f:
-            md5 = hashlib.md5(f.read()).hexdigest()
-            f.seek(0, 0)
-            sha256 = hashlib.sha256(f.read()).hexdigest()
+
+    def dumpb(self, uids: list or tuple = None, file_type: str = "ritc") -> bytes:
+        """
+        返回列式导出文件(ritc或parquet)的内容,见dump_columnar
+        :param uids: 为None时导出全部账号
+        :param file_type:
+        :return:
+        """
+        uids = self.get_uids() if uids is None else uids
+        return dump_columnar((self.load_history(uid) for uid in uids), file_type)
+
+    def dump(self, uid: int, file: str, *, file_type: str = None, separators: tuple = None, indent: int = 4,
+             incremental: bool = False):
+        """
+        CSV使用utf-8-sig编码,JSON使用utf-8编码,ritc/parquet为列式二进制格式(可用read_columnar读取)
+        返回 tuple[md5, sha256]
+        :param uid: 列式格式下为None时导出全部账号
+        :param file:
+        :param file_type:
+        :param separators:
+        :param indent:
+        :param incremental: 仅CSV,只追加上次导出之后的新记录,见dump_append
+        :return:
+        """
+        file = os.path.abspath(file)
+        file_path = os.path.split(file)[0]
+        if file_path and not os.path.exists(file_path):
+            os.makedirs(file_path)
+        if file_type is None:
+            file_type = os.path.splitext(file)[-1][1:]
+        file_type = file_type.lower()
+
+        if uid is None and file_type not in COLUMNAR_TYPES:
+            _dbLogger.error(f"only {COLUMNAR_TYPES} files can hold all uids, not '{file_type}'")
+            raise ValueError(f"only {COLUMNAR_TYPES} files can hold all uids, not '{file_type}'")
+        if incremental:
+            if file_type != "csv":
+                _dbLogger.error(f"incremental dump only supports csv, not '{file_type}'")
+                raise ValueError(f"incremental dump only supports csv, not '{file_type}'")
+            return self.dump_append(uid, file)
+        if file_type in COLUMNAR_TYPES:
+            data = self.dumpb(None if uid is None else (uid,), file_type)
+            with open(file, "wb") as f:
+                f.write(data)
+        else:
+            text = self.dumps(uid, file_type, separators=separators, indent=indent)
+            with open(file, "w", encoding="utf-8-sig" if file_type == "csv" else "utf-8") as f:
+                f.write(text)
+        md5, sha256 = file_digests(file)
         _dbLogger.info(f"dump file '{file}' as {file_type} (md5:{md5}, sha256:{sha256}).")
         return md5, sha256
 
+    def dump_append(self, uid: int, file: str):
+        """
+        增量导出CSV,内容与dump完全相同
+        上次导出的位置和各卡池序号保存在file+EXPORT_STATE_SUFFIX中,之后只查询、格式化并追加新记录
+        校验码用hashlib重新计算整个文件,耗时与文件大小成正比:导出文件通常只有几MiB,比用纯python从保存的中间状态继续计算新增部分更快
+        状态文件缺失、导出文件被修改过(大小或修改时间不一致)或有早于上次导出位置的新记录时重新完整导出
+        返回 tuple[md5, sha256]
+        :param uid:
+        :param file:
+        :return:
+        """
+        file = os.path.abspath(file)
+        state_file = file + self.EXPORT_STATE_SUFFIX
+        state = None
+        try:
+            with open(state_file, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            stat = os.stat(file)
+            if state["uid"] != uid or state["size"] != stat.st_size or state["mtime"] != stat.st_mtime_ns:
+                _dbLogger.info(f"'{file}' changed since last dump, rewrite it.")
+                state = None
+        except FileNotFoundError:
+            state = None
+        except (ValueError, KeyError, TypeError) as e:
+            _dbLogger.warning(f"broken dump state '{state_file}': {e}")
+            state = None
+
+        rows = self.get_rows(uid, None if state is None else state["last"])
+        if state is not None and state["rows"] + len(rows) != self.get_version(uid):
+            _dbLogger.info(f"user(uid={uid}) got records older than last dump of '{file}', rewrite it.")
+            state = None
+            rows = self.get_rows(uid)
+        if state is None:
+            state = {"uid": uid, "rows": 0, "last": None, "pools": {}}
+            mode, data = "wb", self.CSV_HEADER.encode("utf-8-sig")
+        else:
+            mode, data = "ab", b""
+        pools = state["pools"]
+        lines = []
+        for ts, seq, pool, operator, rarity, _ in rows:
+            pools[pool] = pools.get(pool, 0) + 1
+            lines.append(f"{ts},{pool},{pools[pool]},{operator},{rarity + 1}星\n")
+        data += "".join(lines).encode("utf-8")
+
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        with open(file, mode) as f:
+            f.write(data)
+        stat = os.stat(file)
+        if rows:
+            state["last"] = rows[-1][:2]
+        state.update(rows=state["rows"] + len(rows), size=stat.st_size, mtime=stat.st_mtime_ns)
+        with open(state_file + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(state_file + ".tmp", state_file)
+        md5, sha256 = file_digests(file)
+        _dbLogger.info(f"dump file '{file}' as csv, {len(rows)} lines appended ({mode}) (md5:{md5}, sha256:{sha256}).")
+        return md5, sha256
+
+
+class MetaIndex:
+    """
+    干员与卡池元数据的内存索引,由MetaModel.index()一次性构建,查询时不再访问数据库
+    """
+
+    def __init__(self, version: str = None, operators: dict = None, tags: dict = None, banners: dict = None):
+        """
+        :param version: 元数据版本号
+        :param operators: dict[干员:tuple[星级-1, 职业, 是否可公开招募]]
+        :param tags: dict[干员:frozenset[公招标签]]
+        :param banners: dict[卡池:list[tuple[开始时间, 结束时间, tuple[UP干员]]]],按开始时间升序
+        """
+        self.version = version
+        self.operators = operators or {}
+        self.tags = tags or {}
+        self.banners = banners or {}
+        self._starts = {pool: [banner[0] for banner in items] for pool, items in self.banners.items()}
+
+    def __len__(self):
+        return len(self.operators)
+
+    def profession(self, name: str):
+        info = self.operators.get(name)
+        return None if info is None else info[1]
+
+    def banner(self, pool: str, ts: str):
+        """
+        返回 ts时开放的同名卡池tuple[开始时间, 结束时间, tuple[UP干员]],没有记录时返回None
+        常驻等同名卡池按开始时间二分查找
+        :param pool:
+        :param ts: 格式同寻访记录的时间('%Y-%m-%d %H:%M:%S')
+        :return:
+        """
+        starts = self._starts.get(pool)
+        if not starts:
+            return None
+        i = bisect.bisect_right(starts, ts) - 1
+        if i < 0:
+            return None
+        banner = self.banners[pool][i]
+        return banner if banner[1] is None or ts <= banner[1] else None
+
+
+class MetaModel(SqlConnection):
+    """
+    干员与卡池的元数据(职业、公招标签、卡池开放时间与UP干员),由metadata.py从JSON快照导入,整体替换并记录版本号
+    """
+    DATABASE = "./data/meta.db"
+    DB_INIT = (
+        "CREATE TABLE meta(key TEXT NOT NULL PRIMARY KEY, value TEXT)",
+
+        "CREATE TABLE operator_info(name TEXT NOT NULL PRIMARY KEY, rarity INTEGER NOT NULL CHECK(rarity BETWEEN 0 \
+AND 5), profession TEXT, recruitable BOOL NOT NULL DEFAULT 0)",
+
+        "CREATE TABLE operator_tags(name TEXT NOT NULL, tag TEXT NOT NULL, PRIMARY KEY(name, tag))",
+
+        "CREATE INDEX operator_tags_tag ON operator_tags(tag)",
+
+        "CREATE TABLE banners(pool TEXT NOT NULL, start DATETIME NOT NULL, end DATETIME, PRIMARY KEY(pool, start))",
+
+        "CREATE TABLE banner_rate_up(pool TEXT NOT NULL, start DATETIME NOT NULL, operator TEXT NOT NULL, PRIMARY \
+KEY(pool, start, operator))",
+
+        "CREATE INDEX banner_rate_up_operator ON banner_rate_up(operator)",
+    )
+
+    def __init__(self, database: str = None):
+        super().__init__(self.DATABASE if database is None else database, self.DB_INIT)
+        self._index = None
+
+    def get_meta(self):
+        """
+        返回 dict[版本号、来源、同步时间等]
+        :return:
+        """
+        return dict(self.execute("SELECT key, value FROM meta").fetchall())
+
+    def get_version(self):
+        row = self.execute("SELECT value FROM meta WHERE key='version'").fetchone()
+        return None if row is None else row[0]
+
+    def get_counts(self):
+        """
+        返回 tuple[干员数, 卡池数]
+        :return:
+        """
+        return (self.execute("SELECT COUNT(*) FROM operator_info").fetchone()[0],
+                self.execute("SELECT COUNT(*) FROM banners").fetchone()[0])
+
+    def replace(self, version: str, operators, banners, source: str = ""):
+        """
+        在一个事务中用新数据替换全部元数据
+        :param version:
+        :param operators: 可迭代的tuple[干员, 星级-1, 职业, 是否可公开招募, tuple[标签]]
+        :param banners: 可迭代的tuple[卡池, 开始时间, 结束时间, tuple[UP干员]]
+        :param source: 数据来源(文件路径或URL)
+        :return:
+        """
+        operators, banners = list(operators), list(banners)
+        with self.lock:
+            try:
+                for table in ("operator_info", "operator_tags", "banners", "banner_rate_up", "meta"):
+                    self.execute(f"DELETE FROM {table}")
+                self.executemany("INSERT INTO operator_info(name, rarity, profession, recruitable) VALUES (?,?,?,?)",
+                                 [op[:4] for op in operators])
+                self.executemany("INSERT INTO operator_tags(name, tag) VALUES (?,?)",
+                                 [(op[0], tag) for op in operators for tag in set(op[4])])
+                self.executemany("INSERT INTO banners(pool, start, end) VALUES (?,?,?)", [b[:3] for b in banners])
+                self.executemany("INSERT INTO banner_rate_up(pool, start, operator) VALUES (?,?,?)",
+                                 [(b[0], b[1], name) for b in banners for name in set(b[3])])
+                self.executemany("INSERT INTO meta(key, value) VALUES (?,?)",
+                                 (("version", str(version)), ("source", source),
+                                  ("synced_at", time.strftime("%Y-%m-%d %H:%M:%S"))))
+            except Exception as e:
+                _dbLogger.error(f"meet {e.__class__.__name__} when replace metadata: {e}")
+                self.rollback()
+                raise e
+            self.commit()
+            self._index = None
+        _dbLogger.info(f"replace metadata with version '{version}': {len(operators)} operators, "
+                       f"{len(banners)} banners.")
+
+    def index(self) -> MetaIndex:
+        """
+        返回 MetaIndex,版本号不变时复用已构建的索引(每次调用只查询一次版本号)
+        :return:
+        """
+        version = self.get_version()
+        if self._index is not None and self._index.version == version:
+            return self._index
+        tags = {}
+        for name, tag in self.execute("SELECT name, tag FROM operator_tags ORDER BY name, tag"):
+            tags.setdefault(name, set()).add(tag)
+        rate_up = {}
+        for pool, start, name in self.execute("SELECT pool, start, operator FROM banner_rate_up ORDER BY operator"):
+            rate_up.setdefault((pool, start), []).append(name)
+        banners = {}
+        for pool, start, end in self.execute("SELECT pool, start, end FROM banners ORDER BY pool, start"):
+            banners.setdefault(pool, []).append((start, end, tuple(rate_up.get((pool, start), ()))))
+        self._index = MetaIndex(
+            version,
+            {name: (rarity, profession, bool(recruitable)) for name, rarity, profession, recruitable in
+             self.execute("SELECT name, rarity, profession, recruitable FROM operator_info")},
+            {name: frozenset(items) for name, items in tags.items()},
+            banners)
+        return self._index
+
 
 if __name__ == "__main__":
     pass
@@ -1,7 +1,31 @@
 from terminal import Terminal, LOG_FILE
+import argparse
 import logging
+import sys
 
-logging.basicConfig(filename=LOG_FILE, filemode="a", encoding="utf-8", datefmt="%y.%m.%d %H:%M:%S",
-                    level=logging.DEBUG,
-                    format="%(lineno)d|%(asctime)s|%(levelname)s|%(name)s-%(threadName)s: %(message)s")
-Terminal().menu_index()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rhodes Island Terminal",
+                                     epilog="without script or -c, start the interactive terminal")
+    parser.add_argument("script", nargs="?", help="run commands from a file (one per line, '-' for stdin)")
+    parser.add_argument("-c", dest="commands", help="run commands separated by ';'")
+    parser.add_argument("-e", "--exit-on-error", action="store_true", help="stop at the first failed command")
+    args = parser.parse_args(argv)
+    batch = args.script is not None or args.commands is not None
+    logging.basicConfig(filename=LOG_FILE, filemode="a", encoding="utf-8", datefmt="%y.%m.%d %H:%M:%S",
+                        level=logging.INFO if batch else logging.DEBUG,
+                        format="%(lineno)d|%(asctime)s|%(levelname)s|%(name)s-%(threadName)s: %(message)s")
+    if not batch:
+        Terminal().menu_index()
+    if args.commands is not None:
+        commands = args.commands.split(";")
+    elif args.script == "-":
+        commands = sys.stdin.read().splitlines()
+    else:
+        with open(args.script, "r", encoding="utf-8") as f:
+            commands = f.read().splitlines()
+    return Terminal().run_batch(commands, exit_on_error=args.exit_on_error)
+
+
+if __name__ == "__main__":  # 导入文件时子进程会重新导入本模块
+    sys.exit(main())
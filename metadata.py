@@ -0,0 +1,160 @@
+import argparse
+import datetime
+import json
+import logging
+import os
+import re
+
+import requests
+
+from database import MetaModel
+
+_metaLogger = logging.getLogger("MetadataLogger")
+
+
+class FileFetcher:
+    """
+    从本地JSON文件读取元数据快照
+    """
+
+    def __init__(self, path: str):
+        self.source = os.path.abspath(path)
+
+    def fetch(self) -> dict:
+        with open(self.source, "r", encoding="utf-8-sig") as f:
+            return json.load(f)
+
+
+class HttpFetcher:
+    """
+    通过HTTP(S)获取元数据快照,可指向本地搭建的替代服务器
+    """
+
+    def __init__(self, url: str, timeout: float = 10):
+        self.source = url
+        self.timeout = timeout
+
+    def fetch(self) -> dict:
+        resp = requests.get(self.source, timeout=self.timeout)
+        resp.raise_for_status()
+        return json.loads(resp.content)
+
+
+# 按来源的scheme选择获取方式,新的来源(如其他数据站)在此注册,fetcher只需实现fetch() -> dict和source属性
+FETCHERS = {"http": HttpFetcher, "https": HttpFetcher, "file": FileFetcher}
+
+
+def make_fetcher(source: str):
+    """
+    返回 source对应的fetcher,没有scheme时视为本地文件
+    :param source: 文件路径或URL(如'http://127.0.0.1:8000/meta.json')
+    :return:
+    """
+    match = re.match(r"^([a-zA-Z][a-zA-Z0-9+.-]+)://", source)
+    if match is None:
+        return FileFetcher(source)
+    scheme = match.group(1).lower()
+    if scheme not in FETCHERS:
+        _metaLogger.error(f"no fetcher for '{scheme}', use one of {tuple(FETCHERS)}.")
+        raise ValueError(f"no fetcher for '{scheme}', use one of {tuple(FETCHERS)}.")
+    return FETCHERS[scheme](source[len("file://"):] if scheme == "file" else source)
+
+
+def _time(value, field: str):
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return datetime.datetime.fromtimestamp(value).strftime("%Y-%m-%d %H:%M:%S")
+    try:
+        return datetime.datetime.strptime(str(value), "%Y-%m-%d %H:%M:%S").strftime("%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        raise ValueError(f"{field} must be a timestamp or '%Y-%m-%d %H:%M:%S', not '{value}'.")
+
+
+def parse_snapshot(data: dict):
+    """
+    校验元数据快照并转换为MetaModel.replace的参数,快照格式:
+    {
+        "version": "2023-05-01",
+        "operators": [{"name": "能天使", "stars": 6, "profession": "狙击", "recruitable": false, "tags": ["输出"]}],
+        "banners": [{"pool": "常驻标准寻访", "start": "2020-09-01 04:00:00", "end": "2020-09-15 03:59:59",
+                     "rate_up": ["能天使"]}]
+    }
+    start/end也可以是时间戳,end为null表示尚未结束;profession、recruitable、tags、rate_up可省略
+    返回 tuple[版本号, list[干员], list[卡池]]
+    :param data:
+    :return:
+    """
+    if not isinstance(data, dict) or "version" not in data:
+        raise ValueError("metadata snapshot must be an object with 'version'.")
+    operators = {}
+    for i, op in enumerate(data.get("operators", [])):
+        try:
+            name, stars = str(op["name"]), int(op["stars"])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f"operators[{i}] needs 'name' and 'stars'.")
+        if not 1 <= stars <= 6:
+            raise ValueError(f"operators[{i}] '{name}': stars must be 1-6, not {stars}.")
+        operators[name] = (name, stars - 1, op.get("profession"), bool(op.get("recruitable", False)),
+                           tuple(str(tag) for tag in op.get("tags", ())))
+    banners = {}
+    for i, banner in enumerate(data.get("banners", [])):
+        try:
+            pool, start = str(banner["pool"]), _time(banner["start"], f"banners[{i}].start")
+        except (KeyError, TypeError):
+            raise ValueError(f"banners[{i}] needs 'pool' and 'start'.")
+        if start is None:
+            raise ValueError(f"banners[{i}].start must not be null.")
+        end = _time(banner.get("end"), f"banners[{i}].end")
+        if end is not None and end < start:
+            raise ValueError(f"banners[{i}] '{pool}' ends before it starts.")
+        banners[(pool, start)] = (pool, start, end, tuple(str(name) for name in banner.get("rate_up", ())))
+    return str(data["version"]), list(operators.values()), list(banners.values())
+
+
+def sync(model: MetaModel, source: str, force: bool = False):
+    """
+    从source获取元数据快照,版本号与本地不同(或force)时整体替换
+    返回 tuple[版本号, 是否更新]
+    :param model:
+    :param source: 文件路径或URL,见make_fetcher
+    :param force:
+    :return:
+    """
+    fetcher = make_fetcher(source)
+    try:
+        version, operators, banners = parse_snapshot(fetcher.fetch())
+    except ValueError as e:
+        _metaLogger.error(f"bad metadata snapshot from '{fetcher.source}': {e}")
+        raise e
+    if not force and version == model.get_version():
+        _metaLogger.info(f"metadata is already version '{version}'.")
+        return version, False
+    model.replace(version, operators, banners, source=fetcher.source)
+    return version, True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rhodes Island Terminal operator and banner metadata")
+    sub = parser.add_subparsers(dest="command", required=True)
+    do_sync = sub.add_parser("sync", help="import a metadata snapshot from a JSON file or URL")
+    do_sync.add_argument("source", help="file path, file:// or http(s):// URL")
+    do_sync.add_argument("-f", "--force", action="store_true", help="import even if the version is unchanged")
+    sub.add_parser("info", help="show the local metadata version")
+    args = parser.parse_args(argv)
+
+    model = MetaModel()
+    if args.command == "sync":
+        version, updated = sync(model, args.source, args.force)
+        operators, banners = model.get_counts()
+        print(f"{'imported' if updated else 'already up to date'}: version {version}, "
+              f"{operators} operators, {banners} banners")
+    elif args.command == "info":
+        meta = model.get_meta()
+        operators, banners = model.get_counts()
+        print(f"version {meta.get('version', '-')} from '{meta.get('source', '-')}' at {meta.get('synced_at', '-')}, "
+              f"{operators} operators, {banners} banners")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+
+_metricsLogger = logging.getLogger("MetricsLogger")
+
+# 默认关闭,调用处先判断enabled,关闭时只多一次属性读取
+enabled = os.environ.get("RIT_STATS", "").strip().lower() in ("1", "on", "true")
+
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)  # 秒
+
+
+class Histogram:
+    __slots__ = ("count", "total", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        self.buckets[bisect.bisect_left(BUCKETS, value)] += 1
+
+    def quantile(self, q: float):
+        """
+        返回分位数所在桶的上界,超过最大的桶时返回最大值
+        :param q:
+        :return:
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, cnt in zip(BUCKETS, self.buckets):
+            seen += cnt
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {"count": self.count, "total": self.total, "mean": self.total / self.count if self.count else 0.0,
+                "max": self.max, "p50": self.quantile(0.5), "p95": self.quantile(0.95),
+                "buckets": dict(zip([str(b) for b in BUCKETS] + ["+Inf"], self.buckets))}
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    def incr(self, kind: str, key: str, n: int = 1):
+        with self._lock:
+            group = self.counters.setdefault(kind, {})
+            group[key] = group.get(key, 0) + n
+
+    def observe(self, kind: str, key: str, seconds: float):
+        with self._lock:
+            group = self.histograms.setdefault(kind, {})
+            hist = group.get(key)
+            if hist is None:
+                hist = group[key] = Histogram()
+            hist.observe(seconds)
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.started = time.time()
+
+    def snapshot(self):
+        with self._lock:
+            return {"enabled": enabled, "started": self.started, "now": time.time(),
+                    "counters": {kind: dict(group) for kind, group in self.counters.items()},
+                    "histograms": {kind: {key: hist.to_dict() for key, hist in group.items()}
+                                   for kind, group in self.histograms.items()}}
+
+    def dump(self, file: str):
+        file_path = os.path.split(file)[0]
+        if file_path and not os.path.exists(file_path):
+            os.makedirs(file_path)
+        with open(file, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, ensure_ascii=False, indent=4)
+        _metricsLogger.info(f"dump metrics to '{file}'.")
+        return file
+
+
+REGISTRY = Registry()
+_trace = None  # 记录中的调用列表
+_trace_only = False  # 统计未开启时只记录调用,不计入REGISTRY
+
+
+def enable(flag: bool = True):
+    global enabled
+    enabled = flag
+    _metricsLogger.info(f"metrics {'on' if flag else 'off'}.")
+
+
+def start_trace():
+    """
+    开始逐条记录SQL语句和HTTP请求,统计未开启时临时开启且不计入统计
+    :return:
+    """
+    global enabled, _trace, _trace_only
+    _trace = []
+    _trace_only = not enabled
+    enabled = True
+
+
+def stop_trace():
+    """
+    返回 list[tuple[时间戳, 类别, 语句或接口, 耗时(秒)]]
+    :return:
+    """
+    global enabled, _trace, _trace_only
+    trace, _trace = _trace or [], None
+    if _trace_only:
+        enabled = False
+    _trace_only = False
+    return trace
+
+
+def incr(kind: str, key: str, n: int = 1):
+    if not _trace_only:
+        REGISTRY.incr(kind, key, n)
+
+
+def observe(kind: str, key: str, seconds: float):
+    if _trace is not None:
+        _trace.append((time.time(), kind, key, seconds))
+    if not _trace_only:
+        REGISTRY.observe(kind, key, seconds)
+
+
+def snapshot():
+    return REGISTRY.snapshot()
+
+
+if __name__ == "__main__":
+    pass
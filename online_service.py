@@ -1,9 +1,22 @@
+import copy
+import hashlib
+import json as _json
 import logging
 import re
+import threading
+import time
+from collections import OrderedDict
 
 import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
 
 _osvLoger = logging.getLogger("OnlineService_Logger")
+# 所有OnlineService共用的连接池,各会话只保存自己的cookies
+ADAPTER = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+# 日志中最多记录响应的前LOG_BODY_LIMIT字节,寻访记录等大响应不整体写入日志
+LOG_BODY_LIMIT = 256
 
 
 class CaptchaError(Exception):
@@ -22,6 +35,65 @@ class ParamsError(Exception):
     pass
 
 
+class ResponseCache:
+    """
+    进程内的个人信息响应缓存,只保存在内存中,不写入磁盘,不保存响应设置的cookies
+    键中的token只保存其哈希值;过期、请求失败或登出(evict)时删除
+    """
+    MAX_ENTRIES = 1024
+
+    def __init__(self, max_entries: int = MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # tuple[接口, 键哈希] -> tuple[响应, 过期时间, token哈希]
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        return hashlib.sha256("\x00".join(map(str, parts)).encode("utf-8")).hexdigest()
+
+    def get(self, web: str, key: tuple):
+        """
+        返回 未过期的响应(副本) 或 None
+        :param web:
+        :param key: 第一个元素为token,其余为区分响应的参数
+        :return:
+        """
+        entry_key = (web, self.make_key(*key))
+        with self.lock:
+            entry = self.entries.get(entry_key)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                del self.entries[entry_key]
+                return None
+            self.entries.move_to_end(entry_key)
+            return copy.deepcopy(entry[0])  # 调用者会修改返回的dict
+
+    def set(self, web: str, key: tuple, body, ttl: float):
+        entry_key = (web, self.make_key(*key))
+        with self.lock:
+            self.entries[entry_key] = (copy.deepcopy(body), time.monotonic() + ttl, self.make_key(key[0]))
+            self.entries.move_to_end(entry_key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def evict(self, token: str):
+        """
+        删除token的全部响应
+        :param token:
+        :return:
+        """
+        owner = self.make_key(token)
+        with self.lock:
+            for entry_key in [k for k, v in self.entries.items() if v[2] == owner]:
+                del self.entries[entry_key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        _osvLoger.info("clear response cache.")
+
+
 class OnlineService:
     HEADERS = {'accept': 'application/json,text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,\
 */*;q=0.8,application/signed-exchange;v=b3;q=0.9',
@@ -47,11 +119,37 @@ Chrome/105.0.0.0 Safari/537.36 Edg/105.0.1343.50'}
         "ak-b": "https://web-api.hypergryph.com/account/info/ak-b",
     }
 
-    def __init__(self, headers: dict = None):
+    # 可以缓存的接口及缓存时间(秒);只缓存按token查询的个人信息,登录与token、cookies互换的响应含有凭证并会设置
+    # cookies,一律不缓存;个人信息也用于判断登录是否有效,因此缓存时间很短
+    CACHE_TTL = {"post_basic": 300, "get_basic": 300}
+
+    def __init__(self, headers: dict = None, cache=None, adapter: HTTPAdapter = None):
+        """
+        :param headers:
+        :param cache: ResponseCache,可在多个会话间共用,为None时不缓存
+        :param adapter: 连接池,默认为共用的ADAPTER
+        """
         _osvLoger.info("initialize online service.")
         self.session = requests.session()
+        adapter = ADAPTER if adapter is None else adapter
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.cache = cache
         # self.session.headers = self.HEADERS if headers is None else headers
 
+    def clear_cache(self, token: str = None):
+        """
+        删除token的缓存响应,token为None时清空全部缓存
+        :param token:
+        :return:
+        """
+        if self.cache is None:
+            return
+        if token is None:
+            self.cache.clear()
+        else:
+            self.cache.evict(token)
+
     def clear_cookies(self):
         _osvLoger.debug("clear cookies.")
         self.session.cookies.clear()
@@ -67,41 +165,74 @@ Chrome/105.0.0.0 Safari/537.36 Edg/105.0.1343.50'}
 
     def get_json(self, method: str, web: str, data: dict or str = None, json: dict = None, params: dict = None,
                  timeout: int or float = 5, exc_info: bool = True, stack_info: bool = True,
-                 return0: bool = False, to_json: bool = True):
+                 return0: bool = False, to_json: bool = True, cache_key: tuple = None):
+        """
+        :param cache_key: tuple[token, 区分响应的参数...],不为None且web在CACHE_TTL中时在内存中缓存成功的JSON响应,
+                          未过期时直接返回;请求失败时删除该token的全部缓存
+        """
         method = method.strip().upper()
         url = self.URLS.get(web, web)
         if not re.findall(r"https?://.+\..+", url):
             _osvLoger.error(f"'{url}' is not a website.")
             raise ValueError(f"'{url}' is not a website.")
 
+        cached = cache_key is not None and self.cache is not None and to_json and web in self.CACHE_TTL
+        if cached:
+            hit = self.cache.get(web, cache_key)
+            if metrics.enabled:
+                metrics.incr("http_cache", "miss" if hit is None else "hit")
+            if hit is not None:
+                _osvLoger.debug(f"{method} website '{url}' hit cache.")
+                return hit
+
+        start = time.perf_counter() if metrics.enabled else None
         try:
             req = self.session.request(method, url, params=params, data=data, json=json, timeout=timeout)
         except Exception as e:
             _osvLoger.error(f"meet error when visit website '{url}': {e.__class__.__name__}: {str(e)}",
                             exc_info=exc_info, stack_info=stack_info)
+            if cached:
+                self.cache.evict(cache_key[0])
+            if start is not None:
+                metrics.incr("http_error", f"{method} {web}")
             if return0:
                 return 0
             else:
                 raise e
+        if start is not None:
+            metrics.observe("http", f"{method} {web}", time.perf_counter() - start)
+            metrics.incr("http_bytes", f"{method} {web}", len(req.content))
         http_code = req.status_code
-        _osvLoger.debug(f"{method} website '{url}', respond {http_code} and contents is '{req.content}'.")
+        if _osvLoger.isEnabledFor(logging.DEBUG):
+            _osvLoger.debug(f"{method} website '{url}', respond {http_code} with {len(req.content)} bytes: "
+                            f"'{req.content[:LOG_BODY_LIMIT]}'.")
         if to_json:
             try:
                 req = req.json()
             except Exception as e:
                 _osvLoger.error(f"meet error when decode json '{req}': {e.__class__.__name__}: {str(e)}",
                                 exc_info=exc_info, stack_info=stack_info)
+                if cached:
+                    self.cache.evict(cache_key[0])
                 if return0:
                     return 0
                 else:
                     raise e
         if to_json and req.get("statusCode") is not None or http_code >= 300 or http_code < 200:
+            body = req if to_json else {}  # 不是JSON时不记录响应内容
             _osvLoger.error("request's http code={}; statusCode:{}; request's message: '{}'".
-                            format(http_code, req.get('statusCode'), req.get('message', '')), stack_info=stack_info)
+                            format(http_code, body.get('statusCode'), body.get('message', '')), stack_info=stack_info)
+            if cached:
+                self.cache.evict(cache_key[0])
             if return0:
                 return 0
             else:
                 raise ParamsError(f"bad params with <Respond [{http_code}]>: '{req}'")
+        if cached:
+            if req.get("code", req.get("status", 0)) in (0, "0"):
+                self.cache.set(web, cache_key, req, self.CACHE_TTL[web])
+            else:  # token已失效等,之后的请求不应再使用该token的缓存
+                self.cache.evict(cache_key[0])
         return req
 
     def login_phone_password(self, phone: str, password: str) -> str:
@@ -170,7 +301,8 @@ req.message: " + req.get("msg", "") + req.get("message", ""))
             _osvLoger.error(f"get_basic: bad token {token}.")
             raise ValueError(f"bad token {token}.")
         req = self.get_json("post", "post_basic", data={"appId": 1, "channelMasterId": channel_id, "channelToken":
-            "{\"token\":\"%s\"}" % token} if channel_id == 1 else {"token": token}, return0=True)
+            "{\"token\":\"%s\"}" % token} if channel_id == 1 else {"token": token}, return0=True,
+                            cache_key=(token, channel_id))
         if req == 0 or req.get("code") != 0:
             return dict()
         result = req.get('data', {})
@@ -179,7 +311,7 @@ req.message: " + req.get("msg", "") + req.get("message", ""))
             _osvLoger.info("get_basic: successfully get bilibili basic.")
             return result
 
-        req = self.get_json("GET", "get_basic", params={"token": token}, return0=True)
+        req = self.get_json("GET", "get_basic", params={"token": token}, return0=True, cache_key=(token,))
         if req == 0:
             _osvLoger.info("get_basic: unknown error.")
         else:
@@ -187,31 +319,78 @@ req.message: " + req.get("msg", "") + req.get("message", ""))
             _osvLoger.info("get_basic: successfully get basic.")
         return result
 
-    def get_gacha(self, token: str, channel_id: 1 or 2 = 1):
+    @staticmethod
+    def gacha_page_meta(content: bytes) -> dict:
+        """
+        从寻访记录接口的原始响应中读取code与总条数,不解析data.list
+        JSON字符串中的引号都会被转义,因此'"code":'与'"total":'只会是键;code不为0时整体解析以获取错误信息
+        返回 dict[code, total, msg]
+        :param content:
+        :return:
+        """
+        code = re.search(rb'"code"\s*:\s*(-?\d+)', content)
+        total = re.search(rb'"total"\s*:\s*(\d+)', content)
+        if code is not None and int(code.group(1)) == 0:
+            return {"code": 0, "total": int(total.group(1)) if total is not None else 0, "msg": ""}
+        req = _json.loads(content)
+        return {"code": req.get("code"), "total": (req.get("data") or {}).get("pagination", {}).get("total", 0),
+                "msg": req.get("msg", "") + req.get("message", "")}
+
+    def _get_gacha_page(self, page: int, token: str, channel_id: 1 or 2, raw: bool, return0: bool):
+        """
+        返回 tuple[dict[code, total, msg], 原始字节(raw为True时)或data.list] 或 0
+        """
+        params = {"page": page, "token": token, "channelId": channel_id}
+        if raw:
+            resp = self.get_json("GET", "gacha", params=params, return0=return0, to_json=False)
+            if resp == 0:
+                return 0
+            try:
+                return self.gacha_page_meta(resp.content), resp.content
+            except ValueError as e:
+                _osvLoger.error(f"meet error when decode gacha page {page}: {e.__class__.__name__}: {str(e)}")
+                if return0:
+                    return 0
+                raise e
+        req = self.get_json("GET", "gacha", params=params, return0=return0)
+        if req == 0:
+            return 0
+        data = req.get("data") or {}
+        return {"code": req.get("code"), "total": data.get("pagination", {}).get("total", 0),
+                "msg": req.get("msg", "") + req.get("message", "")}, data.get("list", [])
+
+    def get_gacha(self, token: str, channel_id: 1 or 2 = 1, progress=None, raw: bool = False):
         """
         generator,失败直接退出
         :param token:
         :param channel_id:
+        :param progress: 每获取一页后调用progress(已获取页数, 总页数)
+        :param raw: 为True时返回每页响应的原始字节(可直接交给GachaModel.loads),不构造中间的dict与list
         :return:
         """
         if not isinstance(token, str):  # or len(token) != 24:
             _osvLoger.error(f"get_gacha: bad token '{token}'.")
             raise ValueError(f"bad token '{token}'.")
-        req = self.get_json("GET", "gacha", params={"page": 1, "token": token, "channelId": channel_id})
-        if req["code"] != 0:
-            _osvLoger.error("get_gacha: req.message: " + req.get("msg", "") + req.get("message", ""))
+        meta, body = self._get_gacha_page(1, token, channel_id, raw, False)
+        if meta["code"] != 0:
+            _osvLoger.error("get_gacha: req.message: " + meta["msg"])
             return 0
-        total = req.get("data", {}).get("pagination", {}).get("total", 0)
+        total = meta["total"]
+        pages = (total - 1) // 10 + 1
         _osvLoger.info(f"get gacha page {1}, total {total}.")
-        yield req.get("data", {}).get("list", [])
-        for page in range(2, (total - 1) // 10 + 1 + 1):
-            req = self.get_json("GET", "gacha", params={"page": page, "token": token, "channelId": channel_id},
-                                return0=True)
-            if req == 0 or req["code"] != 0:
-                _osvLoger.error("get_gacha: req = \"" + str(req) + "\"")
+        if progress is not None:
+            progress(1, pages)
+        yield body
+        for page in range(2, pages + 1):
+            req = self._get_gacha_page(page, token, channel_id, raw, True)
+            if req == 0 or req[0]["code"] != 0:
+                _osvLoger.error(f"get_gacha: page {page} failed: {'no response' if req == 0 else req[0]['msg']}")
                 return 0
+            meta, body = req
             _osvLoger.info(f"get gacha page {page}, total {total}.")
-            yield req.get("data", {}).get("list", [])
+            if progress is not None:
+                progress(page, pages)
+            yield body
 
 
 if __name__ == "__main__":
@@ -0,0 +1,170 @@
+"""
+公开招募标签组合计算,数据来自MetaModel同步的元数据(或直接读取元数据快照文件)
+每个标签预先计算为干员位掩码,选中标签的31种组合只需要按位与,不再逐个扫描干员列表
+"""
+import argparse
+import logging
+import time
+
+import metadata
+from database import MetaIndex, MetaModel
+
+_recruitLogger = logging.getLogger("RecruitLogger")
+
+MAX_TAGS = 5
+TOP_OPERATOR = "高级资深干员"  # 只有选中该标签时才可能招募到6星干员
+SENIOR_OPERATOR = "资深干员"
+MIN_RARITY = 2  # 按招募时间7:40以上计算,不会出现1星和2星干员
+RARITY_TAGS = {5: TOP_OPERATOR, 4: SENIOR_OPERATOR}
+
+
+class RecruitIndex:
+    """
+    公招标签的位掩码索引:干员按星级从高到低编号,每个标签对应一个整数,第i位表示第i位干员带有该标签
+    职业标签('近卫干员'等)与资深/高级资深标签由职业和星级自动补充
+    """
+
+    def __init__(self, operators, version: str = None):
+        """
+        :param operators: 可迭代的tuple[干员, 星级-1, 职业, 可迭代的公招标签],只应包含可公开招募的干员
+        :param version: 元数据版本号
+        """
+        self.version = version
+        self.names = []
+        self.rarities = []
+        self.masks = {}  # 标签 -> 位掩码
+        self.rarity_masks = [0] * 6  # 星级-1 -> 位掩码
+        for name, rarity, profession, tags in sorted(operators, key=lambda op: (-op[1], op[0])):
+            if rarity < MIN_RARITY:
+                continue
+            bit = 1 << len(self.names)
+            self.names.append(name)
+            self.rarities.append(rarity)
+            self.rarity_masks[rarity] |= bit
+            tags = set(tags)
+            if profession:
+                tags.add(profession if profession.endswith("干员") else profession + "干员")
+            if rarity in RARITY_TAGS:
+                tags.add(RARITY_TAGS[rarity])
+            for tag in tags:
+                self.masks[tag] = self.masks.get(tag, 0) | bit
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def from_meta(cls, index: MetaIndex):
+        """
+        返回 由MetaIndex中可公开招募的干员构建的索引
+        :param index:
+        :return:
+        """
+        return cls(((name, rarity, profession, index.tags.get(name, ()))
+                    for name, (rarity, profession, recruitable) in index.operators.items() if recruitable),
+                   version=index.version)
+
+    def tags(self):
+        """
+        返回 全部公招标签,按名称排序
+        :return:
+        """
+        return sorted(self.masks)
+
+    def operators(self, mask: int):
+        """
+        返回 位掩码对应的干员,按星级从高到低
+        :param mask:
+        :return:
+        """
+        result = []
+        while mask:
+            low = mask & -mask
+            result.append(self.names[low.bit_length() - 1])
+            mask ^= low
+        return tuple(result)
+
+    def min_rarity(self, mask: int):
+        """
+        返回 位掩码对应干员中的最低星级-1,即该组合保底的星级
+        :param mask:
+        :return:
+        """
+        return None if not mask else self.rarities[mask.bit_length() - 1]
+
+    def combinations(self, tags):
+        """
+        计算所选标签全部非空组合可能招募到的干员
+        返回 list[tuple[tuple[标签], 保底星级-1, tuple[干员]]],按保底星级从高到低、标签数从少到多排序,没有干员的组合被忽略
+        :param tags: 最多5个标签,重复的标签只计算一次
+        :return:
+        """
+        tags = tuple(dict.fromkeys(tags))
+        if len(tags) > MAX_TAGS:
+            _recruitLogger.error(f"at most {MAX_TAGS} tags can be chosen, got {len(tags)}.")
+            raise ValueError(f"at most {MAX_TAGS} tags can be chosen, got {len(tags)}.")
+        unknown = [tag for tag in tags if tag not in self.masks]
+        if unknown:
+            _recruitLogger.error(f"unknown recruitment tags: {unknown}.")
+            raise ValueError(f"unknown recruitment tags: {unknown}.")
+        masks = [self.masks[tag] for tag in tags]
+        no_top = ~self.rarity_masks[5]
+        top = 1 << tags.index(TOP_OPERATOR) if TOP_OPERATOR in tags else 0
+        # 按子集编号递推,每个组合的掩码等于去掉最高位标签后的组合再与该标签按位与
+        subsets = [-1] + [0] * ((1 << len(tags)) - 1)
+        result = []
+        for subset in range(1, 1 << len(tags)):
+            high = subset.bit_length() - 1
+            mask = subsets[subset] = subsets[subset ^ (1 << high)] & masks[high]
+            if not mask:
+                continue
+            if not subset & top:
+                mask &= no_top
+                if not mask:
+                    continue
+            result.append((tuple(tag for i, tag in enumerate(tags) if subset >> i & 1), self.min_rarity(mask),
+                           self.operators(mask)))
+        result.sort(key=lambda item: (-item[1], len(item[0])))
+        return result
+
+
+_index = None
+
+
+def get_index(model: MetaModel) -> RecruitIndex:
+    """
+    返回 model中元数据的RecruitIndex,元数据版本不变时复用
+    :param model:
+    :return:
+    """
+    global _index
+    meta = model.index()
+    if _index is None or _index.version != meta.version:
+        _index = RecruitIndex.from_meta(meta)
+    return _index
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rhodes Island Terminal recruitment tag calculator")
+    parser.add_argument("tags", nargs="*", help=f"up to {MAX_TAGS} recruitment tags, list all tags if omitted")
+    parser.add_argument("--data", help="read a metadata snapshot file instead of data/meta.db")
+    args = parser.parse_args(argv)
+
+    if args.data:
+        version, operators, _ = metadata.parse_snapshot(metadata.FileFetcher(args.data).fetch())
+        index = RecruitIndex(((name, rarity, profession, tags) for name, rarity, profession, recruitable, tags in
+                              operators if recruitable), version=version)
+    else:
+        index = get_index(MetaModel())
+    if not args.tags:
+        print(" ".join(index.tags()))
+        return
+    start = time.perf_counter()
+    result = index.combinations(args.tags)
+    duration = time.perf_counter() - start
+    for tags, rarity, operators in result:
+        print(f"{' + '.join(tags)}: {rarity + 1}星 {' '.join(operators)}")
+    print(f"{len(result)} combinations in {duration * 1000:.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
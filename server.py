@@ -0,0 +1,247 @@
+import argparse
+import gzip
+import json
+import logging
+import os
+import queue
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager, ExitStack
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from database import GachaModel
+from sharding import ShardedGachaModel, shard_files, shard_index, shard_settings
+
+_srvLogger = logging.getLogger("ServerLogger")
+
+
+class GachaReader(GachaModel):
+    """
+    绑定到一个只读连接的GachaModel,复用其全部查询方法,不参与单例
+    """
+
+    def __new__(cls, *args, **kwargs):
+        return object.__new__(cls)
+
+    def __init__(self, connection: sqlite3.Connection, database: str):
+        self.database = database
+        self.echo = False
+        self.connection = connection
+        self.cursor = connection.cursor()
+        self.lock = threading.RLock()
+
+
+class ReadOnlyPool:
+    """
+    只读连接池,每个请求线程借出一个GachaReader,用完归还
+    """
+
+    def __init__(self, database: str = GachaModel.DATABASE, size: int = 4):
+        self.database = os.path.abspath(database)
+        if not os.path.isfile(self.database):
+            _srvLogger.error(f"database '{self.database}' does not exist.")
+            raise FileNotFoundError(self.database)
+        self._readers = queue.Queue()
+        for _ in range(size):
+            connection = sqlite3.connect(f"file:{self.database}?mode=ro", uri=True, check_same_thread=False)
+            self._readers.put(GachaReader(connection, self.database))
+        _srvLogger.info(f"open {size} read-only connections to '{self.database}'.")
+
+    @contextmanager
+    def reader(self, uid: int = None):
+        """
+        :param uid: 与ShardedReadOnlyPool.reader的参数一致,单文件数据库不需要
+        """
+        reader = self._readers.get()
+        try:
+            yield reader
+        finally:
+            self._readers.put(reader)
+
+    def close(self):
+        while not self._readers.empty():
+            self._readers.get_nowait().connection.close()
+
+
+class ShardedReader(ShardedGachaModel):
+    """
+    绑定到各分片只读连接的ShardedGachaModel,复用其转发与合并方法
+    """
+
+    def __init__(self, readers):
+        self.directory = None
+        self.shards = readers
+
+
+class ShardedReadOnlyPool:
+    """
+    分片存储的只读连接池,每个分片一个ReadOnlyPool
+    单账号的请求只借出uid所在分片的连接;跨账号的请求按分片顺序各借出一个连接,顺序固定因此不会互相等待
+    """
+
+    def __init__(self, shards: int, directory: str, size: int = 4):
+        self.pools = []
+        try:
+            for file in shard_files(shards, directory):
+                self.pools.append(ReadOnlyPool(file, size))
+        except FileNotFoundError:
+            self.close()
+            raise
+
+    @contextmanager
+    def reader(self, uid: int = None):
+        if uid is not None:
+            with self.pools[shard_index(uid, len(self.pools))].reader() as reader:
+                yield reader
+            return
+        with ExitStack() as stack:
+            yield ShardedReader([stack.enter_context(pool.reader()) for pool in self.pools])
+
+    def close(self):
+        for pool in self.pools:
+            pool.close()
+
+
+def open_pool(database: str = GachaModel.DATABASE, size: int = 4):
+    """
+    返回 只读连接池;与sharding.open_gacha_model一致,设置了环境变量RIT_SHARDS时打开各分片,忽略database
+    :param database:
+    :param size: 每个数据库文件的连接数
+    :return:
+    """
+    settings = shard_settings()
+    if settings is None:
+        return ReadOnlyPool(database, size)
+    _srvLogger.info(f"RIT_SHARDS is set, serve {settings[0]} shards in '{settings[1]}' instead of '{database}'.")
+    return ShardedReadOnlyPool(*settings, size=size)
+
+
+class GachaRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /users
+    GET /users/<uid>/total?limit=100&after=<时间>,<十连内序号>
+    GET /users/<uid>/rarity | pools | remains
+    GET /users/<uid>/operators?rarity=5
+    GET /users/<uid>/dump?format=csv|json
+    响应带有基于数据版本号的ETag,支持If-None-Match和gzip
+    """
+    server_version = "RIT"
+    pool: ReadOnlyPool or ShardedReadOnlyPool = None
+    MAX_LIMIT = 1000
+    GZIP_MIN_SIZE = 512
+    ROUTE = re.compile(r"^/users(?:/(\d+)(?:/(total|rarity|pools|remains|operators|dump))?)?/?$")
+
+    def log_message(self, format, *args):
+        _srvLogger.info("%s - %s" % (self.address_string(), format % args))
+
+    def send_body(self, code: int, body: bytes, content_type: str = "application/json; charset=utf-8",
+                  etag: str = None):
+        gzipped = len(body) >= self.GZIP_MIN_SIZE and "gzip" in self.headers.get("Accept-Encoding", "")
+        if gzipped:
+            body = gzip.compress(body, compresslevel=5)
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Vary", "Accept-Encoding")
+        if gzipped:
+            self.send_header("Content-Encoding", "gzip")
+        if etag is not None:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, code: int, obj, etag: str = None):
+        self.send_body(code, json.dumps(obj, ensure_ascii=False).encode("utf-8"), etag=etag)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        match = self.ROUTE.match(url.path)
+        if match is None:
+            return self.send_json(404, {"error": f"no route '{url.path}'"})
+        uid, view = match.groups()
+        try:
+            with self.pool.reader(None if uid is None else int(uid)) as db:
+                etag = 'W/"{}"'.format(db.get_version(None if uid is None else int(uid)))
+                if etag in [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                if uid is None:
+                    return self.send_json(200, {"users": db.get_uids()}, etag)
+                uid = int(uid)
+                if view is None:
+                    return self.send_json(200, {"uid": uid, "version": db.get_version(uid),
+                                                "duration": db.get_duration(uid)}, etag)
+                elif view == "total":
+                    return self.send_json(200, self.total(db, uid, query), etag)
+                elif view == "rarity":
+                    return self.send_json(200, {str(k + 1): v for k, v in db.get_rarity(uid).items()}, etag)
+                elif view == "pools":
+                    return self.send_json(200, [{"pool": pool, "count": cnt, "mean_rarity": mean}
+                                                for pool, cnt, mean in db.get_pools(uid)], etag)
+                elif view == "remains":
+                    return self.send_json(200, dict(db.get_remains(uid)), etag)
+                elif view == "operators":
+                    rarity = int(query.get("rarity", 5))
+                    return self.send_json(200, {pool: [{"name": name, "count": cnt} for name, cnt in ops]
+                                                for pool, ops in db.get_operators(uid, rarity).items()}, etag)
+                elif view == "dump":
+                    file_type = query.get("format", "csv").lower()
+                    text = db.dumps(uid, file_type)
+                    return self.send_body(200, text.encode("utf-8"), "text/csv; charset=utf-8" if file_type == "csv"
+                                          else "application/json; charset=utf-8", etag)
+        except ValueError as e:
+            return self.send_json(400, {"error": str(e)})
+        except Exception as e:
+            _srvLogger.error(f"meet {e.__class__.__name__} when handle '{self.path}': {e}", exc_info=True)
+            return self.send_json(500, {"error": e.__class__.__name__})
+
+    def total(self, db: GachaModel, uid: int, query: dict):
+        limit = query.get("limit", "100")
+        if not limit.isdigit() or int(limit) < 1:  # 0会让游标取到空页的最后一行,负数在sqlite中表示不限制
+            raise ValueError(f"limit must be an integer between 1 and {self.MAX_LIMIT}, not '{limit}'.")
+        limit = min(int(limit), self.MAX_LIMIT)
+        after = query.get("after")
+        if after is not None:
+            ts, _, seq = after.rpartition(",")
+            after = (ts, int(seq))
+        rows = db.get_total_page(uid, after=after, limit=limit)
+        items = [{"time": ts, "pool": pool, "row": row, "name": name, "rarity": rarity}
+                 for ts, _, pool, row, name, rarity in rows]
+        cursor = "{},{}".format(*rows[-1][:2]) if len(rows) == limit else None
+        return {"items": items, "next": cursor}
+
+
+def serve(host: str = "127.0.0.1", port: int = 8080, database: str = GachaModel.DATABASE, pool_size: int = 4):
+    pool = open_pool(database, pool_size)
+    handler = type("Handler", (GachaRequestHandler,), {"pool": pool})
+    httpd = ThreadingHTTPServer((host, port), handler)
+    _srvLogger.info(f"serve on http://{host}:{port}/.")
+    print(f"serving on http://{host}:{port}/ (Ctrl+C to stop)")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        pool.close()
+        _srvLogger.info("server stop.")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rhodes Island Terminal read-only HTTP API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--database", default=GachaModel.DATABASE)
+    parser.add_argument("--pool", type=int, default=4, help="number of read-only connections")
+    args = parser.parse_args(argv)
+    serve(args.host, args.port, args.database, args.pool)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+import argparse
+import logging
+import logging.handlers
+import os
+import random
+import signal
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from database import UserModel, open_databases
+from sharding import open_gacha_model
+from online_service import OnlineService, CookiesError, ParamsError
+
+_svcLogger = logging.getLogger("SyncServiceLogger")
+LOG_FILE = "./log/service.log"
+
+
+def fetch_account(uid: int, channel_id: int, cookies: str):
+    """
+    在工作线程中运行,使用独立的OnlineService(独立的cookies),只联网不写数据库
+    返回 list[寻访记录页的原始响应(bytes)]
+    :param uid:
+    :param channel_id:
+    :param cookies:
+    :return:
+    """
+    osv = OnlineService()
+    token = osv.login_cookies({"ACCOUNT" if channel_id == 1 else "ACCOUNT_AK_B": cookies}, channel_id=channel_id)
+    if not token:
+        raise CookiesError(f"no token for user(uid={uid}).")
+    pages = list(osv.get_gacha(token=token, channel_id=channel_id, raw=True))
+    _svcLogger.info(f"fetch {len(pages)} pages of user(uid={uid}).")
+    return pages
+
+
+class SyncService:
+    """
+    无界面的定时同步服务:定期同步users.db中所有保存了cookies的账号
+    每个账号有独立的下次同步时间(带随机抖动),失败后指数退避,同时联网的账号数有上限,
+    同步计划保存在users.db的sync_schedule表中,重启后继续执行.
+    网络请求在线程池中进行,数据库只在调度线程中读写.
+    """
+
+    def __init__(self, interval: float = 12 * 3600, jitter: float = 0.1, concurrency: int = 4,
+                 backoff: float = 300, max_backoff: float = 24 * 3600, poll: float = 60):
+        """
+        :param interval: 两次成功同步之间的间隔(秒)
+        :param jitter: 随机抖动占间隔的比例
+        :param concurrency: 同时同步的账号数
+        :param backoff: 首次失败后的等待时间(秒),之后每次失败翻倍
+        :param max_backoff: 最长等待时间(秒)
+        :param poll: 重新读取账号列表的最长间隔(秒)
+        """
+        self.interval = interval
+        self.jitter = jitter
+        self.concurrency = concurrency
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.poll = poll
+        self.userDb, self.gachaDb = open_databases(UserModel, open_gacha_model)
+        self.stopped = threading.Event()
+
+    def _delay(self, base: float):
+        return base * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def accounts(self):
+        """
+        返回 dict[uid:tuple[channel_id, cookies]],不含没有cookies的账号
+        :return:
+        """
+        return {line[0]: (line[3], line[4]) for line in self.userDb.get_identities() if line[4]}
+
+    def due(self, now: float = None):
+        """
+        返回 list[uid],按下次同步时间排序,新账号立即同步
+        :param now:
+        :return:
+        """
+        now = time.time() if now is None else now
+        schedule = self.userDb.get_schedule()
+        accounts = self.accounts()
+        due = [(schedule[uid][0] if uid in schedule else 0, uid) for uid in accounts
+               if uid not in schedule or schedule[uid][0] <= now]
+        return [uid for _, uid in sorted(due)]
+
+    def finish(self, uid: int, pages: list = None, error: Exception = None):
+        """
+        写入同步结果并安排下次同步,返回同步结果
+        :param uid:
+        :param pages:
+        :param error:
+        :return:
+        """
+        now = time.time()
+        failures = self.userDb.get_schedule().get(uid, (None, 0))[1]
+        if error is None:
+            cnt = err = 0
+            try:
+                for page in pages:
+                    c, e = self.gachaDb.loads(uid=uid, js=page)
+                    cnt, err = cnt + c, err + e
+            except (ValueError, KeyError, TypeError, sqlite3.Error) as e:  # 响应格式异常或数据库被锁,按失败退避重试
+                _svcLogger.error(f"ingest pages of user(uid={uid}) failed after {cnt} lines: "
+                                 f"{e.__class__.__name__}: {e}", exc_info=True)
+                error = e
+        if error is None:
+            result = f"ok: {cnt} lines, {cnt - err} new"
+            self.userDb.set_schedule(uid, now + self._delay(self.interval), 0, now, result)
+            _svcLogger.info(f"sync user(uid={uid}): {result}.")
+            return result
+        failures += 1
+        delay = self._delay(min(self.max_backoff, self.backoff * 2 ** (failures - 1)))
+        if isinstance(error, CookiesError):
+            result = f"cookies expired, please login again: {error}"
+        elif isinstance(error, ParamsError):
+            result = f"bad response: {error}"
+        else:
+            result = f"{error.__class__.__name__}: {error}"
+        self.userDb.set_schedule(uid, now + delay, failures, now, result)
+        _svcLogger.error(f"sync user(uid={uid}) failed {failures} times, retry in {delay:.0f}s: {result}")
+        return result
+
+    def run_once(self):
+        """
+        同步所有到期的账号后返回
+        返回 dict[uid:同步结果]
+        :return:
+        """
+        return self.run(once=True)
+
+    def run(self, once: bool = False):
+        _svcLogger.info(f"sync service start (interval={self.interval}s, concurrency={self.concurrency}).")
+        running = {}
+        results = {}
+        with ThreadPoolExecutor(self.concurrency, thread_name_prefix="sync") as executor:
+            while not self.stopped.is_set():
+                accounts = self.accounts()
+                for uid in self.due():
+                    if uid in running.values() or len(running) >= self.concurrency:
+                        continue
+                    channel_id, cookies = accounts[uid]
+                    running[executor.submit(fetch_account, uid, channel_id, cookies)] = uid
+                if not running:
+                    if once:
+                        break
+                    schedule = self.userDb.get_schedule()
+                    next_run = min((schedule[uid][0] for uid in accounts if uid in schedule), default=None)
+                    timeout = self.poll if next_run is None else min(self.poll, max(0.0, next_run - time.time()))
+                    self.stopped.wait(timeout)
+                    continue
+                done, _ = wait(running, timeout=self.poll, return_when=FIRST_COMPLETED)
+                for future in done:
+                    uid = running.pop(future)
+                    error = future.exception()
+                    results[uid] = self.finish(uid, None if error else future.result(), error)
+            for future in running:
+                future.cancel()
+        _svcLogger.info("sync service stop.")
+        return results
+
+    def stop(self, *args):
+        _svcLogger.info("stop sync service.")
+        self.stopped.set()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rhodes Island Terminal headless sync service")
+    parser.add_argument("--interval", type=float, default=12, help="hours between two syncs of one account")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--once", action="store_true", help="sync due accounts once and exit")
+    args = parser.parse_args(argv)
+
+    os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+    handler = logging.handlers.TimedRotatingFileHandler(LOG_FILE, when="midnight", backupCount=30, encoding="utf-8")
+    logging.basicConfig(handlers=[handler], datefmt="%y.%m.%d %H:%M:%S", level=logging.INFO,
+                        format="%(lineno)d|%(asctime)s|%(levelname)s|%(name)s-%(threadName)s: %(message)s")
+
+    service = SyncService(interval=args.interval * 3600, concurrency=args.concurrency)
+    signal.signal(signal.SIGINT, service.stop)
+    signal.signal(signal.SIGTERM, service.stop)
+    results = service.run(once=args.once)
+    for uid, result in results.items():
+        print(uid, result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+import argparse
+import functools
+import heapq
+import logging
+import os
+import re
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from database import GachaModel, open_databases, parse_export_file
+
+_shardLogger = logging.getLogger("ShardLogger")
+
+SHARD_DIR = "./data/shards"
+
+
+def shard_files(shards: int, directory: str = SHARD_DIR):
+    """
+    返回 list[各分片的文件路径]
+    :param shards:
+    :param directory:
+    :return:
+    """
+    return [os.path.join(os.path.abspath(directory), f"AkGacha.{i:03d}.db") for i in range(shards)]
+
+
+def shard_index(uid: int, shards: int) -> int:
+    """
+    返回 uid所在分片的序号
+    :param uid:
+    :param shards: 分片数
+    :return:
+    """
+    return zlib.crc32(str(int(uid)).encode("ascii")) % shards
+
+
+class GachaShard(GachaModel):
+    """
+    一个分片文件,不参与单例,使用WAL使读取不被写入阻塞
+    """
+
+    def __new__(cls, *args, **kwargs):
+        return object.__new__(cls)
+
+    def __init__(self, database: str):
+        super().__init__(database)
+        self.execute("PRAGMA journal_mode=WAL")
+        self.execute("PRAGMA synchronous=NORMAL")
+
+
+class ShardedGachaModel:
+    """
+    按uid的哈希把账号分配到多个SQLite文件中,每个分片有独立的连接和写锁
+    单账号的方法转发到所在分片,跨账号的汇总方法在各分片上执行后合并
+    """
+    # 第一个参数为uid的方法,直接转发
+    PER_UID = ("get_rarity", "get_total", "get_total_page", "get_duration", "get_pools", "get_remains",
+               "get_operators", "load_history", "get_rows", "insert_many", "loads", "load", "load_stream", "dumps")
+    expand_files = staticmethod(GachaModel.expand_files)
+    dumpb = GachaModel.dumpb  # 只用到get_uids和load_history
+    dump = GachaModel.dump
+    dump_append = GachaModel.dump_append  # 只用到get_rows和get_version
+    CSV_HEADER = GachaModel.CSV_HEADER
+    EXPORT_STATE_SUFFIX = GachaModel.EXPORT_STATE_SUFFIX
+
+    def __init__(self, shards: int = 8, directory: str = SHARD_DIR):
+        if shards < 1:
+            _shardLogger.error(f"number of shards must be positive, not {shards}.")
+            raise ValueError(f"number of shards must be positive, not {shards}.")
+        self.directory = os.path.abspath(directory)
+        self.shards = open_databases(*(functools.partial(GachaShard, file) for file in shard_files(shards, directory)))
+        _shardLogger.info(f"open {shards} shards in '{self.directory}'.")
+
+    def __len__(self):
+        return len(self.shards)
+
+    def __getattr__(self, name: str):
+        if name not in self.PER_UID:
+            raise AttributeError(f"'{self.__class__.__name__}' object has no attribute '{name}'")
+
+        def forward(*args, **kwargs):
+            uid = kwargs["uid"] if "uid" in kwargs else args[0]
+            return getattr(self.shard(uid), name)(*args, **kwargs)
+        forward.__name__ = name
+        return forward
+
+    def shard_index(self, uid: int) -> int:
+        return shard_index(uid, len(self.shards))
+
+    def shard(self, uid: int) -> GachaShard:
+        return self.shards[self.shard_index(uid)]
+
+    def _map(self, func, *args):
+        """
+        在每个分片上并发执行func(分片, *args)
+        返回 list[各分片的结果]
+        :param func:
+        :param args:
+        :return:
+        """
+        if len(self.shards) == 1:
+            return [func(self.shards[0], *args)]
+        with ThreadPoolExecutor(min(len(self.shards), os.cpu_count() or 4), thread_name_prefix="shard") as executor:
+            return list(executor.map(lambda shard: func(shard, *args), self.shards))
+
+    def commit(self):
+        for shard in self.shards:
+            shard.commit()
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+    def get_uids(self):
+        return tuple(heapq.merge(*self._map(GachaModel.get_uids)))
+
+    def get_version(self, uid: int = None):
+        if uid is not None:
+            return self.shard(uid).get_version(uid)
+        return sum(self._map(GachaModel.get_version))
+
+    def rebuild_rollups(self):
+        result = {}
+        for part in self._map(GachaModel.rebuild_rollups):
+            for table, cnt in part.items():
+                result[table] = result.get(table, 0) + cnt
+        return result
+
+    def get_global_pools(self):
+        pools = {}
+        for part in self._map(GachaModel.get_global_pools):
+            for pool, cnt, six in part:
+                total = pools.setdefault(pool, [0, 0])
+                total[0] += cnt
+                total[1] += six
+        return tuple(sorted(((pool, cnt, six) for pool, (cnt, six) in pools.items()), key=lambda x: -x[1]))
+
+    def get_global_rarity(self, uid: int = None):
+        if uid is not None:
+            return self.shard(uid).get_global_rarity(uid)
+        result = {2: 0, 3: 0, 4: 0, 5: 0}
+        for part in self._map(GachaModel.get_global_rarity):
+            for rarity, cnt in part.items():
+                result[rarity] = result.get(rarity, 0) + cnt
+        return result
+
+    def get_top_operators(self, limit: int = 10, rarity: int = None):
+        operators = {}
+        for part in self._map(GachaModel.get_top_operators, -1, rarity):  # LIMIT -1:每个分片返回全部干员
+            for name, rar, cnt, users in part:
+                total = operators.setdefault(name, [rar, 0, 0])
+                total[1] += cnt
+                total[2] += users
+        result = sorted(((name, rar, cnt, users) for name, (rar, cnt, users) in operators.items()),
+                        key=lambda x: -x[2])
+        return tuple(result[:limit])
+
+    def get_daily(self, uid: int = None, earliest_day: str = None):
+        if uid is not None:
+            return self.shard(uid).get_daily(uid, earliest_day)
+        days = {}
+        for part in self._map(GachaModel.get_daily, None, earliest_day):
+            for day, cnt in part:
+                days[day] = days.get(day, 0) + cnt
+        return tuple(sorted(days.items()))
+
+    def import_files(self, paths: str or list or tuple, uid: int = None, processes: int = None):
+        """
+        同GachaModel.import_files,解析在进程池中进行,不同分片的写入并发进行
+        :param paths:
+        :param uid:
+        :param processes:
+        :return:
+        """
+        files = self.expand_files(paths)
+        _shardLogger.info(f"import {len(files)} files into {len(self.shards)} shards.")
+        start = time.perf_counter()
+        results = []
+        futures = []
+
+        def write(file, file_uid, rows):
+            cnt, err = self.insert_many(file_uid, rows)
+            _shardLogger.info(f"import file '{file}': {cnt} lines({err} fail).")
+            return file, file_uid, cnt, err, None
+
+        with ThreadPoolExecutor(len(self.shards), thread_name_prefix="shard") as writer, \
+                ProcessPoolExecutor(processes) as parser:  # 进程在第一次提交任务时才会创建
+            if processes == 1 or len(files) <= 1:
+                parsed = map(parse_export_file, files)
+            else:
+                parsed = parser.map(parse_export_file, files, chunksize=4)
+            for file, rows, error in parsed:
+                file_uid = uid
+                if file_uid is None and error is None:
+                    match = re.match(r"\d+", os.path.basename(file))
+                    if match is None:
+                        error = f"cannot get uid from file name '{os.path.basename(file)}'."
+                    else:
+                        file_uid = int(match.group())
+                if error is not None:
+                    _shardLogger.error(f"import file '{file}' failed: {error}")
+                    results.append((file, file_uid, 0, 0, error))
+                else:
+                    futures.append(writer.submit(write, file, file_uid, rows))
+        results.extend(future.result() for future in futures)
+        return results, time.perf_counter() - start
+
+
+def shard_settings():
+    """
+    返回 tuple[分片数, 分片目录],由环境变量RIT_SHARDS与RIT_SHARD_DIR(默认SHARD_DIR)决定,未设置RIT_SHARDS时返回None
+    :return:
+    """
+    shards = os.environ.get("RIT_SHARDS", "").strip()
+    if not shards:
+        return None
+    return int(shards), os.environ.get("RIT_SHARD_DIR", SHARD_DIR)
+
+
+def open_gacha_model():
+    """
+    返回 GachaModel,设置了环境变量RIT_SHARDS(分片数)时返回ShardedGachaModel,分片目录为RIT_SHARD_DIR或SHARD_DIR
+    :return:
+    """
+    settings = shard_settings()
+    if settings is None:
+        return GachaModel()
+    return ShardedGachaModel(*settings)
+
+
+def reshard(source, target, batch: int = 10000):
+    """
+    把source(GachaModel或ShardedGachaModel)中的全部记录复制到target,已存在的记录会被跳过,可重复执行
+    返回 tuple[账号数, 总条数, 跳过条数]
+    :param source:
+    :param target:
+    :param batch: 每batch条写入一次
+    :return:
+    """
+    users = total = skipped = 0
+    for uid in source.get_uids():
+        rows = source.get_rows(uid)
+        for i in range(0, len(rows), batch):
+            cnt, err = target.insert_many(uid, rows[i:i + batch])
+            total, skipped = total + cnt, skipped + err
+        users += 1
+        _shardLogger.info(f"reshard user(uid={uid}): {len(rows)} lines.")
+    return users, total, skipped
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rhodes Island Terminal sharded gacha storage")
+    sub = parser.add_subparsers(dest="command", required=True)
+    split = sub.add_parser("reshard", help="copy a database (single file or shards) into N shards")
+    split.add_argument("--source", default=GachaModel.DATABASE, help="single database file, or a shard directory")
+    split.add_argument("--source-shards", type=int, help="number of shards when --source is a shard directory")
+    split.add_argument("--shards", type=int, default=8)
+    split.add_argument("--dir", default=SHARD_DIR, help="target shard directory")
+    info = sub.add_parser("info", help="show rows and accounts per shard")
+    info.add_argument("--shards", type=int, default=8)
+    info.add_argument("--dir", default=SHARD_DIR)
+    args = parser.parse_args(argv)
+
+    if args.command == "reshard":
+        if os.path.abspath(args.source) == os.path.abspath(args.dir):
+            parser.error("source and target must be different directories")
+        if args.source_shards is not None:
+            source = ShardedGachaModel(args.source_shards, args.source)
+        elif not os.path.isfile(args.source):
+            parser.error(f"database '{args.source}' does not exist")
+        else:
+            source = GachaModel(args.source)
+        target = ShardedGachaModel(args.shards, args.dir)
+        start = time.perf_counter()
+        users, total, skipped = reshard(source, target)
+        print(f"copied {users} accounts, {total - skipped} of {total} rows ({skipped} already present) into "
+              f"{args.shards} shards in {time.perf_counter() - start:.2f}s")
+    elif args.command == "info":
+        model = ShardedGachaModel(args.shards, args.dir)
+        for i, shard in enumerate(model.shards):
+            print(f"{i:>3}: {len(shard.get_uids()):>6} accounts, {shard.get_version():>9} rows  {shard.database}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import logging
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+_snapLogger = logging.getLogger("SnapshotLogger")
+
+SNAPSHOT_DIR = "./data/snapshot"
+
+
+class Snapshot:
+    """
+    单个用户的只读快照,update之后重新生成,离线查看时用mmap打开,按定长记录切片读取
+    文件结构(小端序):
+        文件头 HEADER
+        字符串表: 卡池名与干员名,每个为长度(uint16)+utf-8
+        各星级数量: 6 * uint32
+        各卡池统计 POOL * 卡池数,卡池编号按首次出现的顺序
+        6星间隔: uint16 * 间隔数,按卡池编号依次排列
+        寻访记录 ROW * 行数,按(时间, 十连内序号)升序
+    """
+    MAGIC = b"RITS"
+    VERSION = 1
+    # 魔数, 格式版本, 数据版本号(GachaModel.get_version), 行数, 卡池数, 干员数, 字符串表字节数, 6星间隔数
+    HEADER = struct.Struct("<4sB3xqIIIII")
+    # 抽数, 平均星级, 距离上个6星抽数, 6星间隔数
+    POOL = struct.Struct("<IdII")
+    # 时间, 十连内序号, 卡池编号, 干员编号, 卡池内序号, 星级-1
+    ROW = struct.Struct("<19sBHHIB")
+
+    def __init__(self, file: str):
+        self.file = os.path.abspath(file)
+        self._fp = open(self.file, "rb")
+        try:
+            self._mmap = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # 空文件
+            self._fp.close()
+            _snapLogger.error(f"'{self.file}' is empty.")
+            raise ValueError(f"'{self.file}' is empty.")
+        self.buffer = memoryview(self._mmap)
+        magic, version, self.version, self.rows, npools, noperators, nbytes, ngaps = \
+            self.HEADER.unpack_from(self.buffer)
+        if magic != self.MAGIC or version != self.VERSION:
+            self.close()
+            _snapLogger.error(f"'{self.file}' is not a snapshot of version {self.VERSION}.")
+            raise ValueError(f"'{self.file}' is not a snapshot of version {self.VERSION}.")
+        offset = self.HEADER.size
+        names = []
+        for _ in range(npools + noperators):
+            size, = struct.unpack_from("<H", self.buffer, offset)
+            names.append(str(self.buffer[offset + 2:offset + 2 + size], "utf-8"))
+            offset += 2 + size
+        self.pools, self.operators = names[:npools], names[npools:]
+        self.rarity = struct.unpack_from("<6I", self.buffer, offset)
+        offset += 24
+        self.pool_stats = [self.POOL.unpack_from(self.buffer, offset + i * self.POOL.size) for i in range(npools)]
+        offset += npools * self.POOL.size
+        self._gaps = self.buffer[offset:offset + ngaps * 2]
+        offset += ngaps * 2
+        self._rows = self.buffer[offset:offset + self.rows * self.ROW.size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        try:
+            for name in ("_gaps", "_rows", "buffer"):
+                if hasattr(self, name):
+                    getattr(self, name).release()
+            self._mmap.close()
+        except BufferError:  # 仍有外部引用的切片时由垃圾回收关闭
+            pass
+        finally:
+            self._fp.close()
+
+    @classmethod
+    def write(cls, model, uid: int, file: str):
+        """
+        根据model(GachaModel或ShardedGachaModel)中的数据生成快照,先写入临时文件再替换,读者不会看到写了一半的文件
+        返回 文件路径
+        :param model:
+        :param uid:
+        :param file:
+        :return:
+        """
+        version = model.get_version(uid)
+        rows = model.get_rows(uid)
+        pools, operators = {}, {}
+        rarity = [0] * 6
+        stats = []  # list[list[抽数, 星级和, 距离上个6星抽数, list[6星间隔]]]
+        records = []
+        for ts, seq, pool, operator, rar, _ in rows:
+            pool_id = pools.setdefault(pool, len(pools))
+            operator_id = operators.setdefault(operator, len(operators))
+            if pool_id == len(stats):
+                stats.append([0, 0, 0, []])
+            stat = stats[pool_id]
+            stat[0] += 1
+            stat[1] += rar
+            stat[2] += 1
+            if rar == 5:
+                stat[3].append(min(stat[2], 0xFFFF))
+                stat[2] = 0
+            rarity[rar] += 1
+            records.append(cls.ROW.pack(ts.encode("ascii"), seq, pool_id, operator_id, stat[0], rar))
+        strings = b"".join(struct.pack("<H", len(raw)) + raw for raw in
+                           (name.encode("utf-8") for name in list(pools) + list(operators)))
+        gaps = array("H", (gap for stat in stats for gap in stat[3]))
+        if sys.byteorder == "big":
+            gaps.byteswap()
+        file = os.path.abspath(file)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        tmp = file + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, version, len(records), len(pools), len(operators),
+                                    len(strings), len(gaps)))
+            f.write(strings)
+            f.write(struct.pack("<6I", *rarity))
+            f.write(b"".join(cls.POOL.pack(cnt, total / cnt, remain, len(gap)) for cnt, total, remain, gap in stats))
+            f.write(gaps.tobytes())
+            f.write(b"".join(records))
+        os.replace(tmp, file)
+        _snapLogger.info(f"write snapshot of user(uid={uid}) with {len(records)} lines to '{file}'.")
+        return file
+
+    def get_total(self, max_cnt: int = None):
+        """
+        同GachaModel.get_total,只读取需要的行
+        :param max_cnt:
+        :return:
+        """
+        rows = self._rows if max_cnt is None else self._rows[:int(max_cnt) * self.ROW.size]
+        return tuple((ts.decode("ascii"), self.pools[pool], row, self.operators[operator], f"{rar + 1}星")
+                     for ts, _, pool, operator, row, rar in self.ROW.iter_unpack(rows))
+
+    def get_duration(self):
+        if not self.rows:
+            return None, None
+        first = self.ROW.unpack_from(self._rows, 0)[0].decode("ascii")
+        last = self.ROW.unpack_from(self._rows, (self.rows - 1) * self.ROW.size)[0].decode("ascii")
+        return first, last
+
+    def get_rarity(self):
+        result = {2: 0, 3: 0, 4: 0, 5: 0}
+        result.update((i, cnt) for i, cnt in enumerate(self.rarity) if cnt)
+        return result
+
+    def get_pools(self):
+        return tuple((pool, cnt, mean) for pool, (cnt, mean, _, _) in zip(self.pools, self.pool_stats))
+
+    def get_remains(self):
+        """
+        同GachaModel.get_remains:先是抽到过6星的卡池,再是没抽到过的,各自按卡池名排序
+        :return:
+        """
+        return tuple((pool, remain) for gaps, pool, remain in
+                     sorted((not ngaps, pool, remain) for pool, (_, _, remain, ngaps) in
+                            zip(self.pools, self.pool_stats)))
+
+    def pity_gaps(self):
+        """
+        返回 dict[卡池:memoryview[6星间隔]],小端序机器上不复制数据
+        :return:
+        """
+        gaps = self._gaps.cast("H")
+        if sys.byteorder == "big":
+            gaps = array("H")
+            gaps.frombytes(self._gaps)
+            gaps.byteswap()
+        result = {}
+        offset = 0
+        for pool, (_, _, _, ngaps) in zip(self.pools, self.pool_stats):
+            result[pool] = gaps[offset:offset + ngaps]
+            offset += ngaps
+        return result
+
+
+def snapshot_file(uid: int, directory: str = SNAPSHOT_DIR) -> str:
+    return os.path.join(directory, f"{uid}.snap")
+
+
+if __name__ == "__main__":
+    pass
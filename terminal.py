@@ -1,40 +1,67 @@
 import ua
 from ua import UserAgent
+from collections import OrderedDict
+import metadata
+import metrics
+import recruit
+import cProfile
+import contextlib
+import io
+import itertools
+import json
 import logging
+import pstats
+import shutil
+import sys
 import time
 import os
 
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+try:
+    import readline
+except ImportError:  # Windows
+    readline = None
+
 _terminalLogger = logging.getLogger("TerminalLogger")
 LOG_FILE = "./log/" + time.strftime("%Y%m%d") + ".log"
 SUPERUSER_PSW = os.environ.get("RIT_SUPERUSER_PSW")
-if not os.path.exists(".\\log"):
-    os.makedirs(".\\log")
+LOG_DIR = os.path.dirname(LOG_FILE)
+if not os.path.exists(LOG_DIR):
+    os.makedirs(LOG_DIR)
 
 
 class Terminal:
     __instance = None
-    __local_namespace = {}
-    __global_namespace = {}
+    __commands = {}  # (是否全局, 位置..., 指令...) -> 函数
+    __completions = {}  # (是否全局, 位置..., 已输入的指令...) -> 可补全的下一个词
+    __depth = 0
     __version__ = (0, 1, 5)
     _VERSION_NAME = "beta"
     TRANSFER = "?"
+    _tables = None  # 批处理模式下print_table不输出,表格记录在此列表中
+    RENDER_CACHE_SIZE = 16
+    RARITY_LABELS = tuple(f"{i + 1}星" for i in range(6))
 
     def __new__(cls, *args, **kwargs):
         if cls.__instance is None:
             cls.__instance = super().__new__(cls)
             for name, func in cls.__dict__.items():
                 if name[:3] == "do_":
-                    name = name[3:].replace("__", cls.TRANSFER).split("_")
-                    father = cls.__local_namespace
+                    is_global, name = False, name[3:]
                 elif name[:4] == "gdo_":
-                    name = name[4:].replace("__", cls.TRANSFER).split("_")
-                    father = cls.__global_namespace
+                    is_global, name = True, name[4:]
                 else:
                     continue
-                for route in name:
-                    father[route] = father.get(route, {})
-                    father = father[route]
-                father[...] = func
+                key = (is_global,) + tuple(s.replace(cls.TRANSFER, "_")
+                                           for s in name.replace("__", cls.TRANSFER).split("_"))
+                cls.__commands[key] = func
+                cls.__depth = max(cls.__depth, len(key) - 1)
+                for i in range(1, len(key)):
+                    cls.__completions.setdefault(key[:i], set()).add(key[i])
 
         return cls.__instance
 
@@ -42,66 +69,87 @@ class Terminal:
         _terminalLogger.debug("initialize terminal.")
         self.loc = []
         self.user: UserAgent = None
+        self.task: ua.UpdateTask = None
         self.trials = 10
         self.is_superuser: bool = False
+        self._matches = []
+        self.batch = False  # 批处理模式:不等待、不读取输入、表格输出为JSON
+        self.errors = 0
+        self._renders = OrderedDict()  # 见print_cached_table
+        if readline is not None:
+            readline.set_completer(self.complete)
+            readline.set_completer_delims(" \t")
+            readline.parse_and_bind("tab: complete")
 
     @staticmethod
-    def print_table(data, headers: tuple or list = None, width: tuple or list = None, index: bool = True,
-                    end: str = None, border: bool = True):
+    def render_table(data, headers: tuple or list = None, width: tuple or list = None, index: bool = True,
+                     end: str = None, border: bool = True) -> str:
+        """
+        返回 表格的完整文本,格式同print_table,空表返回空字符串
+        """
         data = data.__iter__()
         try:
             first_line = next(data)
         except StopIteration:
             _terminalLogger.info("print blank table.")
-            return
-        i = -1
+            return ""
         if headers is None:
             headers = ("Untitled",) * len(first_line)
         else:
             headers = tuple(headers)
         if width is None:
-            width = ["{:^%ds}" % max(len(i), len(str(j))) for i, j in zip(headers, first_line)]
-        else:
-            width = ["{:^%ds}" % i for i in width]
+            width = [max(len(i), len(str(j))) for i, j in zip(headers, first_line)]
 
         if not (len(first_line) == len(headers) == len(width)):
             raise ValueError("length of headers and width does not match data.")
 
         if index:
             headers = ("index",) + headers
-            width = ["{:^5s}"] + width
-            first_line = [0] + [item for item in first_line]
-
-        if border:
-            print("-" * int((sum(int(w[3:-2]) for w in width) + 2) * 1.3))
-
-        print("|" if border else "", end="")
-        print(*(w.format(str(d)) for w, d in zip(width, headers)), sep="|", end="")
-        print("|" if border else "", end="\n")
-
-        if border:
-            print("-" * int((sum(int(w[3:-2]) for w in width) + 2) * 1.3))
-
-        print("|" if border else "", end="")
-        print(*(w.format(str(d)) for w, d in zip(width, first_line)), sep="|", end="")
-        print("|" if border else "", end="\n")
-        for i, line in enumerate(data):
-            if index:
-                line = [i + 1] + [item for item in line]
-            print("|" if border else "", end="")
-            print(*(w.format(str(d)) for w, d in zip(width, line)), sep="|", end="")
-            print("|" if border else "", end="\n")
-
-        if border:
-            print("-" * int((sum(int(w[3:-2]) for w in width) + 2) * 1.3))
-
-        if end is None:
-            print(f"total: {i + 2}")
-        else:
-            print(end)
+            width = [5] + list(width)
+        side = "|" if border else ""
+        row = side + "|".join("{:^%ds}" % w for w in width) + side + "\n"  # 整行一次format
+        line = "-" * int((sum(width) + 2) * 1.3) + "\n" if border else ""
+
+        lines = [line, row.format(*map(str, headers)), line]
+        cnt = 0
+        for cnt, item in enumerate(itertools.chain((first_line,), data)):
+            lines.append(row.format(*map(str, (cnt,) + tuple(item) if index else item)))
+        lines += [line, f"total: {cnt + 1}\n" if end is None else f"{end}\n", line]
+        return "".join(lines)
 
-        if border:
-            print("-" * int((sum(int(w[3:-2]) for w in width) + 2) * 1.3))
+    @staticmethod
+    def print_table(data, headers: tuple or list = None, width: tuple or list = None, index: bool = True,
+                    end: str = None, border: bool = True):
+        if Terminal._tables is not None:
+            Terminal._tables.append({"headers": None if headers is None else list(headers),
+                                     "rows": [list(line) for line in data], "end": end})
+            return
+        sys.stdout.write(Terminal.render_table(data, headers, width, index, end, border))
+
+    def print_cached_table(self, key: tuple, data, **kwargs):
+        """
+        渲染结果按(指令, uid, 数据版本号, key..., 终端宽度)缓存,重复查看时只输出一次缓存的文本
+        数据版本号随loads/insert_many写入的新记录增大,写入后旧的缓存不会再被命中,按LRU淘汰
+        :param key: 指令名与参数(如页数)
+        :param data: 返回表格数据的函数,只在未命中时调用
+        :param kwargs: 同print_table
+        :return:
+        """
+        if Terminal._tables is not None:
+            return self.print_table(data(), **kwargs)
+        key = (self.user.uid, self.user.version()) + tuple(key) + (shutil.get_terminal_size().columns,)
+        text = self._renders.get(key)
+        if text is None:
+            text = self._renders[key] = self.render_table(data(), **kwargs)
+            while len(self._renders) > self.RENDER_CACHE_SIZE:
+                self._renders.popitem(last=False)
+            if metrics.enabled:
+                metrics.incr("render_cache", "miss")
+        else:
+            self._renders.move_to_end(key)
+            if metrics.enabled:
+                metrics.incr("render_cache", "hit")
+        sys.stdout.write(text)
 
     def gdo_debug(self, debug: str, *args):
         if debug.lower() == "on":
@@ -126,6 +174,13 @@ class Terminal:
         version 版本号(由可露希尔小姐倾情提供)
         about   关于Rhodes Island Terminal(看来博士的失忆确实很严重了呢……)
         eval    奇怪的指令,要不要试着输点东西呢(博士……我在看着你……)
+        rebuild_rollups 重建并校验汇总表
+        stats   [on|off|reset|json [file]] 查看、开关、清空或导出性能统计
+        profile [-s] <command...> 分析指令耗时,结果保存在log文件夹(-s:使用pyinstrument采样分析)
+        import  [path] [uid] 批量导入JSON/CSV文件,path可以是文件、目录或通配符,未指定uid时从文件名获取
+        export  [file] 把全部账号导出为一个列式二进制文件(.ritc,安装pyarrow后支持.parquet)
+        meta    [sync source [-f]] 查看或同步干员与卡池元数据,source为JSON文件路径或http(s)地址(-f:版本相同也重新导入)
+        recruit [tag...] 公招标签组合计算,最多5个标签,不输入标签时列出全部标签(需要先同步元数据)
         """)
         print("""
         -----------局部指令----------""")
@@ -134,7 +189,7 @@ class Terminal:
     def DO(self, command: str):
         loc = self.loc if self.loc else ("index",)
         _terminalLogger.debug(f"/{'/'.join(loc)}:do command '{command}'.")
-        command = command.strip().replace("_", self.TRANSFER)
+        command = command.strip()
         route = command.split()
         if not command:
             return  # True #忽略空输入,去除注释后空输入返回上一界面
@@ -158,35 +213,109 @@ class Terminal:
             self.help()
             self.trials = self.trials - 1 if self.trials > 0 else time.time()
 
-        func = self.__local_namespace
+        for prefix in ((False,) + tuple(loc), (True,)):
+            for i in range(min(len(route), self.__depth - len(prefix) + 1), 0, -1):
+                func = self.__commands.get(prefix + tuple(route[:i]))
+                if func is not None:
+                    return self._invoke(func, [self] + route[i:])
+        self.error(f"no command '{command}'")
+        return
+
+    def error(self, msg: str):
+        """
+        输出错误信息,批处理模式下该指令记为失败
+        :param msg:
+        :return:
+        """
+        self.errors += 1
+        print(msg)
+
+    def sleep(self, seconds: float):
+        if not self.batch:
+            time.sleep(seconds)
+
+    def run_batch(self, commands, out=None, exit_on_error: bool = False):
+        """
+        非交互地依次执行指令,每条指令输出一行JSON:
+        {"command": 指令, "ok": 是否成功, "output": [输出的每一行], "tables": [{"headers", "rows", "end"}], "error": 异常}
+        需要输入的指令直接失败,不会等待
+        返回 退出码,有指令失败时为1
+        :param commands: 可迭代的指令,空行和以#开头的行被忽略
+        :param out: 输出流,默认为标准输出
+        :param exit_on_error: 出现失败后不再执行后续指令
+        :return:
+        """
+        out = sys.stdout if out is None else out
+        failed = 0
+        self.batch = True
+        stdin, sys.stdin = sys.stdin, io.StringIO()
         try:
-            for rt in loc:
-                func = func[rt]
-        except KeyError:
-            func = {}
-        run = None
-        for i in range(len(route)):
-            func = func.get(route[i])
-            if func is None:
-                break
-            elif callable(func.get(Ellipsis)):
-                run = (func[Ellipsis], [self] + [s.replace(self.TRANSFER, "_") for s in route[i+1:]])
-        if run is not None:
-            return run[0](*run[1])
-
-        func = self.__global_namespace
-        run = None
-        for i in range(len(route)):
-            func = func.get(route[i])
-            if func is None:
-                break
-            elif callable(func.get(Ellipsis)):
-                run = (func[Ellipsis], [self] + [s.replace(self.TRANSFER, "_") for s in route[i+1:]])
-        if run is not None:
-            return run[0](*run[1])
-        else:
-            print(f"no command '{command.replace(self.TRANSFER, '_')}'")
-            return
+            for command in commands:
+                command = command.strip()
+                if not command or command.startswith("#"):
+                    continue
+                Terminal._tables = []
+                self.errors = 0
+                buffer = io.StringIO()
+                result = error = None
+                stop = False
+                try:
+                    with contextlib.redirect_stdout(buffer):
+                        result = self.DO(command)
+                        if result is True and self.user is not None:
+                            self.logout()
+                except SystemExit:
+                    stop = True
+                except BaseException as e:
+                    _terminalLogger.error(f"batch: meet {e.__class__.__name__} when do '{command}': {e}",
+                                          exc_info=True)
+                    error = f"{e.__class__.__name__}: {e}"
+                line = {"command": command, "ok": error is None and not self.errors,
+                        "output": buffer.getvalue().splitlines(), "tables": Terminal._tables}
+                if error is not None:
+                    line["error"] = error
+                out.write(json.dumps(line, ensure_ascii=False, default=str) + "\n")
+                out.flush()
+                failed += not line["ok"]
+                if stop or (failed and exit_on_error):
+                    break
+            if self.user is not None:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    self.logout()
+        finally:
+            sys.stdin = stdin
+            Terminal._tables = None
+            self.batch = False
+        return 1 if failed else 0
+
+    def complete(self, text: str, state: int):
+        """
+        readline补全函数,候选词来自局部和全局指令
+        :param text:
+        :param state:
+        :return:
+        """
+        if state == 0:
+            words = readline.get_line_buffer()[:readline.get_endidx()].split()
+            if text:
+                words = words[:-1]
+            loc = tuple(self.loc) if self.loc else ("index",)
+            candidates = self.__completions.get((False,) + loc + tuple(words), set()) | \
+                self.__completions.get((True,) + tuple(words), set())
+            if not words:
+                candidates.add("help")
+            self._matches = sorted(c + " " for c in candidates if c.startswith(text))
+        return self._matches[state] if state < len(self._matches) else None
+
+    @staticmethod
+    def _invoke(func, args):
+        if not metrics.enabled:
+            return func(*args)
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            metrics.observe("command", func.__name__, time.perf_counter() - start)
 
     def menu_index(self):
         _terminalLogger.info("menu index")
@@ -200,7 +329,7 @@ class Terminal:
         while e is None:
             e = self.DO(input(">>>"))
         print("正在退出...")
-        time.sleep(0.5)
+        self.sleep(0.5)
         raise SystemExit(0)
 
     def do_index_login(self, *args):
@@ -211,6 +340,7 @@ class Terminal:
         login   phone_password [phone password] 手机号+密码登录
                 local                           本地登录,会根据保存的cookies自动尝试联网
                 token [token]                   token登录,B服唯一的登录方法
+                uid [uid]                       使用已保存的cookies直接登录指定uid,适合批处理
                 token获取方法:登录后根据所在服务器选择对应链接访问,将页面内所有内容粘贴至输入即可
                 官服:https://web-api.hypergryph.com/account/info/hg
                 B服:https://web-api.hypergryph.com/account/info/ak-b
@@ -236,7 +366,7 @@ class Terminal:
     def gdo_exit(self, *args):
         print("退出程序...")
         _terminalLogger.info("exit terminal")
-        time.sleep(0.5)
+        self.sleep(0.5)
         raise SystemExit
 
     def gdo_eval(self, *args):
@@ -251,6 +381,171 @@ class Terminal:
         except Exception as e:
             print(f"{e.__class__.__name__}: '{e}'")
 
+    def gdo_stats(self, action: str = None, *args):
+        action = (action or "").lower()
+        if action in ("on", "off"):
+            metrics.enable(action == "on")
+            print(f"stats {action}")
+            return
+        elif action == "reset":
+            metrics.REGISTRY.reset()
+            print("stats reset")
+            return
+        elif action == "json":
+            file = args[0] if args else os.path.join(LOG_DIR, "stats_" + time.strftime("%Y%m%d_%H%M%S") + ".json")
+            print(f"已导出至 '{metrics.REGISTRY.dump(file)}'.")
+            return
+        elif action:
+            print(f"no stats action '{action}'")
+            return
+        snapshot = metrics.snapshot()
+        print("统计{}, 开始于{}.".format("已开启" if snapshot["enabled"] else "未开启(输入 'stats on' 开启)",
+                                    time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(snapshot["started"]))))
+        for kind, group in snapshot["histograms"].items():
+            val = sorted(group.items(), key=lambda item: -item[1]["total"])
+            self.print_table(((key if len(key) <= 48 else key[:45] + "...", h["count"],
+                               "{:.3f}".format(h["mean"] * 1000), "{:.3f}".format(h["p95"] * 1000),
+                               "{:.3f}".format(h["max"] * 1000), "{:.1f}".format(h["total"] * 1000))
+                              for key, h in val),
+                             headers=[kind, "次数", "平均ms", "p95ms", "最大ms", "总计ms"], width=[48, 6, 8, 8, 8, 9],
+                             index=False)
+        for kind, group in snapshot["counters"].items():
+            self.print_table(((key if len(key) <= 48 else key[:45] + "...", cnt) for key, cnt in group.items()),
+                             headers=[kind, "计数"], width=[48, 10], index=False)
+
+    def gdo_profile(self, *args):
+        sampling = bool(args) and args[0] == "-s"
+        command = " ".join(args[1:] if sampling else args)
+        if not command:
+            print("用法: profile [-s] <command...>")
+            return
+        if sampling and pyinstrument is None:
+            print("未安装pyinstrument,使用cProfile.")
+            sampling = False
+        name = os.path.join(LOG_DIR, "profile_" + time.strftime("%Y%m%d_%H%M%S"))
+        _terminalLogger.info(f"profile command '{command}'.")
+        profiler = pyinstrument.Profiler() if sampling else cProfile.Profile()
+        metrics.start_trace()
+        start = time.perf_counter()
+        if sampling:
+            profiler.start()
+        else:
+            profiler.enable()
+        try:
+            result = self.DO(command)
+        finally:
+            if sampling:
+                profiler.stop()
+            else:
+                profiler.disable()
+            duration = time.perf_counter() - start
+            trace = metrics.stop_trace()
+
+            if sampling:
+                report = profiler.output_text(unicode=True)
+                with open(name + ".txt", "w", encoding="utf-8") as f:
+                    f.write(report)
+                files = [name + ".txt"]
+            else:
+                stream = io.StringIO()
+                stats = pstats.Stats(profiler, stream=stream)
+                stats.dump_stats(name + ".pstats")
+                stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(20)
+                report = stream.getvalue()
+                files = [name + ".pstats"]
+            with open(name + ".trace.txt", "w", encoding="utf-8") as f:
+                f.write(f"command: {command}\nduration: {duration:.6f}s\n")
+                for ts, kind, key, seconds in trace:
+                    f.write("{} {:>8.3f}ms {:<6} {}\n".format(
+                        time.strftime("%H:%M:%S", time.localtime(ts)), seconds * 1000, kind, key))
+            files.append(name + ".trace.txt")
+            print(report)
+            print("'{}'用时{:.3f}秒,共{}条SQL语句,{}次网络请求.".format(
+                command, duration, sum(t[1] == "sql" for t in trace), sum(t[1] == "http" for t in trace)))
+            print("分析结果已保存至: " + ", ".join(files))
+        return result
+
+    def gdo_rebuild__rollups(self, *args):
+        print("正在重建汇总表...")
+        result = UserAgent.gachaDb.rebuild_rollups()
+        self.print_table(result.items(), headers=["汇总表", "不一致分组数"], width=[15, 12], index=False,
+                         end="汇总表一致." if not any(result.values()) else "已修复不一致的汇总数据.")
+
+    def gdo_import(self, *args):
+        path = args[0] if args else input("请输入导入文件、目录或通配符:")
+        if not path:
+            return
+        uid = int(args[1]) if len(args) > 1 and args[1].isdigit() else None
+        files = UserAgent.gachaDb.expand_files(path)
+        if not files:
+            print("没有找到可导入的文件.")
+            return
+        if uid is None and self.user is not None and len(files) == 1:
+            uid = self.user.uid
+        results, duration = UserAgent.gachaDb.import_files(files, uid=uid)
+        total = sum(r[2] for r in results)
+        self.print_table(((os.path.basename(file), file_uid, cnt, err, error or "")
+                          for file, file_uid, cnt, err, error in results),
+                         headers=["文件", "uid", "条数", "已录入", "错误"], width=[20, 10, 6, 6, 10], index=False,
+                         end="共导入{}个文件,{}条数据,用时{:.2f}秒({:.0f}条/秒).".format(
+                             len(results), total, duration, total / duration if duration else 0))
+
+    def gdo_meta(self, *args):
+        meta = UserAgent.meta.get_meta()
+        operators, banners = UserAgent.meta.get_counts()
+        if "version" not in meta:
+            print("还没有元数据,请使用'meta sync [source]'导入.")
+            return
+        print(f"元数据版本{meta['version']},共{operators}位干员,{banners}个卡池,"
+              f"于{meta.get('synced_at', '-')}从'{meta.get('source', '-')}'同步.")
+
+    def gdo_meta_sync(self, *args):
+        source = args[0] if args else input("请输入元数据文件路径或URL:")
+        if not source:
+            return
+        try:
+            version, updated = metadata.sync(UserAgent.meta, source, force="-f" in args[1:])
+        except (OSError, ValueError, metadata.requests.RequestException) as e:
+            self.error(f"同步元数据失败: {e.__class__.__name__}: {e}")
+            return
+        operators, banners = UserAgent.meta.get_counts()
+        print(f"{'已导入' if updated else '已是最新'}元数据版本{version},共{operators}位干员,{banners}个卡池.")
+
+    def gdo_recruit(self, *args):
+        index = recruit.get_index(UserAgent.meta)
+        if not len(index):
+            print("没有可公开招募的干员,请先使用'meta sync'导入元数据.")
+            return
+        if not args:
+            print(" ".join(index.tags()))
+            return
+        try:
+            result = index.combinations(args)
+        except ValueError as e:
+            self.error(str(e))
+            return
+        if not result:
+            print("没有符合这些标签的干员.")
+            return
+        self.print_table(((" + ".join(tags), self.RARITY_LABELS[rarity], " ".join(operators))
+                          for tags, rarity, operators in result),
+                         headers=["标签组合", "保底", "可能的干员"], width=[24, 4, 40], index=False)
+
+    def gdo_export(self, *args):
+        file = args[0] if args else input("请输入导出文件路径(.ritc或.parquet):")
+        if not file:
+            return
+        try:
+            md5, sha256 = UserAgent.gachaDb.dump(None, file)
+        except ValueError as e:
+            self.error(str(e))
+            return
+        print(f"""
+        导出全部账号成功!文件大小{os.path.getsize(file) / 1024:.1f}KiB,校验码如下:
+        md5:{md5}
+        sha256:{sha256}
+        """)
+
     def do_index_login_phone__password(self, *args):
         self.loc.append("login_PhonePassword")
         flag = len(args) == 2
@@ -266,13 +561,13 @@ class Terminal:
                 try:
                     user = UserAgent.login_phone_password(phone, password)
                 except ua.PasswordError:
-                    print("用户名或密码错误.")
+                    self.error("用户名或密码错误.")
                 except ua.CaptchaError:
-                    print("需要人机验证,请使用token登录.")
+                    self.error("需要人机验证,请使用token登录.")
                 except ua.LoginError:
-                    print("登录失败.")
+                    self.error("登录失败.")
                 except Exception as e:
-                    print(e.__class__.__name__, str(e))
+                    self.error(f"{e.__class__.__name__} {e}")
                 else:
                     self.loc.pop()
                     self.user = user
@@ -297,7 +592,7 @@ class Terminal:
             try:
                 users = next(generator)
             except Exception as e:
-                print("无用户登录记录,请先登录.")
+                self.error("无用户登录记录,请先登录.")
                 _terminalLogger.debug(f"login local: no user ({e.__class__.__name__}: '{e}')")
                 self.loc.pop()
                 return
@@ -326,30 +621,74 @@ class Terminal:
         try:
             user = UserAgent.login_token(token)
         except Exception as e:
-            print(f"{e.__class__.__name__}: {e}")
+            self.error(f"{e.__class__.__name__}: {e}")
             return
         self.user = user
         return self.menu_user()
 
+    def do_index_login_uid(self, uid: str = None, *args):
+        if uid is None or not uid.isdigit():
+            self.error("请输入uid,如'login uid 123456'.")
+            return
+        identities = UserAgent.userDb.get_identities(uid=int(uid))
+        if not identities:
+            self.error(f"没有uid为{uid}的登录记录,请先登录.")
+            return
+        generator = UserAgent.login_local(uid=int(uid), channel_id=identities[0][3])
+        next(generator)
+        self.user = generator.send(0)
+        return self.menu_user()
+
     def menu_user(self):
         _terminalLogger.info(f"menu {self.user}")
         self.loc.append("user")
         print(f"""
         Dr.{self.user.username.rsplit("#", 1)[0]} 欢迎回来!
         """)
+        if self.batch:  # 批处理模式下同步更新,之后的指令即可读取最新数据
+            if self.user.has_connection():
+                print("更新抽卡数据成功!共更新{}条数据,其中{}条已录入.".format(*self.user.update()))
+            return
         if self.user.has_connection():
-            r = self.user.update()
-            print("更新抽卡数据成功!共更新{}条数据,其中{}条已录入.".format(*r))
+            self.task = self.user.update_background()
+            print("正在后台更新抽卡数据,博士可以先查看已有的数据.")
         e = None
         while e is None:
-            stdin = input(">>>")
+            self.report_update()
+            stdin = input(self.prompt())
+            self.report_update()
             e = self.DO(stdin)
+        self.logout()
+
+    def logout(self):
+        if self.task is not None and self.task.is_alive():
+            print("正在等待更新完成...")
+            self.task.join()
+            self.report_update()
         self.loc.pop()
         print("正在登出...")
         self.user.logout()
         self.user = None
         _terminalLogger.info("menu user: logout")
-        time.sleep(0.5)
+        self.sleep(0.5)
+
+    def prompt(self):
+        if self.task is not None and self.task.is_alive():
+            return "[更新中 {}/{}]>>>".format(self.task.page, self.task.pages or "?")
+        return ">>>"
+
+    def report_update(self):
+        """
+        后台更新结束后输出一次结果
+        :return:
+        """
+        if self.task is None or self.task.is_alive():
+            return
+        task, self.task = self.task, None
+        if task.error is not None:
+            self.error(f"更新抽卡数据失败: {task.error.__class__.__name__}: {task.error}")
+        else:
+            print("更新抽卡数据成功!共更新{}条数据,其中{}条已录入.".format(*task.result))
 
     def do_user_help(self, *args):
         print("""
@@ -359,6 +698,11 @@ class Terminal:
         summary 寻访简报(真的只是简报啦……)
         view    total [max] 详细数据
                 rarity      各稀有度干员统计
+                pity [all]  6星保底分布与实际出率(all:统计全部本地账号)
+                luck [all]  欧气百分位与各卡池期望花费
+                global [n]  全部本地账号的汇总数据与最常抽到的n位干员
+                six         6星记录及职业、是否为UP干员和卡池开放时间(需要先同步元数据,见meta)
+        dump    [file] [-i] 导出寻访记录(.csv/.json/.ritc/.parquet),-i:CSV只追加上次导出之后的新记录
         """)
 
     def do_user_basic(self, *args):
@@ -366,22 +710,89 @@ class Terminal:
         return
 
     def do_user_view_total(self, max_cnt: int = None, *args):
-        self.print_table(self.user.get_total(max_cnt=max_cnt), headers=["时间", "卡池", "序号", "干员", "稀有度"],
-                         width=[19, 10, 5, 8, 2], index=True)
+        self.print_cached_table(("total", max_cnt), lambda: self.user.get_total(max_cnt=max_cnt),
+                                headers=["时间", "卡池", "序号", "干员", "稀有度"], width=[19, 10, 5, 8, 2], index=True)
 
     def do_user_view_rarity(self, *args):
-        val = {(str(i + 1) + "星"): j for i, j in self.user.get_rarity().items()}.items()
-        self.print_table(val, headers=["稀有度", "总数"], width=None, index=False)
+        self.print_cached_table(("rarity",), lambda: ((self.RARITY_LABELS[i], j) for i, j in
+                                                      self.user.get_rarity().items()),
+                                headers=["稀有度", "总数"], width=None, index=False)
+
+    def do_user_view_pity(self, *args):
+        pity = self.user.get_pity(all_users=bool(args) and args[0].lower() == "all")
+        if not sum(pity["gaps"]) and not pity["reached"][0]:
+            print("没有抽卡记录看个毛线,快去玩明日方舟!!!")
+            return
+        val = []
+        for start in range(0, len(pity["gaps"]), 10):
+            hits = sum(pity["gaps"][start:start + 10])
+            pulls = sum(pity["reached"][start:start + 10])
+            if not pulls:
+                continue
+            official = sum(o * n for o, n in zip(pity["official"][start:start + 10], pity["reached"][start:start + 10]))
+            val.append((f"{start + 1}-{start + 10}", hits, pulls, "{:.2f}%".format(hits / pulls * 100),
+                        "{:.2f}%".format(official / pulls * 100)))
+        self.print_table(val, headers=["抽数", "6星数", "抽卡数", "实际出率", "官方出率"], width=[7, 5, 6, 8, 8],
+                         index=False, end=f"6星总数: {sum(pity['gaps'])}")
+
+    def do_user_view_six(self, *args):
+        rows = self.user.get_six()
+        if not rows:
+            print("还没有抽到6星干员,博士再接再厉!")
+            return
+        label = {True: "UP", False: "歪", None: "-"}
+        self.print_table(((ts, pool, operator, profession or "-", pulls, label[rate_up],
+                           "-" if banner is None else f"{banner[0][:10]}~{banner[1][:10] if banner[1] else ''}")
+                          for ts, pool, operator, profession, pulls, rate_up, banner in rows),
+                         headers=["时间", "卡池", "干员", "职业", "抽数", "UP", "卡池开放时间"],
+                         width=[19, 10, 8, 4, 4, 2, 21], index=False,
+                         end=None if UserAgent.meta.get_version() else "没有元数据,请先使用'meta sync'导入.")
+
+    def do_user_view_luck(self, *args):
+        all_users = bool(args) and args[0].lower() == "all"
+        luck, rates = self.user.get_luck(all_users=all_users)
+        if not luck["count"]:
+            print(f"共抽卡{luck['pulls']}次,还没有抽到6星干员,博士再接再厉!")
+        else:
+            print("共抽卡{}次,获得6星干员{}位,平均{:.2f}抽出货(官方期望{:.2f}抽),最欧{}抽,最非{}抽.".format(
+                luck["pulls"], luck["count"], luck["mean"], luck["expected"], luck["best"], luck["worst"]))
+            print("博士的欧气超过了{:.2f}%的博士.".format(luck["percentile"]))
+        print("实际出率: " + ", ".join("{}星 {:.2f}%(官方 {:.2f}%)".format(rarity + 1, real * 100, official * 100)
+                                       for rarity, (real, official) in rates.items()))
+        if all_users:
+            return
+        self.print_table(((pool, cnt, six, remain, "{:.1f}".format(exp), "{:.0f}".format(cost))
+                          for pool, cnt, six, remain, exp, cost in self.user.get_costs()),
+                         headers=["卡池", "抽数", "6星数", "已垫", "期望抽数", "期望合成玉"], width=[10, 5, 5, 4, 8, 10],
+                         index=False)
+
+    def do_user_view_global(self, limit: str = "10", *args):
+        db = UserAgent.gachaDb
+        rarity = db.get_global_rarity()
+        total = sum(rarity.values())
+        if not total:
+            print("本地还没有任何抽卡记录.")
+            return
+        print("全部账号共抽卡{}次,6星出率{:.2f}%,5星出率{:.2f}%.".format(
+            total, rarity[5] / total * 100, rarity[4] / total * 100))
+        self.print_table(db.get_global_pools(), headers=["卡池", "抽数", "6星数"], width=[10, 7, 5], index=False)
+        self.print_table(((name, rar + 1, cnt, users) for name, rar, cnt, users in
+                          db.get_top_operators(int(limit) if limit.isdigit() else 10)),
+                         headers=["干员", "星级", "次数", "账号数"], width=[8, 4, 7, 6], index=True)
 
     def do_user_logout(self, *args):
         return True
 
     def do_user_update(self, *args):
-        if self.user.has_connection():
-            r = self.user.update()
-            print("更新抽卡数据成功!共更新{}条数据,其中{}条已录入.".format(*r))
+        if self.task is not None:
+            print("正在后台更新,已获取{}/{}页.".format(self.task.page, self.task.pages or "?"))
+        elif self.user.has_connection() and self.batch:
+            print("更新抽卡数据成功!共更新{}条数据,其中{}条已录入.".format(*self.user.update()))
+        elif self.user.has_connection():
+            self.task = self.user.update_background()
+            print("正在后台更新抽卡数据...")
         else:
-            print("无网络,无法更新数据.")
+            self.error("无网络,无法更新数据.")
 
     def do_user_summary(self, *args):
         duration = self.user.get_duration()
@@ -404,14 +815,16 @@ class Terminal:
             rarity[3] / cnt_sum * 100))
 
     def do_user_dump(self, *args):
+        incremental = "-i" in args
+        args = [arg for arg in args if arg != "-i"]
         if len(args) == 1:
             file = args[0]
         else:
             file = input("请输入导出文件路径:")
         try:
-            md5, sha256 = self.user.dump(file)
+            md5, sha256 = self.user.dump(file, incremental=incremental)
         except Exception:
-            print("路径非法!")
+            self.error("路径非法!")
             return
         print(f"""
         导出成功!文件校验码如下:
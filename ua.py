@@ -1,6 +1,12 @@
 import json
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from database import UserModel, GachaModel
+import analytics
+from database import UserModel, MetaModel, open_databases
+from sharding import open_gacha_model
+from snapshot import Snapshot, snapshot_file
 from online_service import *
 import logging
 
@@ -10,26 +16,55 @@ class LoginError(Exception):
     pass
 
 
+class UpdateTask(threading.Thread):
+    """
+    在后台线程中更新抽卡数据,每获取一页写入一次,主线程可同时读取已写入的数据
+    """
+
+    def __init__(self, user):
+        super().__init__(name=f"update-{user.uid}", daemon=True)
+        self.user = user
+        self.page = 0
+        self.pages = 0
+        self.result = None
+        self.error = None
+
+    def progress(self, page: int, pages: int):
+        self.page, self.pages = page, pages
+
+    def run(self):
+        try:
+            self.result = self.user.update(progress=self.progress)
+        except Exception as e:
+            _uaLogger.error(f"update user(uid={self.user.uid}) in background failed: {e.__class__.__name__}: {e}",
+                            exc_info=True)
+            self.error = e
+
+
 class UserAgent:
-    userDb = UserModel()
-    gachaDb = GachaModel()
-    osv = OnlineService()
+    userDb, gachaDb, meta = open_databases(UserModel, open_gacha_model, MetaModel)
+    cache = ResponseCache()
     __pool = {}
+    __lock = threading.RLock()  # 保护__pool,登录、登出可在不同线程中进行
 
     def __new__(cls, *args, **kwargs):
         uid = kwargs.get("uid")
         if uid is None:
             uid = args[0]
-        inst = cls.__pool.get(uid)
-        if inst is None:
-            raise ValueError("user has not logged in.")
-        elif inst is Ellipsis:
-            inst = super().__new__(cls)
-            cls.__pool[uid] = inst
+        with cls.__lock:
+            inst = cls.__pool.get(uid)
+            if inst is None:
+                raise ValueError("user has not logged in.")
+            elif inst is Ellipsis:
+                inst = super().__new__(cls)
+                cls.__pool[uid] = inst
         return inst
 
     def __init__(self, uid: int, phone: int or str = None, username: str = None, token: str = None,
-                 channel_id: int = 1, mode: str = "unknown"):
+                 channel_id: int = 1, mode: str = "unknown", osv: OnlineService = None):
+        """
+        :param osv: 该用户独立的网络会话(独立的cookies),为None时新建
+        """
         _uaLogger.info(f"initialize user(uid={uid}, name='{username}').")
         self.uid = uid
         self.username = username
@@ -37,6 +72,49 @@ class UserAgent:
         self.token = token
         self.channel_id = channel_id
         self.mode = mode
+        self.osv = self.new_session() if osv is None else osv
+        self._snapshot = None
+
+    @classmethod
+    def new_session(cls):
+        """
+        返回 新的OnlineService,cookies独立,连接池和响应缓存共用
+        :return:
+        """
+        return OnlineService(cache=cls.cache)
+
+    @classmethod
+    def _reserve(cls, uid: int):
+        with cls.__lock:
+            cls.__pool[uid] = Ellipsis
+
+    @classmethod
+    def users(cls):
+        """
+        返回 list[已登录的UserAgent]
+        :return:
+        """
+        with cls.__lock:
+            return [inst for inst in cls.__pool.values() if inst is not Ellipsis]
+
+    @classmethod
+    def update_all(cls, concurrency: int = 4):
+        """
+        并发更新所有有网络连接的已登录用户
+        返回 dict[uid:更新结果或异常]
+        :param concurrency:
+        :return:
+        """
+        users = [user for user in cls.users() if user.has_connection()]
+        results = {}
+        with ThreadPoolExecutor(concurrency, thread_name_prefix="update") as executor:
+            futures = {executor.submit(user.update): user.uid for user in users}
+            for future, uid in futures.items():
+                error = future.exception()
+                if error is not None:
+                    _uaLogger.error(f"update user(uid={uid}) failed: {error.__class__.__name__}: {error}")
+                results[uid] = future.result() if error is None else error
+        return results
 
     def __str__(self):
         res = "user(uid="+str(self.uid)
@@ -50,7 +128,13 @@ class UserAgent:
         return res
 
     def logout(self):
-        del self.__pool[self.uid]
+        if self.token is not None:
+            self.osv.clear_cache(self.token)
+        if self._snapshot is not None:
+            self._snapshot.close()
+            self._snapshot = None
+        with self.__lock:
+            self.__pool.pop(self.uid, None)
 
     def user_execute(self, sql: str, sql_val: tuple = ()):
         return self.userDb.execute(sql, sql_val)
@@ -60,35 +144,142 @@ class UserAgent:
         return self.gachaDb.execute(sql, sql_val)
 
     def get_total(self, earliest_time: str or int or float = None, max_cnt: int = None):
+        snap = self.snapshot() if earliest_time is None else None
+        if snap is not None:
+            return snap.get_total(max_cnt)
         return self.gachaDb.get_total(self.uid, earliest_time, max_cnt)
 
     def get_duration(self):
+        snap = self.snapshot()
+        if snap is not None:
+            return snap.get_duration()
         return self.gachaDb.get_duration(self.uid)
 
     def get_rarity(self,  earliest_time: str or int or float = None):
+        snap = self.snapshot() if earliest_time is None else None
+        if snap is not None:
+            return snap.get_rarity()
         return self.gachaDb.get_rarity(self.uid, earliest_time)
 
+    def version(self):
+        """
+        返回 该账号的数据版本号(记录条数),写入新记录后增大
+        :return:
+        """
+        return self.gachaDb.get_version(self.uid)
+
+    def snapshot(self):
+        """
+        离线时返回与数据库一致的快照,快照不存在或已过期(如导入了新数据)时重新生成;在线时返回None
+        :return:
+        """
+        if self.has_connection():
+            return None
+        version = self.version()
+        if self._snapshot is not None and self._snapshot.version == version:
+            return self._snapshot
+        if self._snapshot is not None:
+            self._snapshot.close()
+            self._snapshot = None
+        file = snapshot_file(self.uid)
+        try:
+            snap = Snapshot(file)
+        except (OSError, ValueError):
+            snap = None
+        if snap is None or snap.version != version:
+            if snap is not None:
+                snap.close()
+            snap = Snapshot(self.refresh_snapshot())
+        self._snapshot = snap
+        return snap
+
+    def refresh_snapshot(self):
+        """
+        重新生成快照文件,返回文件路径
+        :return:
+        """
+        return Snapshot.write(self.gachaDb, self.uid, snapshot_file(self.uid))
+
+    def get_six(self):
+        """
+        返回 list[tuple[时间, 卡池, 干员, 职业, 抽数, 是否为UP干员, 卡池(开始时间, 结束时间, UP干员)]],按时间升序
+        职业与卡池信息来自MetaModel的内存索引,没有元数据时为None
+        :return:
+        """
+        index = self.meta.index()
+        pulls = {}
+        result = []
+        for ts, _, pool, operator, rarity, _ in self.gachaDb.get_rows(self.uid):
+            pulls[pool] = pulls.get(pool, 0) + 1
+            if rarity != 5:
+                continue
+            banner = index.banner(pool, ts)
+            rate_up = None if banner is None or not banner[2] else operator in banner[2]
+            result.append((ts, pool, operator, index.profession(operator), pulls[pool], rate_up, banner))
+            pulls[pool] = 0
+        return result
+
     def get_remains(self):
+        snap = self.snapshot()
+        if snap is not None:
+            return snap.get_remains()
         return self.gachaDb.get_remains(self.uid)
 
     def get_counts(self,  earliest_time: str or int or float = None):
+        snap = self.snapshot() if earliest_time is None else None
+        if snap is not None:
+            return snap.get_pools()
         return self.gachaDb.get_pools(self.uid, earliest_time)
 
     def get_operators(self, rarity: int = 5, earliest_time: str or int or float = None):
         return self.gachaDb.get_operators(self.uid, rarity, earliest_time)
 
+    def load_history(self):
+        return self.gachaDb.load_history(self.uid)
+
+    def load_histories(self, all_users: bool = False):
+        if not all_users:
+            return (self.load_history(),)
+        return tuple(self.gachaDb.load_history(uid) for uid in self.gachaDb.get_uids())
+
+    def get_pity(self, all_users: bool = False):
+        return analytics.pity_histogram(self.load_histories(all_users))
+
+    def get_luck(self, all_users: bool = False):
+        histories = self.load_histories(all_users)
+        return analytics.luck(histories), analytics.empirical_rates(histories)
+
+    def get_costs(self):
+        return analytics.expected_cost(self.load_history())
+
     def has_connection(self):
         return self.token is not None
 
-    def update(self):
+    def update(self, progress=None):
         results = [0][:] * 4
-        for line in self.osv.get_gacha(token=self.token, channel_id=self.channel_id):
-            r = self.gachaDb.loads(uid=self.uid, js=line)
+        version = self.version()
+        for page in self.osv.get_gacha(token=self.token, channel_id=self.channel_id, progress=progress, raw=True):
+            r = self.gachaDb.loads(uid=self.uid, js=page)
             results = [a + b for a, b in zip(results, r)]
+        if self.version() == version:  # 没有写入新记录,已有快照仍然有效
+            return results
+        try:
+            self.refresh_snapshot()
+        except (OSError, sqlite3.Error) as e:  # 快照只用于加速离线查看,生成失败时离线查看会重新生成
+            _uaLogger.error(f"refresh snapshot of user(uid={self.uid}) failed: {e.__class__.__name__}: {e}")
         return results
 
-    def dump(self, file, file_type=None):
-        return self.gachaDb.dump(self.uid, file, file_type=file_type)
+    def update_background(self):
+        """
+        返回 已启动的UpdateTask
+        :return:
+        """
+        task = UpdateTask(self)
+        task.start()
+        return task
+
+    def dump(self, file, file_type=None, incremental=False):
+        return self.gachaDb.dump(self.uid, file, file_type=file_type, incremental=incremental)
 
     @staticmethod
     def is_password(password: str):
@@ -113,8 +304,9 @@ class UserAgent:
         elif not cls.is_password(password):
             _uaLogger.error(f"'{password}' is not a legal password.")
             raise ValueError(f"'{password}' is not a legal password.")
+        osv = cls.new_session()
         try:
-            token = cls.osv.login_phone_password(str(phone), password)
+            token = osv.login_phone_password(str(phone), password)
         except PasswordError as e:
             _uaLogger.error(f"meet {e.__class__.__name__} when login by phone and password: {str(e)}")
             raise ValueError(f"wrong password '{password}'.")
@@ -125,7 +317,7 @@ class UserAgent:
             _uaLogger.error(f"meet {e.__class__.__name__} when login by phone and password: {str(e)}")
             raise e
         _uaLogger.info(f"user(phone='{phone}') successfully log in")
-        req = cls.osv.get_basic(token)
+        req = osv.get_basic(token)
 
         if not req:
             _uaLogger.error(f"login error because of bad token")
@@ -134,17 +326,18 @@ class UserAgent:
         uid = int(req["uid"])
         channel_id = req["channelMasterId"]
         username = req["nickName"]
-        cls.__pool[uid] = Ellipsis
+        cls._reserve(uid)
 
         not_exists = cls.userDb.insert_user(uid, channel_id, phone=phone, username=username)
         if not not_exists:
             cls.userDb.update_user(uid, channel_id, phone=phone, username=username, update_time=True)
 
-        cookies = cls.osv.get_cookies_from_token(token, channel_id=1)
+        cookies = osv.get_cookies_from_token(token, channel_id=1)
         if cookies is not None:
             _uaLogger.info("update cookies.")
             cls.userDb.update_user(uid, channel_id, cookies=cookies, update_time=False)
-        return cls(uid=uid, phone=phone, username=username, token=token, channel_id=channel_id, mode="phone_password")
+        return cls(uid=uid, phone=phone, username=username, token=token, channel_id=channel_id, mode="phone_password",
+                   osv=osv)
 
     @classmethod
     def login_local(cls, uid: int = None, phone: int or str = None, username: str = None, channel_id: int = 1):
@@ -170,16 +363,17 @@ class UserAgent:
         phone = results[1]
         username = results[2]
         cookies = results[4]
-        cls.__pool[uid] = Ellipsis
+        cls._reserve(uid)
 
+        osv = cls.new_session()
         try:
-            token = cls.osv.login_cookies({"ACCOUNT" if channel_id == 1 else "ACCOUNT_AK_B": cookies},
+            token = osv.login_cookies({"ACCOUNT" if channel_id == 1 else "ACCOUNT_AK_B": cookies},
                                           channel_id=channel_id)
         except Exception:
             _uaLogger.debug("no Internet connection.")
             token = None
         if token is not None:
-            req = cls.osv.get_basic(token, channel_id)
+            req = osv.get_basic(token, channel_id)
         else:
             req = {}
         if req:
@@ -190,7 +384,7 @@ class UserAgent:
         else:
             token = None  # 保证网络连接正常显示
             cls.userDb.update_user(uid, channel_id, cookies=None, update_time=False)
-        yield cls(uid=uid, phone=phone, username=username, channel_id=channel_id, token=token, mode="local")
+        yield cls(uid=uid, phone=phone, username=username, channel_id=channel_id, token=token, mode="local", osv=osv)
         return
 
     @classmethod
@@ -211,23 +405,24 @@ class UserAgent:
         else:
             _uaLogger.error("bad token")
             raise ValueError("bad token")
+        osv = cls.new_session()
         try:
-            cookies = cls.osv.get_cookies_from_token(token=token, channel_id=channel_id)
+            cookies = osv.get_cookies_from_token(token=token, channel_id=channel_id)
         except Exception as e:
             _uaLogger.error(f"bad token '{token}'(channelId={channel_id}), meet error ({e.__class__.__name__}): {e}")
             raise ValueError(f"bad token '{token}'")
         _uaLogger.info(f"get cookies by token '{token}'.")
-        result = cls.osv.get_basic(token=token, channel_id=channel_id)
+        result = osv.get_basic(token=token, channel_id=channel_id)
         if not result:
             _uaLogger.error(f"bad token '{token}'(channelId={channel_id})")
             raise ValueError(f"bad token '{token}'")
         uid = int(result.get("uid"))
         username = result.get("nickName")
-        cls.__pool[uid] = Ellipsis
+        cls._reserve(uid)
         not_exists = cls.userDb.insert_user(uid, channel_id, username=username, cookies=cookies)
         if not not_exists:
             cls.userDb.update_user(uid, channel_id, username=username, cookies=cookies, update_time=True)
-        return cls(uid=uid, username=username, token=token, channel_id=channel_id, mode="token")
+        return cls(uid=uid, username=username, token=token, channel_id=channel_id, mode="token", osv=osv)
 
 
 if __name__ == "__main__":